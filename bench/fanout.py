@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+"""
+Fan-out benchmark for the rbd-target-api
+
+Starts N instances of the rbd-target-api flask app in this process, each
+listening on its own localhost port and backed by the in-memory stand-ins in
+bench/stubs.py. Requests between the instances are routed by gateway name or
+portal IP to the right port, with a configurable latency, jitter and failure
+rate per gateway, so the cost of call_api, seed_tpg/seed_disks/seed_clients
+and friends can be measured without real gateways.
+
+The following operations are timed, end-to-end (as the gwcli on the first
+gateway would see them) and per hop (each request the API servers make to
+each other);
+  disk_create    PUT /api/disk/<image_id>
+  client_create  PUT /api/client/<iqn>
+  client_map     PUT /api/clientlun/<iqn>
+  gateway_join   PUT /api/gateway/<name>, adding the last gateway
+  clearconfig    DELETE /api/_gateway/<name> on each gateway
+
+Results are written to stdout as JSON. Example;
+
+  python bench/fanout.py --gateways 4 --disks 200 --clients 50 \\
+                         --latency 0.002 --jitter 0.001 \\
+                         --gateway-latency gw3=0.02:0.005:0.01
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from collections import defaultdict
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+try:
+    from importlib.machinery import SourceFileLoader
+
+    def load_source(name, path):
+        return SourceFileLoader(name, path).load_module()
+except ImportError:
+    from imp import load_source
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, repo_dir)
+
+import stubs
+cluster = stubs.install()
+
+import flask
+import requests
+from werkzeug.serving import make_server
+
+import gwcli.utils
+from gwcli.utils import APIRequest, GatewayAPIError
+from gwcli.perf import LatencyStats
+import ceph_iscsi_config.settings as settings
+
+__author__ = 'Paul Cuzner'
+
+TARGET_IQN = 'iqn.2003-01.com.redhat.iscsi-gw:bench'
+CLIENT_PREFIX = 'iqn.1994-05.com.redhat:bench'
+OPERATIONS = ['disk_create', 'client_map', 'gateway_join', 'clearconfig']
+
+context = threading.local()
+
+
+def current_gateway():
+    """
+    work out which of the fake gateways the calling code is running on; the
+    flask app handling the request, the gateway a worker thread was started
+    for, or the first gateway (where the gwcli driving the benchmark runs)
+    """
+
+    if flask.has_app_context():
+        return flask.current_app.config['GATEWAY_NAME']
+    return getattr(context, 'gateway', None) or Harness.local_gateway
+
+
+def propagate_gateway(run_concurrently):
+    """
+    wrap run_concurrently so the pool threads know which gateway they're
+    running on
+    """
+
+    def wrapper(func, items, max_workers=8):
+        gw_name = current_gateway()
+
+        def call(item):
+            context.gateway = gw_name
+            try:
+                return func(item)
+            finally:
+                context.gateway = None
+
+        return run_concurrently(call, items, max_workers)
+
+    return wrapper
+
+
+class Link(object):
+    """
+    network characteristics of the path to a gateway
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+    @classmethod
+    def parse(cls, spec, default):
+        """
+        :param spec: (str) latency[:jitter[:failure_rate]] in seconds
+        :param default: Link providing values for any missing fields
+        """
+        fields = [float(f) for f in spec.split(':')]
+        values = fields + [default.jitter, default.failure_rate][len(fields) - 1:]
+        return cls(*values[:3])
+
+
+class Network(object):
+    """
+    Route the requests module's http calls to the fake gateways, applying
+    the link characteristics of the target gateway to remote calls
+    """
+
+    methods = ['get', 'put', 'delete']
+
+    def __init__(self, gateways, default_link, links):
+        self.gateways = gateways            # name -> FakeGateway
+        self.default_link = default_link
+        self.links = links                  # name -> Link
+        self.real = dict((m, getattr(requests, m)) for m in self.methods)
+        self.hops = defaultdict(lambda: defaultdict(LatencyStats))
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+
+    def install(self):
+        for method in self.methods:
+            setattr(requests, method, self._wrap(method))
+
+    def reset(self):
+        self.hops = defaultdict(lambda: defaultdict(LatencyStats))
+
+    def resolve(self, host):
+        if host in ('127.0.0.1', 'localhost'):
+            return current_gateway()
+        if host in self.gateways:
+            return host
+        return cluster.gateway_for_ip(host)
+
+    def _wrap(self, method):
+
+        real_method = self.real[method]
+
+        def call(url, *args, **kwargs):
+            parsed = urlparse(url)
+            target = self.resolve(parsed.hostname)
+            if target not in self.gateways:
+                return real_method(url, *args, **kwargs)
+
+            gw_url = "http://127.0.0.1:{}{}".format(self.gateways[target].port,
+                                                    parsed.path)
+            hop = "{} {}".format(method.upper(),
+                                 parsed.path.split('/')[2])
+            stats = self.hops[hop][target]
+
+            start = time.time()
+            if target != current_gateway():
+                link = self.links.get(target, self.default_link)
+                with self.lock:
+                    delay = link.latency + self.random.uniform(0, link.jitter)
+                    failed = self.random.random() < link.failure_rate
+                time.sleep(delay)
+                if failed:
+                    stats.add(time.time() - start, error=True)
+                    raise requests.ConnectionError("injected failure "
+                                                   "for {}".format(target))
+
+            response = real_method(gw_url, *args, **kwargs)
+            stats.add(time.time() - start,
+                      error=response.status_code != 200)
+            return response
+
+        return call
+
+
+class FakeGateway(object):
+    """
+    An instance of the rbd-target-api running as a named gateway
+    """
+
+    def __init__(self, name, ip_address, watch_interval):
+        self.name = name
+        self.ip_address = ip_address
+
+        api_path = os.path.join(repo_dir, 'rbd-target-api.py')
+        module = load_source('rbd_target_api_{}'.format(name), api_path)
+
+        module.logger = logging.getLogger('rbd-target-api.{}'.format(name))
+        module.this_host = current_gateway
+        module.pre_reqs_errors = lambda: []
+        module.run_concurrently = propagate_gateway(module.run_concurrently)
+        module.config = stubs.Config(module.logger)
+        module.config_events.epoch = module.get_snapshot().epoch
+        module.app.config['GATEWAY_NAME'] = name
+        self.module = module
+
+        self.watcher = module.ConfigWatcher(interval=watch_interval)
+        self.server = make_server('127.0.0.1', 0, module.app, threaded=True)
+        self.port = self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        self.watcher.start()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class Harness(object):
+
+    local_gateway = 'gw1'
+
+    def __init__(self, args):
+        self.args = args
+        self.names = ['gw{}'.format(n) for n in range(1, args.gateways + 1)]
+        self.joining = self.names[-1] if 'gateway_join' in args.ops else None
+        self.gateways = {}
+        self.operations = defaultdict(LatencyStats)
+        self.hops = {}
+
+        for n, name in enumerate(self.names, 1):
+            cluster.host_ips[name] = ['10.90.0.{}'.format(n)]
+
+        self.seed()
+
+        for name in self.names:
+            self.gateways[name] = FakeGateway(name,
+                                              cluster.host_ips[name][0],
+                                              args.watch_interval)
+
+        links = dict((name, Link.parse(spec, args.default_link))
+                     for name, spec in args.gateway_latency)
+        self.network = Network(self.gateways, args.default_link, links)
+        self.network.install()
+
+        for gateway in self.gateways.values():
+            gateway.start()
+
+    def seed(self):
+        """
+        define the gateways (bar the one that will join) and the disks and
+        clients needed to reach the requested config size
+        """
+
+        args = self.args
+        defined = [name for name in self.names if name != self.joining]
+        settings.config.minimum_gateways = min(2, len(defined))
+
+        config = cluster.empty_config()
+        ip_list = [cluster.host_ips[name][0] for name in defined]
+        config['gateways'] = {"iqn": TARGET_IQN, "ip_list": ip_list}
+        for name in defined:
+            portal_ip = cluster.host_ips[name][0]
+            config['gateways'][name] = {
+                "portal_ip_address": portal_ip,
+                "iqn": TARGET_IQN,
+                "active_luns": 0,
+                "tpgs": len(ip_list),
+                "gateway_ip_list": ip_list,
+                "inactive_portal_ips": [ip for ip in ip_list
+                                        if ip != portal_ip]}
+
+        cluster.pools = {'rbd': {}}
+        disk_keys = []
+        for n in range(args.disks):
+            image = 'seed{}'.format(n)
+            cluster.add_image('rbd', image, 1024 ** 3)
+            disk_key = 'rbd.{}'.format(image)
+            config['disks'][disk_key] = {"pool": "rbd",
+                                         "image": image,
+                                         "owner": defined[n % len(defined)],
+                                         "wwn": "bench-{}".format(n),
+                                         "pool_id": 0}
+            disk_keys.append(disk_key)
+
+        for n in range(args.clients):
+            luns = {}
+            if disk_keys:
+                for lun_id in range(args.luns_per_client):
+                    disk_key = disk_keys[(n * args.luns_per_client + lun_id) %
+                                         len(disk_keys)]
+                    luns[disk_key] = {"lun_id": lun_id}
+            config['clients']['{}-seed{}'.format(CLIENT_PREFIX, n)] = {
+                "auth": {"chap": ''}, "luns": luns, "group_name": ''}
+
+        config['epoch'] = 1
+        with cluster.lock:
+            cluster.config = config
+
+    def reset(self):
+        self.seed()
+        for gateway in self.gateways.values():
+            gateway.module.refresh_config()
+            gateway.module.session_cache['sessions'] = None
+
+    def api(self, method, path, data=None):
+        """
+        issue a request from the first gateway (as gwcli would), returning
+        the elapsed time and whether the request succeeded
+        """
+
+        url = "http://127.0.0.1:{}/api/{}".format(settings.config.api_port,
+                                                  path)
+        api = APIRequest(url, data=data)
+        start = time.time()
+        try:
+            getattr(api, method)()
+        except GatewayAPIError:
+            return time.time() - start, False, 'connection failed'
+
+        elapsed = time.time() - start
+        ok = api.response.status_code == 200
+        if not ok:
+            try:
+                msg = api.response.json()['message']
+            except ValueError:
+                msg = "http {}".format(api.response.status_code)
+            logging.getLogger('bench').warning("{} {} : {}".format(method,
+                                                                   path, msg))
+        return elapsed, ok, None
+
+    def timed(self, operation, method, path, data=None):
+        elapsed, ok, _ = self.api(method, path, data)
+        self.operations[operation].add(elapsed, error=not ok)
+        return ok
+
+    def run_disk_create(self, round_num):
+        for n in range(self.args.iterations):
+            self.timed('disk_create', 'put',
+                       'disk/rbd.bench{}_{}'.format(round_num, n),
+                       data={"mode": "create", "size": "1G", "count": "1",
+                             "pool": "rbd"})
+
+    def run_client_map(self, round_num):
+        for n in range(self.args.iterations):
+            disk_key = 'rbd.bench{}_{}'.format(round_num, n)
+            if disk_key not in cluster.read_config()['disks']:
+                # disk_create wasn't requested, so create it (untimed)
+                self.api('put', 'disk/{}'.format(disk_key),
+                         data={"mode": "create", "size": "1G", "count": "1",
+                               "pool": "rbd"})
+
+            client_iqn = '{}-{}-{}'.format(CLIENT_PREFIX, round_num, n)
+            if self.timed('client_create', 'put',
+                          'client/{}'.format(client_iqn)):
+                self.timed('client_map', 'put',
+                           'clientlun/{}'.format(client_iqn),
+                           data={"disk": disk_key})
+
+    def run_gateway_join(self, round_num):
+        data = {"ip_address": cluster.host_ips[self.joining][0]}
+        if not self.args.join_sync:
+            data['nosync'] = 'true'
+        self.timed('gateway_join', 'put', 'gateway/{}'.format(self.joining),
+                   data=data)
+
+    def run_clearconfig(self, round_num):
+        # as gwcli clearconfig does, remove the local gateway last
+        gateways = [name for name in cluster.read_config()['gateways']
+                    if name.startswith('gw')]
+        gateways.sort(key=lambda name: name == self.local_gateway)
+
+        total = 0.0
+        ok = True
+        for name in gateways:
+            url_host = name if name != self.local_gateway else '127.0.0.1'
+            api = APIRequest("http://{}:{}/api/_gateway/"
+                             "{}".format(url_host, settings.config.api_port,
+                                         name))
+            start = time.time()
+            try:
+                api.delete()
+                ok = ok and api.response.status_code == 200
+            except GatewayAPIError:
+                ok = False
+            total += time.time() - start
+
+        self.operations['clearconfig'].add(total, error=not ok)
+
+    def run(self):
+        for round_num in range(self.args.rounds):
+            if round_num:
+                self.reset()
+            for operation in OPERATIONS:
+                if operation in self.args.ops:
+                    self.network.reset()
+                    getattr(self, 'run_{}'.format(operation))(round_num)
+                    self.merge_hops(operation)
+
+    def merge_hops(self, operation):
+        for hop, targets in self.network.hops.items():
+            for gw_name, stats in targets.items():
+                combined = self.hops.setdefault(operation, {}).setdefault(
+                    hop, {}).setdefault(gw_name, LatencyStats())
+                for sample in stats.samples:
+                    combined.add(sample)
+                combined.errors += stats.errors
+
+    def report(self):
+        args = self.args
+        return {
+            "settings": {"gateways": args.gateways,
+                         "disks": args.disks,
+                         "clients": args.clients,
+                         "luns_per_client": args.luns_per_client,
+                         "iterations": args.iterations,
+                         "rounds": args.rounds,
+                         "latency": args.default_link.latency,
+                         "jitter": args.default_link.jitter,
+                         "failure_rate": args.default_link.failure_rate,
+                         "gateway_latency": dict(args.gateway_latency),
+                         "lio_latency": args.lio_latency},
+            "operations": dict((op, stats.summary())
+                               for op, stats in self.operations.items()),
+            "hops": dict((op, dict((hop, dict((gw, stats.summary())
+                                              for gw, stats in gws.items()))
+                                   for hop, gws in hops.items()))
+                         for op, hops in self.hops.items()),
+            "stub_calls": dict(cluster.calls)}
+
+    def stop(self):
+        for gateway in self.gateways.values():
+            gateway.stop()
+
+
+def gateway_link(spec):
+    if '=' not in spec:
+        raise argparse.ArgumentTypeError("expected name=latency[:jitter"
+                                         "[:failure_rate]]")
+    name, link = spec.split('=', 1)
+    return name, link
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the API fan-out across fake gateways")
+    parser.add_argument('--gateways', type=int, default=3,
+                        help="number of gateways, including the one that "
+                             "joins during the gateway_join operation")
+    parser.add_argument('--disks', type=int, default=0,
+                        help="disks defined before the run")
+    parser.add_argument('--clients', type=int, default=0,
+                        help="clients defined before the run")
+    parser.add_argument('--luns-per-client', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=10,
+                        help="disk/client operations per round")
+    parser.add_argument('--rounds', type=int, default=1,
+                        help="repeat the run, resetting the config each time")
+    parser.add_argument('--ops', nargs='+', choices=OPERATIONS,
+                        default=OPERATIONS)
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help="one-way latency (s) of gateway to gateway calls")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="random extra latency (s), 0-jitter")
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help="fraction of remote calls that fail to connect")
+    parser.add_argument('--gateway-latency', type=gateway_link,
+                        action='append', default=[],
+                        metavar='NAME=LATENCY[:JITTER[:FAILURE_RATE]]',
+                        help="link settings for calls to a specific gateway")
+    parser.add_argument('--lio-latency', type=float, default=0.0,
+                        help="time (s) taken by each LIO change")
+    parser.add_argument('--join-sync', action='store_true',
+                        help="sync disks and clients to the joining gateway")
+    parser.add_argument('--watch-interval', type=float, default=1,
+                        help="ConfigWatcher poll interval (s)")
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    if args.gateways < 2:
+        parser.error("at least 2 gateways are needed")
+
+    args.default_link = Link(args.latency, args.jitter, args.failure_rate)
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.ERROR,
+                        stream=sys.stderr)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    logging.getLogger('bench').setLevel(logging.WARNING)
+
+    for op in ['lio.target.target', 'lio.target.map', 'lio.target.clearconfig',
+               'lio.lun.allocate', 'lio.lun.remove', 'lio.client.present',
+               'lio.client.absent', 'lio.group.apply', 'lio.group.purge']:
+        cluster.latency[op] = args.lio_latency
+
+    gwcli.utils.this_host = current_gateway
+    stubs.gateway_resolver = current_gateway
+
+    harness = Harness(args)
+    try:
+        harness.run()
+    finally:
+        harness.stop()
+
+    json.dump(harness.report(), sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
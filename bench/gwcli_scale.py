@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+"""
+gwcli scale benchmark
+
+Generates synthetic gateway configurations of increasing size, serves each
+one from a stub API (GET /api/config and /api/sessions) and measures the gwcli
+against it, using the in-memory rados/rbd/rtslib stand-ins from bench/stubs.py.
+Each size is run in a separate process so the peak RSS is per size.
+
+The phases measured are;
+  import         importing gwcli
+  root_init      creating the shell and the ISCSIRoot object
+  refresh        ISCSIRoot.refresh(), building the full tree
+  <command>      each of the commands below, output discarded
+  disk_delete_pending
+                 /disks delete of a disk whose rbd meta data hasn't been
+                 fetched yet (after a refresh, with the meta data cache off).
+                 gwcli sends the delete to the local hostname, which must
+                 resolve to a loopback address to reach the stub API
+and for each phase the wall time, the peak RSS so far and the calls made to
+the stubs and the API are recorded.
+
+Sizes are given as DISKSxCLIENTS. Example;
+
+  python bench/gwcli_scale.py --sizes 10x10,100x500,1000x5000,5000x5000 \\
+                              --luns-per-client 2 --group-size 10
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from collections import defaultdict
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+
+__author__ = 'Paul Cuzner'
+
+TARGET_IQN = 'iqn.2003-01.com.redhat.iscsi-gw:bench'
+CLIENT_PREFIX = 'iqn.1994-05.com.redhat:client'
+
+COMMANDS = [('ls', 'ls /'),
+            ('ls_disks', 'ls /disks'),
+            ('ls_hosts', 'ls /iscsi-target/{target}/hosts'),
+            ('disk_info', '/disks info {disk}'),
+            ('client_info', '/iscsi-target/{target}/hosts/{client} info'),
+            ('gateways_refresh', '/iscsi-target/{target}/gateways refresh'),
+            ('ceph_refresh', '/clusters refresh')]
+
+
+def generate_config(disks, clients, luns_per_client=1, group_size=0,
+                    gateways=2):
+    """
+    build a gateway config object of the requested size. The content is
+    deterministic, so the API server and the gwcli process generate the same
+    config independently
+    :return: (dict) config object
+    """
+
+    gw_names = ['gw{}'.format(n) for n in range(1, gateways + 1)]
+    ip_list = ['127.0.1.{}'.format(n) for n in range(1, gateways + 1)]
+
+    config = {"disks": {},
+              "gateways": {"iqn": TARGET_IQN,
+                           "ip_list": ip_list,
+                           "created": "2017/01/01 00:00:00"},
+              "clients": {},
+              "groups": {},
+              "created": "2017/01/01 00:00:00",
+              "updated": "2017/01/01 00:00:00",
+              "epoch": 1,
+              "version": 3}
+
+    for gw_name, portal_ip in zip(gw_names, ip_list):
+        config['gateways'][gw_name] = {
+            "portal_ip_address": portal_ip,
+            "iqn": TARGET_IQN,
+            "active_luns": disks // gateways,
+            "tpgs": gateways,
+            "gateway_ip_list": ip_list,
+            "inactive_portal_ips": [ip for ip in ip_list if ip != portal_ip],
+            "created": "2017/01/01 00:00:00",
+            "updated": "2017/01/01 00:00:00"}
+
+    disk_keys = []
+    for n in range(disks):
+        disk_key = 'rbd.disk{}'.format(n)
+        config['disks'][disk_key] = {
+            "pool": "rbd",
+            "image": "disk{}".format(n),
+            "owner": gw_names[n % gateways],
+            "wwn": "00000000-0000-0000-0000-{:012d}".format(n),
+            "pool_id": 0,
+            "created": "2017/01/01 00:00:00",
+            "updated": "2017/01/01 00:00:00"}
+        disk_keys.append(disk_key)
+
+    for n in range(clients):
+        luns = {}
+        if disk_keys:
+            for lun_id in range(luns_per_client):
+                disk_key = disk_keys[(n * luns_per_client + lun_id) %
+                                     len(disk_keys)]
+                luns[disk_key] = {"lun_id": lun_id}
+
+        chap = 'client{}/password{:06d}'.format(n, n) if n % 2 else ''
+        config['clients']['{}{}'.format(CLIENT_PREFIX, n)] = {
+            "auth": {"chap": chap},
+            "luns": luns,
+            "group_name": "",
+            "created": "2017/01/01 00:00:00",
+            "updated": "2017/01/01 00:00:00"}
+
+    if group_size:
+        client_iqns = sorted(config['clients'])
+        for g, start in enumerate(range(0, len(client_iqns), group_size)):
+            group_name = 'group{}'.format(g)
+            members = client_iqns[start:start + group_size]
+            group_disks = sorted(set(disk for iqn in members
+                                     for disk in
+                                     config['clients'][iqn]['luns']))
+            config['groups'][group_name] = {"members": members,
+                                            "disks": group_disks}
+            for iqn in members:
+                config['clients'][iqn]['group_name'] = group_name
+
+    return config
+
+
+def generate_sessions(config, logged_in):
+    """
+    build the /api/sessions response, with the given fraction of the clients
+    logged in to every gateway
+    """
+
+    gw_names = sorted(gw for gw in config['gateways']
+                      if isinstance(config['gateways'][gw], dict))
+    sessions = {}
+    client_iqns = sorted(config['clients'])
+    for n, iqn in enumerate(client_iqns[:int(len(client_iqns) * logged_in)]):
+        address = "10.{}.{}.{}".format(n >> 16 & 255, n >> 8 & 255, n & 255)
+        sessions[iqn] = {"state": "LOGGED_IN",
+                         "gateways": dict(
+                             (gw, {"state": "LOGGED_IN",
+                                   "connections": 1,
+                                   "portal": address})
+                             for gw in gw_names)}
+
+    return {"sessions": sessions, "unreachable": []}
+
+
+class StubAPIHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/api/config' and \
+                self.headers.get('If-None-Match') == self.server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        content = self.server.content.get(path)
+        if content is None:
+            self.send_response(404)
+            content = json.dumps({"message": "not supported by the stub "
+                                             "api"}).encode('utf-8')
+        else:
+            self.send_response(200)
+
+        self.send_content(content)
+
+    def do_DELETE(self):
+        # disk deletes are accepted (the worker removes the image from its
+        # own stub cluster), anything else isn't supported
+        if self.path.startswith('/api/disk/'):
+            self.send_response(200)
+            content = json.dumps({"message": "ok"}).encode('utf-8')
+        else:
+            self.send_response(404)
+            content = json.dumps({"message": "not supported by the stub "
+                                             "api"}).encode('utf-8')
+
+        self.send_content(content)
+
+    def send_content(self, content):
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubAPIServer(ThreadingMixIn, HTTPServer):
+    """
+    serves pre-encoded responses for the read-only endpoints gwcli uses
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubAPIHandler)
+        self.content = {}
+        self.etag = None
+
+    def load(self, config, sessions):
+        self.etag = '"{}"'.format(config['epoch'])
+        self.content = {
+            "/api/config": json.dumps(config).encode('utf-8'),
+            "/api/sessions": json.dumps(sessions).encode('utf-8')}
+
+
+class DiscardOutput(object):
+    """
+    send anything written to stdout (including by the configshell console,
+    which holds its own reference to the stream) to /dev/null
+    """
+
+    def __enter__(self):
+        sys.stdout.flush()
+        self.saved = os.dup(1)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.close(devnull)
+
+    def __exit__(self, *args):
+        sys.stdout.flush()
+        os.dup2(self.saved, 1)
+        os.close(self.saved)
+
+
+def run_worker(args):
+    """
+    measure the gwcli against the stub API (runs in a child process)
+    """
+
+    sys.path.insert(0, repo_dir)
+    sys.path.insert(0, bench_dir)
+
+    import logging
+    import stubs
+
+    cluster = stubs.install()
+    stubs.gateway_resolver = lambda: 'gw1'
+
+    config = generate_config(args.disks, args.clients, args.luns_per_client,
+                             args.group_size, args.gateways)
+    for disk in config['disks'].values():
+        cluster.add_image(disk['pool'], disk['image'], 10 * 1024 ** 3)
+
+    logger = logging.getLogger('gwcli')
+    logger.addHandler(logging.NullHandler())
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG, stream=sys.stderr)
+
+    workdir = tempfile.mkdtemp(prefix='gwcli-scale-')
+    for name in ['ceph.conf', 'ceph.client.admin.keyring']:
+        open(os.path.join(workdir, name), 'w').close()
+
+    api_calls = defaultdict(int)
+    phases = []
+
+    def measure(name, func):
+        cluster.reset_calls()
+        api_calls.clear()
+        start = time.time()
+        error = None
+        try:
+            with DiscardOutput():
+                func()
+        except Exception as err:
+            error = "{}: {}".format(type(err).__name__, err)
+            if args.debug:
+                traceback.print_exc()
+        phases.append({"phase": name,
+                       "wall_s": round(time.time() - start, 4),
+                       "peak_rss_kb": resource.getrusage(
+                           resource.RUSAGE_SELF).ru_maxrss,
+                       "stub_calls": dict(cluster.calls),
+                       "api_calls": dict(api_calls),
+                       "error": error})
+        return error is None
+
+    state = {}
+
+    def count_calls(real):
+        def counted(url, *args, **kwargs):
+            api_calls[url.split('/api/', 1)[-1].split('/')[0]] += 1
+            return real(url, *args, **kwargs)
+        return counted
+
+    def import_gwcli():
+        import requests
+        import ceph_iscsi_config.settings as settings
+        from gwcli.ceph import CephGroup
+        try:
+            from importlib.machinery import SourceFileLoader
+            cli = SourceFileLoader('gwcli_cli', os.path.join(
+                repo_dir, 'gwcli.py')).load_module()
+        except ImportError:
+            import imp
+            cli = imp.load_source('gwcli_cli',
+                                  os.path.join(repo_dir, 'gwcli.py'))
+
+        settings.config.api_port = args.api_port
+        settings.config.interactive = False
+        CephGroup.ceph_config_dir = workdir
+
+        for method in ['get', 'put', 'delete']:
+            setattr(requests, method, count_calls(getattr(requests, method)))
+
+        state['cli'] = cli
+
+    def root_init():
+        from gwcli.gateway import ISCSIRoot
+        shell = state['cli'].GatewayCLI(workdir)
+        state['shell'] = shell
+        state['root'] = ISCSIRoot(shell)
+        state['root'].interactive = False
+
+    def refresh():
+        state['root'].refresh()
+
+    def pend_meta_data(disk_id):
+        """
+        reload the tree with the rbd meta data of the disks pending (the meta
+        data cache off), and remove the disk's image from the cluster as the
+        API's delete would
+        """
+
+        state['root'].disks.meta_cache.ttl = 0
+        state['root'].refresh()
+
+        pool, image = disk_id.split('.', 1)
+        del cluster.pools[pool][image]
+
+    ok = (measure('import', import_gwcli) and
+          measure('root_init', root_init) and
+          measure('refresh', refresh))
+
+    if ok:
+        names = {"target": TARGET_IQN,
+                 "disk": sorted(config['disks'])[0] if config['disks'] else '',
+                 "client": (sorted(config['clients'])[0]
+                            if config['clients'] else '')}
+        for name, command in COMMANDS:
+            if '{disk}' in command and not names['disk']:
+                continue
+            if '{client}' in command and not names['client']:
+                continue
+
+            def run_command(command=command.format(**names)):
+                state['shell'].run_cmdline(command)
+
+            measure(name, run_command)
+
+        if names['disk']:
+            pend_meta_data(names['disk'])
+
+            def delete_disk(command='/disks delete {disk}'.format(**names)):
+                state['shell'].run_cmdline(command)
+
+            measure('disk_delete_pending', delete_disk)
+
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    json.dump({"disks": args.disks,
+               "clients": args.clients,
+               "luns_per_client": args.luns_per_client,
+               "group_size": args.group_size,
+               "gateways": args.gateways,
+               "phases": phases}, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+def parse_sizes(sizes):
+    try:
+        return [tuple(int(n) for n in size.lower().split('x'))
+                for size in sizes.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("sizes must be DISKSxCLIENTS, "
+                                         "comma separated")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure gwcli startup and commands against synthetic "
+                    "configurations")
+    parser.add_argument('--sizes', type=parse_sizes,
+                        default=parse_sizes('10x10,100x500,1000x5000'),
+                        help="comma separated DISKSxCLIENTS config sizes "
+                             "(default 10x10,100x500,1000x5000)")
+    parser.add_argument('--luns-per-client', type=int, default=1)
+    parser.add_argument('--group-size', type=int, default=0,
+                        help="clients per host group (0 for no groups)")
+    parser.add_argument('--gateways', type=int, default=2)
+    parser.add_argument('--logged-in', type=float, default=0.5,
+                        help="fraction of clients with active sessions")
+    parser.add_argument('--timeout', type=float, default=1800,
+                        help="time limit (s) for each size")
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--worker', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--disks', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--clients', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--api-port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    server = StubAPIServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    results = []
+    for disks, clients in args.sizes:
+        config = generate_config(disks, clients, args.luns_per_client,
+                                 args.group_size, args.gateways)
+        server.load(config, generate_sessions(config, args.logged_in))
+
+        sys.stderr.write("measuring {} disks, {} clients\n".format(disks,
+                                                                   clients))
+        cmd = [sys.executable, os.path.abspath(__file__), '--worker',
+               '--disks', str(disks), '--clients', str(clients),
+               '--luns-per-client', str(args.luns_per_client),
+               '--group-size', str(args.group_size),
+               '--gateways', str(args.gateways),
+               '--api-port', str(server.server_port)]
+        if args.debug:
+            cmd.append('--debug')
+
+        worker = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        timer = threading.Timer(args.timeout, worker.kill)
+        timer.start()
+        output = worker.communicate()[0]
+        timer.cancel()
+
+        if worker.returncode != 0:
+            results.append({"disks": disks, "clients": clients,
+                            "error": "worker exited with "
+                                     "{}".format(worker.returncode)})
+        else:
+            results.append(json.loads(output.decode('utf-8')))
+
+    server.shutdown()
+
+    json.dump({"settings": {"luns_per_client": args.luns_per_client,
+                            "group_size": args.group_size,
+                            "gateways": args.gateways,
+                            "logged_in": args.logged_in},
+               "results": results}, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,629 @@
+#!/usr/bin/env python
+"""
+In-memory stand-ins for the rados, rbd, rtslib_fb and ceph_iscsi_config
+modules (plus rpm and OpenSSL), so the rbd-target-api and gwcli code can be
+exercised on a machine without a ceph cluster or LIO.
+
+The stand-ins share a single Cluster instance holding the rbd images, the
+gateway.conf config object and the iSCSI sessions of each gateway. Operations
+that would touch LIO or ceph can be given a latency (cluster.latency) and every
+stub call is counted (cluster.calls).
+
+Call install() before importing anything from gwcli or rbd-target-api.
+"""
+
+import copy
+import json
+import re
+import socket
+import sys
+import threading
+import time
+import types
+import uuid
+
+from collections import defaultdict
+
+__author__ = 'Paul Cuzner'
+
+
+def default_gateway():
+    return socket.gethostname().split('.')[0]
+
+
+# callable returning the name of the gateway the calling code is running on.
+# A harness running several gateways in one process replaces this
+gateway_resolver = default_gateway
+
+
+def current_gateway():
+    return gateway_resolver()
+
+
+class Cluster(object):
+    """
+    State of the fake ceph cluster and the LIO instance of each gateway
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.pools = {'rbd': {}}        # pool -> image -> {size, features}
+        self.config = self.empty_config()
+        self.host_ips = {}              # gateway name -> [ipv4 addresses]
+        self.sessions = {}              # gateway name -> [(iqn, state)]
+        self.latency = {}               # stub op -> seconds
+        self.calls = defaultdict(int)   # stub op -> call count
+
+    @staticmethod
+    def empty_config():
+        now = time.strftime("%Y/%m/%d %H:%M:%S")
+        return {"disks": {},
+                "gateways": {},
+                "clients": {},
+                "groups": {},
+                "created": now,
+                "updated": now,
+                "epoch": 0,
+                "version": 3}
+
+    def call(self, op):
+        """
+        record a call to a stub operation, applying any latency defined for it
+        """
+        with self.lock:
+            self.calls[op] += 1
+        delay = self.latency.get(op, 0)
+        if delay:
+            time.sleep(delay)
+
+    def read_config(self):
+        with self.lock:
+            return copy.deepcopy(self.config)
+
+    def update_config(self, func):
+        """
+        apply a change to the config object as a read-modify-write, bumping
+        the epoch when func reports a change
+        :param func: callable taking the config dict, returning True if it
+                     changed the config
+        """
+        with self.lock:
+            if func(self.config):
+                self.config['epoch'] += 1
+                self.config['updated'] = time.strftime("%Y/%m/%d %H:%M:%S")
+
+    def add_image(self, pool, image, size, features=61):
+        with self.lock:
+            self.pools.setdefault(pool, {})[image] = {"size": size,
+                                                      "features": features}
+
+    def gateway_for_ip(self, ip_address):
+        for gw_name, ips in self.host_ips.items():
+            if ip_address in ips:
+                return gw_name
+        return None
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+
+cluster = Cluster()
+
+
+def size_to_bytes(size):
+    """
+    convert a size string (e.g. 10G) to bytes
+    """
+    units = {'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = str(size).upper()
+    return int(size[:-1]) * units[size[-1]]
+
+
+# rados ----------------------------------------------------------------------
+
+class ObjectNotFound(Exception):
+    pass
+
+
+class Ioctx(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def get_xattr(self, obj_name, xattr_name):
+        cluster.call('rados.get_xattr')
+        if self.pool != 'rbd' or obj_name != 'gateway.conf':
+            raise ObjectNotFound(obj_name)
+        with cluster.lock:
+            return str(cluster.config.get(xattr_name, ''))
+
+    def read(self, obj_name, length=8192, offset=0):
+        cluster.call('rados.read')
+        return json.dumps(cluster.read_config())
+
+
+class Rados(object):
+
+    def __init__(self, conffile=None, **kwargs):
+        self.conffile = conffile
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def connect(self, timeout=0):
+        cluster.call('rados.connect')
+
+    def shutdown(self):
+        pass
+
+    def list_pools(self):
+        cluster.call('rados.list_pools')
+        return list(cluster.pools)
+
+    def open_ioctx(self, pool):
+        cluster.call('rados.open_ioctx')
+        if pool not in cluster.pools:
+            raise ObjectNotFound(pool)
+        return Ioctx(pool)
+
+    def mon_command(self, cmd, inbuf, timeout=0):
+        request = json.loads(cmd)
+        prefix = request['prefix']
+        cluster.call('mon_command.{}'.format(prefix.replace(' ', '_')))
+
+        if prefix == 'status':
+            mons = [{"name": "mon{}".format(n), "health": "HEALTH_OK"}
+                    for n in range(3)]
+            out = {"health": {"overall_status": "HEALTH_OK",
+                              "timechecks": {"mons": mons}},
+                   "osdmap": {"osdmap": {"num_osds": 12}},
+                   "monmap": {"mons": mons}}
+        elif prefix == 'osd dump':
+            out = {"pools": [{"pool_name": pool, "type": 1, "size": 3,
+                              "min_size": 2} for pool in cluster.pools]}
+        elif prefix == 'df':
+            out = {"pools": [{"name": pool,
+                              "stats": {"max_avail": 100 * 1024 ** 4,
+                                        "bytes_used": 10 * 1024 ** 4}}
+                             for pool in cluster.pools]}
+        else:
+            return -22, '', 'unsupported command {}'.format(prefix)
+
+        return 0, json.dumps(out), ''
+
+
+# rbd ------------------------------------------------------------------------
+
+class ImageNotFound(Exception):
+    pass
+
+
+class Image(object):
+
+    def __init__(self, ioctx, name, snapshot=None, read_only=False):
+        cluster.call('rbd.open')
+        self.pool = ioctx.pool
+        self.name = name
+        try:
+            self.meta = cluster.pools[self.pool][name]
+        except KeyError:
+            raise ImageNotFound(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def size(self):
+        cluster.call('rbd.size')
+        return self.meta['size']
+
+    def features(self):
+        cluster.call('rbd.features')
+        return self.meta['features']
+
+    def resize(self, size):
+        cluster.call('rbd.resize')
+        self.meta['size'] = size
+
+
+class RBD(object):
+
+    def list(self, ioctx):
+        cluster.call('rbd.list')
+        return list(cluster.pools.get(ioctx.pool, {}))
+
+
+# rtslib_fb ------------------------------------------------------------------
+
+class RTSLibError(Exception):
+    pass
+
+
+def normalize_wwn(wwn_types, wwn):
+    if not re.match(r'^iqn\.\d{4}-\d{2}\.[^:\s]+(:\S+)?$', wwn.lower()):
+        raise RTSLibError("WWN not valid as: {}".format(', '.join(wwn_types)))
+    return wwn.lower(), 'iqn'
+
+
+class NetworkPortal(object):
+
+    def __init__(self, ip_address):
+        self.ip_address = ip_address
+
+
+class TPG(object):
+
+    def __init__(self, ip_addresses):
+        self.network_portals = [NetworkPortal(ip) for ip in ip_addresses]
+
+
+class NodeACL(object):
+
+    def __init__(self, node_wwn, tpg):
+        self.node_wwn = node_wwn
+        self.parent_tpg = tpg
+
+
+class RTSRoot(object):
+
+    def __init__(self):
+        cluster.call('rtslib.root')
+
+    @property
+    def sessions(self):
+        cluster.call('rtslib.sessions')
+        gw_name = current_gateway()
+        tpg = TPG(cluster.host_ips.get(gw_name, []))
+        for iqn, state in list(cluster.sessions.get(gw_name, [])):
+            yield {"parent_nodeacl": NodeACL(iqn, tpg),
+                   "state": state,
+                   "connections": [{"cid": 0, "cstate": state}]}
+
+    @property
+    def targets(self):
+        return []
+
+
+# ceph_iscsi_config ----------------------------------------------------------
+
+class Settings(object):
+
+    defaults = {"cluster_name": "ceph",
+                "gateway_keyring": "ceph.client.admin.keyring",
+                "cephconf": "/etc/ceph/ceph.conf",
+                "time_out": 30,
+                "api_port": 5000,
+                "api_secure": False,
+                "api_ssl_verify": False,
+                "api_user": "admin",
+                "api_password": "admin",
+                "trusted_ip_list": [],
+                "minimum_gateways": 2}
+
+    def __init__(self):
+        for name, value in self.defaults.items():
+            setattr(self, name, copy.copy(value))
+
+
+class Config(object):
+
+    def __init__(self, logger, cfg_name='gateway.conf', pool='rbd'):
+        self.logger = logger
+        self.error = False
+        self.error_msg = ''
+        self.changed = False
+        self.config = self.get_config()
+
+    def get_config(self):
+        cluster.call('config.read')
+        return cluster.read_config()
+
+    def refresh(self):
+        self.config = self.get_config()
+
+
+class GWTarget(object):
+
+    def __init__(self, logger, iqn, gateway_ip_list):
+        self.logger = logger
+        self.iqn = iqn
+        self.gateway_ip_list = list(gateway_ip_list)
+        self.error = False
+        self.error_msg = ''
+
+    def manage(self, mode):
+        cluster.call('lio.target.{}'.format(mode))
+        gw_name = current_gateway()
+
+        def define(config):
+            gateways = config['gateways']
+            gateways['iqn'] = self.iqn
+            gateways['ip_list'] = self.gateway_ip_list
+            local_ips = [ip for ip in self.gateway_ip_list
+                         if ip in cluster.host_ips.get(gw_name, [])]
+            if not local_ips:
+                # existing gateway, adding a tpg for the new portal
+                return True
+            gateways[gw_name] = {"portal_ip_address": local_ips[0],
+                                 "iqn": self.iqn,
+                                 "active_luns": 0,
+                                 "tpgs": len(self.gateway_ip_list),
+                                 "gateway_ip_list": self.gateway_ip_list,
+                                 "inactive_portal_ips": [
+                                     ip for ip in self.gateway_ip_list
+                                     if ip != local_ips[0]]}
+            return True
+
+        def clear(config):
+            gateways = config['gateways']
+            gw_md = gateways.pop(gw_name, None)
+            if gw_md is None:
+                return False
+            ip_list = [ip for ip in gateways.get('ip_list', [])
+                       if ip != gw_md['portal_ip_address']]
+            gateways['ip_list'] = ip_list
+            return True
+
+        if mode == 'init':
+            cluster.update_config(lambda config: config['gateways'].update(
+                {"iqn": self.iqn}) or True)
+        elif mode == 'target':
+            cluster.update_config(define)
+        elif mode == 'clearconfig':
+            cluster.update_config(clear)
+
+
+class LUN(object):
+
+    def __init__(self, logger, pool, image, size, allocating_host):
+        self.logger = logger
+        self.pool = pool
+        self.image = image
+        self.size = size
+        self.allocating_host = allocating_host
+        self.error = False
+        self.error_msg = ''
+
+    def allocate(self):
+        cluster.call('lio.lun.allocate')
+        disk_key = "{}.{}".format(self.pool, self.image)
+        size = size_to_bytes(self.size)
+
+        images = cluster.pools.setdefault(self.pool, {})
+        if self.image not in images:
+            cluster.call('rbd.create')
+            cluster.add_image(self.pool, self.image, size)
+        elif size > images[self.image]['size']:
+            cluster.call('rbd.resize')
+            images[self.image]['size'] = size
+
+        def add_disk(config):
+            if disk_key in config['disks']:
+                return False
+            config['disks'][disk_key] = {"pool": self.pool,
+                                         "image": self.image,
+                                         "owner": self.allocating_host,
+                                         "wwn": str(uuid.uuid4()),
+                                         "pool_id": 0}
+            return True
+
+        cluster.update_config(add_disk)
+
+    def remove_lun(self):
+        cluster.call('lio.lun.remove')
+        if current_gateway() != self.allocating_host:
+            return
+
+        disk_key = "{}.{}".format(self.pool, self.image)
+        cluster.pools.get(self.pool, {}).pop(self.image, None)
+        cluster.update_config(
+            lambda config: config['disks'].pop(disk_key, None) is not None)
+
+
+class CHAP(object):
+
+    def __init__(self, chap_str):
+        self.chap_str = chap_str
+        if '/' in chap_str:
+            self.user, self.password = chap_str.split('/', 1)
+        else:
+            self.user, self.password = '', ''
+        self.error = False
+        self.error_msg = ''
+
+
+class GWClient(object):
+
+    def __init__(self, logger, client_iqn, image_list, chap):
+        self.logger = logger
+        self.iqn = client_iqn
+        self.requested_images = list(image_list)
+        self.chap = '' if chap == '/' else chap
+        self.error = False
+        self.error_msg = ''
+
+    def manage(self, rqst_type, committer=None):
+        cluster.call('lio.client.{}'.format(rqst_type))
+        if committer != current_gateway():
+            return
+
+        def present(config):
+            client = config['clients'].setdefault(self.iqn,
+                                                  {"auth": {"chap": ''},
+                                                   "luns": {},
+                                                   "group_name": ''})
+            client['auth']['chap'] = self.chap
+            luns = client['luns']
+            for disk in list(luns):
+                if disk not in self.requested_images:
+                    del luns[disk]
+            for disk in self.requested_images:
+                if disk not in luns:
+                    used = [lun['lun_id'] for lun in luns.values()]
+                    luns[disk] = {"lun_id": max(used + [-1]) + 1}
+            return True
+
+        if rqst_type == 'present':
+            cluster.update_config(present)
+        elif rqst_type == 'absent':
+            cluster.update_config(
+                lambda config: config['clients'].pop(self.iqn, None)
+                is not None)
+
+
+class Group(object):
+
+    def __init__(self, logger, group_name, members=[], disks=[]):
+        self.logger = logger
+        self.group_name = group_name
+        self.members = list(members)
+        self.disks = list(disks)
+        self.error = False
+        self.error_msg = ''
+
+    def apply(self):
+        cluster.call('lio.group.apply')
+
+        def define(config):
+            group = {"members": self.members, "disks": self.disks}
+            if config['groups'].get(self.group_name) == group:
+                return False
+            config['groups'][self.group_name] = group
+            for iqn in self.members:
+                client = config['clients'].get(iqn)
+                if client is None:
+                    continue
+                client['group_name'] = self.group_name
+                for disk in self.disks:
+                    if disk not in client['luns']:
+                        used = [lun['lun_id'] for lun in
+                                client['luns'].values()]
+                        client['luns'][disk] = {"lun_id": max(used + [-1]) + 1}
+            return True
+
+        cluster.update_config(define)
+
+    def purge(self):
+        cluster.call('lio.group.purge')
+
+        def remove(config):
+            group = config['groups'].pop(self.group_name, None)
+            if group is None:
+                return False
+            for iqn in group['members']:
+                if iqn in config['clients']:
+                    config['clients'][iqn]['group_name'] = ''
+            return True
+
+        cluster.update_config(remove)
+
+
+def get_ip(addr):
+    if addr in cluster.host_ips:
+        return cluster.host_ips[addr][0]
+    if addr in ('localhost', '127.0.0.1'):
+        return '127.0.0.1'
+    if re.match(r'^\d{1,3}(\.\d{1,3}){3}$', addr):
+        return addr
+    return '0.0.0.0'
+
+
+def ipv4_addresses():
+    return list(cluster.host_ips.get(current_gateway(), []))
+
+
+def gen_file_hash(filename, hash_type='sha256'):
+    return 'stub'
+
+
+def valid_rpm(in_rpm):
+    return True
+
+
+def valid_size(size):
+    return re.match(r'^\d+[MGT]$', str(size).upper()) is not None
+
+
+def convert_2_bytes(disk_size):
+    return size_to_bytes(disk_size)
+
+
+def labelCompare(version1, version2):
+    return (version1 > version2) - (version1 < version2)
+
+
+# module installation ---------------------------------------------------------
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install():
+    """
+    register the stand-in modules in sys.modules
+    :return: Cluster instance shared by the stand-ins
+    """
+
+    settings = _module('ceph_iscsi_config.settings', config=Settings())
+    settings.init = lambda: setattr(settings, 'config', Settings())
+
+    rbd_features = dict(RBD_FEATURE_LAYERING=1,
+                        RBD_FEATURE_STRIPINGV2=2,
+                        RBD_FEATURE_EXCLUSIVE_LOCK=4,
+                        RBD_FEATURE_OBJECT_MAP=8,
+                        RBD_FEATURE_FAST_DIFF=16,
+                        RBD_FEATURE_DEEP_FLATTEN=32,
+                        RBD_FEATURE_JOURNALING=64)
+
+    _module('rados', Rados=Rados, ObjectNotFound=ObjectNotFound)
+    _module('rbd', Image=Image, RBD=RBD, ImageNotFound=ImageNotFound,
+            **rbd_features)
+    _module('rpm', labelCompare=labelCompare)
+    _module('OpenSSL.SSL')
+    _module('OpenSSL', SSL=sys.modules['OpenSSL.SSL'])
+
+    rtslib_root = _module('rtslib_fb.root', RTSRoot=RTSRoot)
+    rtslib_utils = _module('rtslib_fb.utils', RTSLibError=RTSLibError,
+                           normalize_wwn=normalize_wwn)
+    _module('rtslib_fb', root=rtslib_root, utils=rtslib_utils,
+            RTSRoot=RTSRoot, RTSLibError=RTSLibError)
+
+    submodules = {
+        'settings': settings,
+        'common': _module('ceph_iscsi_config.common', Config=Config),
+        'gateway': _module('ceph_iscsi_config.gateway', GWTarget=GWTarget),
+        'lun': _module('ceph_iscsi_config.lun', LUN=LUN),
+        'client': _module('ceph_iscsi_config.client', GWClient=GWClient,
+                          CHAP=CHAP),
+        'group': _module('ceph_iscsi_config.group', Group=Group),
+        'utils': _module('ceph_iscsi_config.utils', get_ip=get_ip,
+                         this_host=current_gateway,
+                         ipv4_addresses=ipv4_addresses,
+                         gen_file_hash=gen_file_hash, valid_rpm=valid_rpm,
+                         valid_size=valid_size,
+                         convert_2_bytes=convert_2_bytes)}
+    _module('ceph_iscsi_config', **submodules)
+
+    return cluster
@@ -10,15 +10,95 @@ import os
 import sys
 import argparse
 import signal
+import time
+
+__author__ = 'Paul Cuzner'
+__version__ = '2.5'
+
+
+def get_options():
+
+    # Set up the runtime overrides, any of these could be provided
+    # by the cfg file(s)
+    parser = argparse.ArgumentParser(prog='gwcli',
+                                     description='Manage iSCSI gateways')
+    parser.add_argument('-c', '--config-object', type=str,
+                        help='pool and object name holding the iSCSI config'
+                             ' object (pool/object_name)')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        default=False,
+                        help='run with additional debug')
+    parser.add_argument('-v', '--version', action='version',
+                        version='%(prog)s - {}'.format(__version__))
+    parser.add_argument('--profile', type=str, metavar='FILE',
+                        help='profile the cli (startup, refresh and the '
+                             'command), writing the stats to FILE (default '
+                             '~/gwcli.prof) and a summary to stderr')
+    parser.add_argument('-f', '--file', type=str, metavar='SCRIPT',
+                        help='run the commands in SCRIPT (- for stdin), one '
+                             'per line, against a single load of the '
+                             'configuration')
+    parser.add_argument('--on-error', choices=['stop', 'continue'],
+                        default='stop',
+                        help='with -f, whether to stop at the first failed '
+                             'command or continue with the next one '
+                             '(default stop)')
+    parser.add_argument('--server', action='store_true', default=False,
+                        help='keep the configuration loaded, running the '
+                             'commands of other gwcli invocations received '
+                             'over a root only unix socket')
+    parser.add_argument('cli_command', type=str, nargs=argparse.REMAINDER)
+
+    # --profile takes an optional file name, so a bare --profile (ahead of
+    # the command) is expanded here - otherwise the first word of the command
+    # would be taken as the file name
+    default_profile = os.path.join(os.path.expanduser("~"), "gwcli.prof")
+    args = sys.argv[1:]
+    ptr = 0
+    while ptr < len(args) and args[ptr].startswith('-'):
+        if args[ptr] == '--profile':
+            args[ptr] = '--profile={}'.format(default_profile)
+        elif args[ptr] in ['-c', '--config-object', '-f', '--file',
+                           '--on-error']:
+            ptr += 1
+        ptr += 1
+
+    # create the opts object
+    opts = parser.parse_args(args)
+
+    # establish defaults, just in case they're missing from the config
+    # file(s) AND run time call
+    if not opts.config_object:
+        opts.config_object = 'rbd/gateway.conf'
+
+    opts.cli_command = ' '.join(opts.cli_command)
+
+    if opts.file and opts.cli_command:
+        parser.error("a command can't be given together with -f")
+    if opts.server and (opts.file or opts.cli_command):
+        parser.error("--server doesn't take a command or -f")
+
+    return opts
+
+
+if __name__ == "__main__":
+    options = get_options()
+
+    # when a gwcli server is running, hand one-shot commands to it before
+    # the (comparatively slow) shell imports and config load. Options that
+    # change how the command runs (debug, profiling) keep it local
+    if options.cli_command and not (options.debug or options.profile):
+        from gwcli.server import forward_command
+        forwarded_rc = forward_command(options.cli_command)
+        if forwarded_rc is not None:
+            sys.exit(forwarded_rc)
 
 from configshell_fb import ConfigShell, ExecutionError
 from gwcli.gateway import ISCSIRoot
+from gwcli.perf import PhaseProfiler, LatencyStats, stats_report
 
 import ceph_iscsi_config.settings as settings
 
-__author__ = 'Paul Cuzner'
-__version__ = '2.5'
-
 
 class GatewayCLI(ConfigShell):
 
@@ -50,36 +130,203 @@ def exception_handler(exception_type, exception, traceback,
         print("{}{}: {}{}".format(color_red, exception_type.__name__,
                                   exception, color_off))
 
-def get_options():
+def kbd_handler(*args):
+    pass
 
-    # Set up the runtime overrides, any of these could be provided
-    # by the cfg file(s)
-    parser = argparse.ArgumentParser(prog='gwcli',
-                                     description='Manage iSCSI gateways')
-    parser.add_argument('-c', '--config-object', type=str,
-                        help='pool and object name holding the iSCSI config'
-                             ' object (pool/object_name)')
-    parser.add_argument('-d', '--debug', action='store_true',
-                        default=False,
-                        help='run with additional debug')
-    parser.add_argument('-v', '--version', action='version',
-                        version='%(prog)s - {}'.format(__version__))
-    parser.add_argument('cli_command', type=str, nargs=argparse.REMAINDER)
 
-    # create the opts object
-    opts = parser.parse_args()
+def profile_phases():
+    """
+    Define the phases the --profile summary breaks the time down into, by the
+    function(s) each phase is entered through
+    :return: (list) of (phase name, [functions])
+    """
 
-    # establish defaults, just in case they're missing from the config
-    # file(s) AND run time call
-    if not opts.config_object:
-        opts.config_object = 'rbd/gateway.conf'
+    from gwcli.ceph import CephGroup, CephCluster, CephPools
+    from gwcli.storage import Disk, Disks
+    from gwcli.utils import get_config, probe_ports, get_sessions
 
-    opts.cli_command = ' '.join(opts.cli_command)
+    return [("config fetch", [ISCSIRoot._get_config, get_config]),
+            ("disk metadata", [Disk.get_meta_data_tcmu,
+                               Disk.get_meta_data_krbd,
+                               Disks.load_meta_data]),
+            ("ceph queries", [CephGroup.fetch_state, CephCluster.update_state,
+                              CephPools.populate, CephPools.refresh]),
+            ("gateway probes", [probe_ports]),
+            ("session queries", [get_sessions])]
 
-    return opts
 
-def kbd_handler(*args):
-    pass
+def run_step(step_name, func, *args):
+    """
+    Run a step of the cli, under the profiler when --profile is in use
+    """
+
+    if profiler is None:
+        return func(*args)
+
+    return profiler.run(step_name, func, *args)
+
+
+def start_shell():
+    shell = GatewayCLI('~/.gwcli')
+
+    root_node = ISCSIRoot(shell)
+
+    return shell, root_node
+
+
+class CommandErrors(logging.Handler):
+    """
+    Collect the errors logged while a command runs - gwcli commands report
+    most failures through the logger, rather than raising an exception
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def read_script(script_name):
+    """
+    :param script_name: (str) script file, or - for stdin
+    :return: (list) of (line number, command) for each command in the
+             script, skipping blank lines and # comments
+    """
+
+    if script_name == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(script_name) as script:
+            lines = script.readlines()
+
+    return [(line_no, line.strip()) for line_no, line in
+            enumerate(lines, 1)
+            if line.strip() and not line.strip().startswith('#')]
+
+
+def run_script(shell, commands):
+    """
+    Run a script's commands in sequence. A command fails if it raises or logs
+    an error, and --on-error determines whether the script carries on
+    :param commands: (list) of (line number, command)
+    :return: (int) number of failed commands
+    """
+
+    errors = CommandErrors()
+    logging.getLogger('gwcli').addHandler(errors)
+
+    timings = []
+    stats = LatencyStats()
+    start = time.time()
+    try:
+        for line_no, command in commands:
+            del errors.messages[:]
+            cmd_start = time.time()
+            try:
+                shell.run_cmdline(command)
+            except Exception as err:
+                errors.messages.append(str(err))
+            elapsed = time.time() - cmd_start
+
+            stats.add(elapsed, error=bool(errors.messages))
+            timings.append((elapsed, line_no, command))
+
+            if errors.messages:
+                print("line {}: '{}' failed : {}".format(
+                      line_no, command, '; '.join(errors.messages)),
+                      file=sys.stderr)
+                if options.on_error == 'stop':
+                    break
+    finally:
+        logging.getLogger('gwcli').removeHandler(errors)
+
+    summary = stats.summary()
+    print("\nRan {} of {} command(s) in {:.3f}s, {} failed".format(
+          summary['count'], len(commands), time.time() - start,
+          summary['errors']), file=sys.stderr)
+    if timings:
+        print("Per command (ms) : mean {mean_ms}, p50 {p50_ms}, "
+              "p95 {p95_ms}, max {max_ms}".format(**summary),
+              file=sys.stderr)
+        print("Slowest commands", file=sys.stderr)
+        for elapsed, line_no, command in sorted(timings, reverse=True)[:5]:
+            print("  line {:<6} {:>10.3f}s  {}".format(line_no, elapsed,
+                                                       command),
+                  file=sys.stderr)
+
+    return summary['errors']
+
+
+def run_server(shell, root_node):
+    """
+    Serve one-shot commands from other gwcli invocations, against a tree
+    that's kept loaded
+    """
+
+    from gwcli.server import CLIServer, SOCKET_PATH
+    from gwcli.utils import get_tunable, APIRequest
+
+    def load_tree():
+        # resolve everything the first use of the tree would otherwise
+        # fetch, since each command runs in a short lived copy of the server
+        root_node.disks.load_pending_meta()
+        root_node.ceph.load()
+
+    def refresh():
+        root_node.refresh()
+        load_tree()
+
+    def config_changed():
+        # the API answers 304 (without the config) while the epoch is
+        # still the one the tree was loaded from
+        etag = '"{}"'.format(root_node.config.get('epoch', 0))
+        api = APIRequest(root_node.local_api + "/config",
+                         headers={"If-None-Match": etag})
+        api.get()
+        return api.response.status_code != 304
+
+    def run_command(command):
+        # this runs in the forked child, where stdout and stderr are the
+        # client's connection - so the messages the command logs go back to
+        # the client, and a logged error fails the command
+        logger = logging.getLogger('gwcli')
+        console = logging.StreamHandler(stream=sys.stderr)
+        console.setLevel(logging.DEBUG if options.debug else logging.INFO)
+        logger.addHandler(console)
+        errors = CommandErrors()
+        logger.addHandler(errors)
+
+        try:
+            shell.run_cmdline(command)
+        except Exception as e:
+            print(str(e), file=sys.stderr)
+            return -1
+        return -1 if errors.messages else 0
+
+    load_tree()
+
+    # the server can be stopped with ctrl-c (which removes the socket)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    server = CLIServer(SOCKET_PATH, run_command, refresh, config_changed,
+                       get_tunable('server_refresh_interval', 60))
+    print("gwcli server listening on {}".format(SOCKET_PATH))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def run_interactive(shell):
+
+    # Main loop - run the interactive shell, until the user exits
+    while not shell._exit:
+        try:
+            shell.run_interactive()
+        except ExecutionError as msg:
+            shell.log.error(str(msg))
 
 
 def main():
@@ -88,15 +335,23 @@ def main():
         print("CLI only supports root level access")
         sys.exit(-1)
 
-    shell = GatewayCLI('~/.gwcli')
+    if options.file:
+        try:
+            commands = read_script(options.file)
+        except IOError as err:
+            print("Unable to read {} : {}".format(options.file, err),
+                  file=sys.stderr)
+            sys.exit(-1)
 
-    root_node = ISCSIRoot(shell)
+    batch_mode = bool(options.cli_command or options.file or options.server)
+
+    shell, root_node = run_step('startup', start_shell)
 
-    root_node.interactive = False if options.cli_command else True
-    settings.config.interactive = False if options.cli_command else True
+    root_node.interactive = not batch_mode
+    settings.config.interactive = not batch_mode
 
     # Load the config to populate the object model
-    root_node.refresh()
+    run_step('refresh', root_node.refresh)
     if root_node.error:
         print("Unable to contact the local API endpoint "
               "({})".format(settings.config.api_endpoint))
@@ -105,20 +360,39 @@ def main():
     # Account for invocation which includes a command to run i.e. batch mode
     if options.cli_command:
 
+        # in debug mode, show the calls made by the refresh and the command
+        refresh_stats = stats_report()
+
         try:
-            shell.run_cmdline(options.cli_command)
+            run_step('command', shell.run_cmdline, options.cli_command)
         except Exception as e:
             print(str(e), file=sys.stderr)
             sys.exit(-1)
+        finally:
+            if options.debug:
+                print("\nCalls made by the refresh\n{}\n\nCalls made by "
+                      "'{}'\n{}".format(refresh_stats, options.cli_command,
+                                         stats_report()),
+                      file=sys.stderr)
 
         sys.exit(0)
 
-    # Main loop - run the interactive shell, until the user exits
-    while not shell._exit:
-        try:
-            shell.run_interactive()
-        except ExecutionError as msg:
-            shell.log.error(str(msg))
+    if options.server:
+        run_step('command', run_server, shell, root_node)
+        sys.exit(0)
+
+    if options.file:
+        # the tree is built once, and shared by all the script's commands
+        failed = run_step('command', run_script, shell, commands)
+        sys.exit(-1 if failed else 0)
+
+    run_step('command', run_interactive, shell)
+
+
+def write_profile():
+    profiler.save(options.profile)
+    sys.stderr.write("Profile stats written to {}\n\n".format(options.profile))
+    profiler.report(sys.stderr, remainder={'command': 'rendering'})
 
 
 def log_in_color(fn):
@@ -146,7 +420,6 @@ def log_in_color(fn):
     return new
 
 if __name__ == "__main__":
-    options = get_options()
 
     # Setup logging
     log_path = os.path.join(os.path.expanduser("~"), "gwcli.log")
@@ -164,7 +437,7 @@ if __name__ == "__main__":
     file_handler.setLevel(logging.DEBUG)
     logger.addHandler(file_handler)
 
-    if not options.cli_command:
+    if not (options.cli_command or options.file or options.server):
         stream_handler = logging.StreamHandler(stream=sys.stdout)
         if options.debug:
             stream_handler.setLevel(logging.DEBUG)
@@ -184,4 +457,10 @@ if __name__ == "__main__":
 
     settings.init()
 
-    main()
+    profiler = PhaseProfiler(profile_phases()) if options.profile else None
+
+    try:
+        main()
+    finally:
+        if profiler is not None:
+            write_profile()
@@ -2,11 +2,12 @@
 
 from .node import UIGroup, UINode
 import json
-import rados
 import glob
 import os
+import threading
 
-from gwcli.utils import human_size
+from gwcli.utils import (human_size, rados_cluster, mon_command,
+                         run_concurrently)
 import ceph_iscsi_config.settings as settings
 
 __author__ = 'Paul Cuzner'
@@ -37,28 +38,137 @@ class CephGroup(UIGroup):
 
     def __init__(self, parent):
         UIGroup.__init__(self, 'clusters', parent)
-        self.cluster_map = self.get_clusters()
-        self.local_ceph = None
+        self._cluster_map = self.get_clusters()
+        self._local_ceph = None
 
-        for cluster_name in self.cluster_map.keys():
+        # the clusters are added to the UI when the subtree is first shown
+        # (ls or its summary) or one of them is looked up
+        self.loaded = False
+        self.prefetched = {}        # cluster name -> state from fetch_state
+        self.prefetch_thread = None
+
+        for cluster_name in self._cluster_map.keys():
 
-            keyring = self.cluster_map[cluster_name]['keyring']
             if cluster_name == settings.config.cluster_name:
 
                 if settings.config.gateway_keyring:
                     keyring = settings.config.gateway_keyring
-                    self.cluster_map[cluster_name]['keyring'] = keyring
+                    self._cluster_map[cluster_name]['keyring'] = keyring
+
+    @staticmethod
+    def fetch_state(conf, queries=('status', 'osd dump', 'df')):
+        """
+        run the mon commands describing a cluster over a single connection
+        :param conf: (str) ceph.conf file of the cluster
+        :param queries: (list) of the mon command prefixes to run
+        :return: (dict) command prefix -> decoded json output. A failed df
+                 is left out, so the pool stats are simply not updated
+        """
+
+        state = {}
+        with rados_cluster(conf) as cluster:
+            for prefix in queries:
+                cmd = {'prefix': prefix, 'format': 'json'}
+                rc, buf_s, out = mon_command(cluster, cmd)
+                if prefix == 'df' and rc != 0:
+                    continue
+                state[prefix] = json.loads(buf_s)
+
+        return state
+
+    def prefetch(self):
+        """
+        fetch the local cluster's state in the background, so it's ready
+        when the clusters subtree is first used
+        """
+
+        if self.loaded:
+            return
+        if self.prefetch_thread and self.prefetch_thread.is_alive():
+            return
+
+        local = [name for name in self._cluster_map
+                 if self._cluster_map[name]['local']]
+        if not local:
+            return
+
+        def _fetch(cluster_name=local[0]):
+            conf = self._cluster_map[cluster_name]['conf_file']
+            try:
+                self.prefetched[cluster_name] = CephGroup.fetch_state(conf)
+            except Exception as err:
+                # the state is fetched again (raising the error) on first use
+                self.logger.debug("Prefetch of ceph cluster '{}' failed : "
+                                  "{}".format(cluster_name, err))
+
+        self.prefetch_thread = threading.Thread(target=_fetch)
+        self.prefetch_thread.daemon = True
+        self.prefetch_thread.start()
+
+    def load(self):
+        """
+        add the ceph clusters to the UI, fetching the state of any cluster
+        that hasn't been prefetched concurrently
+        """
+
+        if self.loaded:
+            return
+        self.loaded = True
+
+        if self.prefetch_thread:
+            self.prefetch_thread.join()
+
+        cluster_names = sorted(self._cluster_map)
+        states = dict(self.prefetched)
+        self.prefetched = {}
+
+        missing = [name for name in cluster_names if name not in states]
+        try:
+            fetched = run_concurrently(
+                lambda name: CephGroup.fetch_state(
+                    self._cluster_map[name]['conf_file']), missing)
+        except Exception:
+            self.loaded = False
+            raise
+        states.update(zip(missing, fetched))
+
+        for cluster_name in cluster_names:
+            cluster_info = self._cluster_map[cluster_name]
 
             # define the cluster object
             self.logger.debug("Adding ceph cluster '{}' to the UI".format(cluster_name))
             cluster = CephCluster(self,
                                   cluster_name,
-                                  self.cluster_map[cluster_name]['conf_file'],
-                                  keyring)
+                                  cluster_info['conf_file'],
+                                  cluster_info['keyring'],
+                                  states[cluster_name])
+
+            cluster_info['object'] = cluster
+            if cluster_info['local']:
+                self._local_ceph = cluster
+
+    def _get_cluster_map(self):
+        self.load()
+        return self._cluster_map
 
-            self.cluster_map[cluster_name]['object'] = cluster
-            if self.cluster_map[cluster_name]['local']:
-                self.local_ceph = cluster
+    def _get_local_ceph(self):
+        self.load()
+        return self._local_ceph
+
+    def get_child(self, name):
+        self.load()
+        return UIGroup.get_child(self, name)
+
+    def ui_command_ls(self, path=None, depth=None):
+        self.load()
+        return UIGroup.ui_command_ls(self, path, depth)
+
+    ui_command_ls.__doc__ = UIGroup.ui_command_ls.__doc__
+
+    cluster_map = property(_get_cluster_map,
+                           doc="ceph_name -> conf_file, keyring, object")
+    local_ceph = property(_get_local_ceph,
+                          doc="CephCluster object of the local cluster")
 
     def get_clusters(self):
         """
@@ -119,9 +229,22 @@ class CephGroup(UIGroup):
 
     def refresh(self):
 
-        for cluster in self.children:
-            cluster.update_state()
-            cluster.pools.refresh()
+        if not self.loaded:
+            # nothing has been shown yet, so there's nothing to update. In
+            # interactive mode the local cluster is fetched in the background
+            # ready for its first use
+            if self.parent.interactive:
+                self.prefetch()
+            return
+
+        clusters = list(self.children)
+        states = run_concurrently(
+            lambda cluster: CephGroup.fetch_state(cluster.conf,
+                                                  ('status', 'df')),
+            clusters)
+
+        for cluster, state in zip(clusters, states):
+            cluster.refresh(state)
 
 
     def summary(self):
@@ -129,6 +252,7 @@ class CephGroup(UIGroup):
         return the number of clusters
         :return:
         """
+        self.load()
         return "Clusters: {}".format(len(self.children)), None
 
     # def _get_healthy_mon(self):
@@ -149,18 +273,26 @@ class CephGroup(UIGroup):
 
 class CephCluster(UIGroup):
 
-    def __init__(self, parent, cluster_name, conf_file, keyring):
+    def __init__(self, parent, cluster_name, conf_file, keyring, state=None):
+        """
+        :param state: (dict) the cluster's state from CephGroup.fetch_state,
+               or None to query the cluster
+        """
 
         self.conf = conf_file
         self.keyring = keyring
         UIGroup.__init__(self, cluster_name, parent)
 
+        if state is None:
+            state = CephGroup.fetch_state(conf_file)
+
         self.ceph_status = {}
         self.health_status = ''
 
-        self.pools = CephPools(self)
+        self.pools = CephPools(self, state['osd dump'])
 
-        self.update_state()
+        self.update_state(state['status'])
+        self.pools.refresh(state.get('df', {}))
 
         self.topology = CephTopology(self)
 
@@ -172,18 +304,28 @@ class CephCluster(UIGroup):
 
         self.refresh()
 
-    def update_state(self):
-        with rados.Rados(conffile=self.conf) as cluster:
-            cmd = {'prefix': 'status', 'format': 'json'}
-            ret, buf_s, out = cluster.mon_command(json.dumps(cmd), b'')
+    def update_state(self, ceph_status=None):
+        if ceph_status is None:
+            with rados_cluster(self.conf) as cluster:
+                cmd = {'prefix': 'status', 'format': 'json'}
+                ret, buf_s, out = mon_command(cluster, cmd)
+            ceph_status = json.loads(buf_s)
 
-        self.ceph_status = json.loads(buf_s)
+        self.ceph_status = ceph_status
         self.health_status = self.ceph_status['health']['overall_status']
 
-    def refresh(self):
+    def refresh(self, state=None):
+        """
+        :param state: (dict) status and df output from CephGroup.fetch_state,
+               or None to query the cluster
+        """
 
-        self.update_state()
-        self.pools.refresh()
+        if state is None:
+            self.update_state()
+            self.pools.refresh()
+        else:
+            self.update_state(state['status'])
+            self.pools.refresh(state.get('df', {}))
 
     def summary(self):
         return self.health_status, None
@@ -233,26 +375,28 @@ class CephPools(UIGroup):
 
                  '''
 
-    def __init__(self, parent):
+    def __init__(self, parent, osd_dump=None):
         UIGroup.__init__(self, 'pools', parent)
 
         self.pool_lookup = {}  # pool_name -> pool object hash
-        self.populate()
+        self.populate(osd_dump)
 
-    def populate(self):
+    def populate(self, osd_dump=None):
 
         # existing_pools = [pool.name for pool in self.children]
 
 
         # get a breakdown of the osd's to retrieve the pool types
         # SLEDGEHAMMER meets NUT
-        self.logger.debug("Fetching ceph osd information")
-        with rados.Rados(conffile=self.parent.conf) as cluster:
-            cmd = {'prefix': 'osd dump', 'format': 'json'}
-            rc, buf_s, out = cluster.mon_command(json.dumps(cmd), b'')
+        if osd_dump is None:
+            self.logger.debug("Fetching ceph osd information")
+            with rados_cluster(self.parent.conf) as cluster:
+                cmd = {'prefix': 'osd dump', 'format': 'json'}
+                rc, buf_s, out = mon_command(cluster, cmd)
+            osd_dump = json.loads(buf_s)
 
         pools = {}
-        for pool in json.loads(buf_s)['pools']:
+        for pool in osd_dump['pools']:
             name = pool['pool_name']
             pools[name] = pool
 
@@ -265,7 +409,11 @@ class CephPools(UIGroup):
             new_pool = RadosPool(self, pool_name, pools[pool_name])
             self.pool_lookup[pool_name] = new_pool
 
-    def refresh(self):
+    def refresh(self, pool_info=None):
+        """
+        :param pool_info: (dict) df output from CephGroup.fetch_state, or None
+               to query the cluster
+        """
 
         self.logger.debug("Gathering pool stats for cluster "
                           "'{}'".format(self.parent.name))
@@ -275,15 +423,16 @@ class CephPools(UIGroup):
         # so stats need to be gathered at this level through the mon_command
         # interface, and pushed down to the child objects. Having a refresh
         # method within the child object would have been preferred!
-        with rados.Rados(conffile=self.parent.conf) as cluster:
-            cmd = {'prefix': 'df', 'format': 'json'}
-            rc, buf_s, out = cluster.mon_command(json.dumps(cmd), b'')
+        if pool_info is None:
+            with rados_cluster(self.parent.conf) as cluster:
+                cmd = {'prefix': 'df', 'format': 'json'}
+                rc, buf_s, out = mon_command(cluster, cmd)
+
+            pool_info = json.loads(buf_s) if rc == 0 else {}
 
-            if rc == 0:
-                pool_info = json.loads(buf_s)
-                for pool_data in pool_info['pools']:
-                    pool_name = pool_data['name']
-                    self.pool_lookup[pool_name].update(pool_data)
+        for pool_data in pool_info.get('pools', []):
+            pool_name = pool_data['name']
+            self.pool_lookup[pool_name].update(pool_data)
 
     def summary(self):
         return "Pools: {}".format(len(self.children)), True
@@ -304,24 +453,27 @@ class RadosPool(UINode):
                          "erasure")}
         self.desc, self.type = pool_type[self.pool_md['type']]
 
-    def _calc_overcommit(self):
-        root = self.parent.parent.parent.parent
-        potential_demand = 0
-        for child in root.disks.children:
-            if child.pool == self.name:
-                potential_demand += child.size
+    def _get_root(self):
+        return self.parent.parent.parent.parent
+
+    def _get_commit(self):
+        return self._get_root().disks.pool_commit(self.name)
 
-        self.commit = potential_demand
-        self.overcommit_PCT = int(
-            (potential_demand / float(self.max_bytes)) * 100)
+    def _get_overcommit(self):
+        return int((self.commit / float(self.max_bytes)) * 100)
+
+    # taken from the disks' capacity aggregates, which leave out the disks
+    # whose rbd meta data hasn't been fetched yet (shown as pending)
+    commit = property(_get_commit,
+                      doc="total size of the disks defined in the pool")
+    overcommit_PCT = property(_get_overcommit,
+                              doc="commit as a percentage of max_bytes")
 
     def update(self, pool_metadata):
 
         self.max_bytes = pool_metadata['stats']['max_avail']
         self.used_bytes = pool_metadata['stats']['bytes_used']
 
-        self._calc_overcommit()
-
     def summary(self):
         msg = ["({})".format(self.desc)]
         msg.append("Commit: {}/{} ({}%)".format(human_size(self.commit),
@@ -329,6 +481,9 @@ class RadosPool(UINode):
                                                 self.overcommit_PCT))
         #msg.append("Avail: {}".format(human_size(self.max_bytes)))
         msg.append("Used: {}".format(human_size(self.used_bytes)))
+        pending = self._get_root().disks.pool_pending(self.name)
+        if pending:
+            msg.append("Pending: {}".format(pending))
         #msg.append("Commit%: {}%".format(self.overcommit_PCT))
         return ', '.join(msg), True
 
@@ -2,13 +2,11 @@
 
 from gwcli.node import UIGroup, UINode
 
-from gwcli.utils import human_size, APIRequest
+from gwcli.utils import human_size, APIRequest, session_snapshot
 
 from ceph_iscsi_config.client import CHAP
 import ceph_iscsi_config.settings as settings
 
-import rtslib_fb.root as root
-
 # FIXME - this ignores the warning issued when verify=False is used
 from requests.packages import urllib3
 
@@ -105,8 +103,7 @@ class Clients(UIGroup):
             self.logger.debug("- '{}' removed and configuration "
                               "updated".format(client_iqn))
 
-            client = [client for client in self.children
-                      if client.name == client_iqn][0]
+            client = self.get_child(client_iqn)
 
             # remove any rbd maps from the lun_map for this client
             rbds_mapped = [lun.rbd_name for lun in client.children]
@@ -181,23 +178,32 @@ class Client(UINode):
             MappedLun(self, rbd_path, lun_id)
 
     def _get_logged_in_state(self):
+        """
+        use the merged session view from all gateways to determine the
+        client's login state
+        :return: (str) session state or '' if the client has no sessions
+        """
 
-        r = root.RTSRoot()
-        for sess in r.sessions:
-            if sess['parent_nodeacl'].node_wwn == self.client_iqn:
-                return sess['state']
-        return ''
+        client_sessions = session_snapshot.get(self.client_iqn)
+        return client_sessions.get('state', '')
 
-    def summary(self):
+    def _get_mapped_bytes(self):
+        """
+        total size of the disks mapped to the client, taken from the client's
+        own luns (each lun holds a reference to its disk)
+        """
 
-        all_disks = self.parent.parent.parent.parent.disks.children
-        total_bytes = 0
+        return sum(lun.size for lun in self.children)
 
-        client_luns = [lun.rbd_name for lun in self.children]
+    def get_mapped_lun(self, rbd_name):
+        """
+        :param rbd_name: (str) disk name (pool.image)
+        :return: the MappedLun object for the disk
+        """
 
-        for disk in all_disks:
-            if disk.image_id in client_luns:
-                total_bytes += disk.size
+        return self.get_child('lun {}'.format(self.luns[rbd_name]['lun_id']))
+
+    def summary(self):
 
         msg = ['LOGGED-IN'] if self.logged_in else []
 
@@ -212,8 +218,8 @@ class Client(UINode):
 
         msg.append(auth_text)
 
-        msg.append("Disks: {}({})".format(len(client_luns),
-                                          human_size(total_bytes)))
+        msg.append("Disks: {}({})".format(len(self.children),
+                                          human_size(self.mapped_bytes)))
 
         return ", ".join(msg), status
 
@@ -307,8 +313,7 @@ class Client(UINode):
 
             if disk not in current_luns:
                 ui_root = self.get_ui_root()
-                valid_disk_names = [defined_disk.image_id
-                                    for defined_disk in ui_root.disks.children]
+                valid_disk_names = ui_root.disks.disk_lookup
             else:
                 # disk provided is already mapped, so remind the user
                 self.logger.error("Disk {} already mapped".format(disk))
@@ -399,9 +404,7 @@ class Client(UINode):
 
                 # this was a remove request, so simply delete the child
                 # MappedLun object corresponding to this rbd name
-                mlun = [lun for lun in self.children
-                        if lun.rbd_name == disk][0]
-                self.remove_lun(mlun)
+                self.remove_lun(self.get_mapped_lun(disk))
 
             self.logger.debug("configuration update successful")
             self.logger.info('ok')
@@ -440,14 +443,11 @@ class Client(UINode):
                                    lun.rbd_name,
                                    self.client_iqn)
 
-    @property
-    def logged_in(self):
+    logged_in = property(_get_logged_in_state,
+                         doc="login state of the client across all gateways")
 
-        r = root.RTSRoot()
-        for sess in r.sessions:
-            if sess['parent_nodeacl'].node_wwn == self.client_iqn:
-                return sess['state']
-        return ''
+    mapped_bytes = property(_get_mapped_bytes,
+                            doc="total size of the client's disks")
 
 
 class MappedLun(UINode):
@@ -464,13 +464,16 @@ class MappedLun(UINode):
 
         self.disk = disk_lookup[name]
         self.owner = self.disk.owner
-        self.size = self.disk.size
-        self.size_h = self.disk.size_h
         self.lun_id = lun_id
 
+    # the size comes from the disk, which fetches it on first use
+    size = property(lambda self: self.disk.size,
+                    doc="size of the mapped disk in bytes")
+    size_h = property(lambda self: self.disk.size_h,
+                      doc="human readable size of the mapped disk")
+
     def summary(self):
         self.owner = self.disk.owner
-        self.size_h = self.disk.size_h
         return "{}({}), Owner: {}".format(self.rbd_name,
                                           self.size_h,
                                           self.owner), True
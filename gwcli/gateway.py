@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
 import json
+import logging
+
+from configshell_fb import ConfigNode, ConfigShell
 
 from gwcli.node import UIGroup, UINode, UIRoot
 
@@ -10,14 +13,15 @@ from gwcli.client import Clients, CHAP
 from gwcli.utils import (this_host,
                          GatewayAPIError, GatewayError,
                          APIRequest,
-                         console_message, get_port_state,
-                         valid_iqn)
+                         console_message, probe_ports, get_tunable,
+                         valid_iqn, session_snapshot)
 
 import ceph_iscsi_config.settings as settings
 
 import rtslib_fb.root as root
 
 from gwcli.ceph import CephGroup
+from gwcli.perf import counters, stats_report, MemoryCensus
 
 # FIXME - code is using a self signed cert common across all gateways
 # the embedded urllib3 package will issue warnings when ssl cert validation is
@@ -63,6 +67,10 @@ class ISCSIRoot(UIRoot):
     def refresh(self):
         self.config = self._get_config()
 
+        # a refresh shows the current session state, not the snapshot the
+        # previous render used
+        session_snapshot.invalidate()
+
         if not self.error:
 
             if 'disks' in self.config:
@@ -90,6 +98,9 @@ class ISCSIRoot(UIRoot):
                                  "object : {}".format(self.error_msg))
             raise GatewayError
 
+    def prepare_listing(self):
+        # listing the whole tree shows the size of every disk
+        self.disks.prepare_listing()
 
     def _get_config(self, endpoint=None):
 
@@ -178,6 +189,39 @@ class ISCSIRoot(UIRoot):
         console_message("Local Ceph Cluster : {}".format(settings.config.cluster_name))
         console_message("2ndary API IP's    : {}".format(display_ips))
 
+    def ui_command_stats(self):
+        """
+        Show the calls made by the previous command (or by the initial load
+        of the configuration, when no command has run yet) to the gateway
+        API, rados, the ceph mons, rbd and rtslib, with their count, errors
+        and time. The latency distribution of the ceph calls is shown by
+        operation and pool.
+        """
+
+        console_message(stats_report())
+
+    def ui_command_memstats(self, top=10):
+        """
+        Show the memory used by the nodes of the tree, by node class. Each
+        node is sized with the objects it references, so an object shared by
+        several nodes is only counted against the first one. Each run is
+        compared to the previous one, showing the growth across the
+        refreshes and commands that ran in between.
+
+        Under python3 tracemalloc is started by the first memstats, and the
+        allocation changes by source line are also shown (top sets the number
+        of lines). Without tracemalloc (python2) only the node walk is shown.
+        """
+
+        census = MemoryCensus(self, lambda node: node.children,
+                              skip=(ConfigNode, ConfigShell, logging.Logger,
+                                    MemoryCensus))
+
+        previous = getattr(self, 'memory_census', None)
+        self.memory_census = census
+
+        console_message(census.report(previous, top=int(top)))
+
 
 class ISCSITarget(UIGroup):
     help_intro = '''
@@ -206,8 +250,9 @@ class ISCSITarget(UIGroup):
             return
 
         # We need LIO to be empty, so check there aren't any targets defined
-        local_lio = root.RTSRoot()
-        current_target_names = [tgt.wwn for tgt in local_lio.targets]
+        with counters.timed('rtslib', 'targets'):
+            local_lio = root.RTSRoot()
+            current_target_names = [tgt.wwn for tgt in local_lio.targets]
         if current_target_names:
             self.logger.error("Local LIO instance already has LIO configured "
                               "with a target - unable to continue")
@@ -387,7 +432,26 @@ class GatewayGroup(UIGroup):
         gateway_list = [gw for gw in gateway_group
                         if isinstance(gateway_group[gw], dict)]
         for gateway_name in gateway_list:
-            Gateway(self, gateway_name, gateway_group[gateway_name])
+            Gateway(self, gateway_name, gateway_group[gateway_name],
+                    refresh=False)
+
+        self.refresh_state()
+
+    def refresh_state(self):
+        """
+        check the iSCSI/API ports of all the gateways, probing every port at
+        the same time
+        """
+
+        gateways = list(self.children)
+        self.logger.debug("- checking iSCSI/API ports on {} "
+                          "gateways".format(len(gateways)))
+
+        port_states = probe_ports([endpoint for gw in gateways
+                                   for endpoint in gw.endpoints()],
+                                  get_tunable('port_probe_timeout', 1.0))
+        for gw in gateways:
+            gw.refresh(port_states)
 
     def ui_command_info(self):
 
@@ -404,8 +468,7 @@ class GatewayGroup(UIGroup):
 
         if len(self.children) > 0:
             self.logger.debug("{} gateways to refresh".format(len(self.children)))
-            for gw in self.children:
-                gw.refresh()
+            self.refresh_state()
         else:
             self.logger.error("No gateways to refresh")
 
@@ -527,11 +590,13 @@ class Gateway(UINode):
 
     TCP_PORT = 3260
 
-    def __init__(self, parent, gateway_name, gateway_config):
+    def __init__(self, parent, gateway_name, gateway_config, refresh=True):
         """
         Create the LIO element
         :param parent: parent object the gateway group object
         :param gateway_config: dict holding the fields that define the gateway
+        :param refresh: (bool) check the gateway's ports now. When False the
+               parent checks them, together with the other gateways
         :return:
         """
 
@@ -546,13 +611,31 @@ class Gateway(UINode):
                               "api": {"state": "DOWN",
                                       "port": settings.config.api_port}
                               }
-        self.refresh()
+        if refresh:
+            self.refresh()
 
-    def refresh(self):
+    def endpoints(self):
+        """
+        :return: (list) of the (ip address, port) tuples of the services
+        """
+
+        return [(self.portal_ip_address, self.service_state[svc]["port"])
+                for svc in self.service_state]
+
+    def refresh(self, port_states=None):
+        """
+        update the service state of the gateway
+        :param port_states: (dict) port states from probe_ports, holding this
+               gateway's endpoints. When not given, the ports are probed
+        """
+
+        if port_states is None:
+            self.logger.debug("- checking iSCSI/API ports on "
+                              "{}".format(self.name))
+            port_states = probe_ports(self.endpoints(),
+                                      get_tunable('port_probe_timeout', 1.0))
 
-        self.logger.debug("- checking iSCSI/API ports on "
-                          "{}".format(self.name))
-        self._get_state()
+        self._get_state(port_states)
 
         up_count = len([self.service_state[s]["state"]
                         for s in self.service_state
@@ -565,18 +648,21 @@ class Gateway(UINode):
         else:
             self.state = "PARTIAL"
 
-    def _get_state(self):
+    def _get_state(self, port_states):
         """
-        Determine iSCSI and gateway API service state
+        Determine iSCSI and gateway API service state, and the time taken to
+        connect to each service
         :return:
         """
 
         for svc in self.service_state:
 
-            result = get_port_state(self.portal_ip_address,
-                                    self.service_state[svc]["port"])
+            result, rtt = port_states[(self.portal_ip_address,
+                                       self.service_state[svc]["port"])]
 
             self.service_state[svc]["state"] = "UP" if result == 0 else "DOWN"
+            self.service_state[svc]["rtt_ms"] = (round(rtt * 1000, 2)
+                                                 if rtt is not None else '-')
 
     def summary(self):
 
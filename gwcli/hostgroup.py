@@ -104,9 +104,7 @@ class HostGroups(UIGroup):
             return
 
         self.logger.debug("removing group from the UI")
-        child = [child for child in self.children
-                 if child.name == group_name][0]
-        self.delete(child)
+        self.delete(self.get_child(group_name))
 
         self.logger.info('ok')
 
@@ -205,9 +203,7 @@ class HostGroup(UIGroup):
             clients[client_iqn]['group_name'] = self.name
 
         elif action == 'remove':
-            child = [child for child in self.children
-                     if child.name == client_iqn][0]
-            self.delete(child)
+            self.delete(self.get_child(client_iqn))
 
         self.logger.info('ok')
 
@@ -233,7 +229,7 @@ class HostGroup(UIGroup):
 
         # simple sanity check - does the disk exist?
         ui_root = self.get_ui_root()
-        if disk_name not in [disk.name for disk in ui_root.disks.children]:
+        if disk_name not in ui_root.disks.disk_lookup:
             self.logger.error("Disk '{}' is not defined within the "
                               "configuration".format(disk_name))
             return
@@ -260,9 +256,7 @@ class HostGroup(UIGroup):
         if action == 'add':
             HostGroupMember(self, 'disk', disk_name)
         elif action == 'remove':
-            child = [child for child in self.children
-                     if child.name == disk_name][0]
-            self.delete(child)
+            self.delete(self.get_child(disk_name))
 
         self.update_clients_UI(action, disk_name)
 
@@ -284,22 +278,22 @@ class HostGroup(UIGroup):
         target_subtree = [child for child in ui_root.target.children][0]
         clients_subtree = target_subtree.client_group
 
-        for client in clients_subtree.children:
-            if client.name in grp_clients:
-                if action == 'add':
-                    client_luns = clients[client.name].get('luns')
-                    lun_id = client_luns[disk_name].get('lun_id')
-                    self.logger.debug("adding {} to {}".format(disk_name,
+        for client_iqn in grp_clients:
+            if client_iqn not in clients_subtree.child_lookup:
+                continue
+            client = clients_subtree.get_child(client_iqn)
+            if action == 'add':
+                client_luns = clients[client.name].get('luns')
+                lun_id = client_luns[disk_name].get('lun_id')
+                self.logger.debug("adding {} to {}".format(disk_name,
+                                                           client.name))
+                client.add_lun(disk_name, lun_id)
+
+            else:
+                # remove the disk from the client UI subtree
+                self.logger.debug("removing {} from {}".format(disk_name,
                                                                client.name))
-                    client.add_lun(disk_name, lun_id)
-
-                else:
-                    # remove the disk from the client UI subtree
-                    self.logger.debug("removing {} from {}".format(disk_name,
-                                                                   client.name))
-                    mapped_lun = [lun for lun in client.children
-                                  if lun.rbd_name == disk_name][0]
-                    client.remove_lun(mapped_lun)
+                client.remove_lun(client.get_mapped_lun(disk_name))
 
     def summary(self):
         counts = {'disk': 0, 'host': 0}
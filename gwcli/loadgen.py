@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+"""
+Load generator for the rbd-target-api REST API
+
+Runs a number of concurrent workers against a gateway's API, each issuing a
+weighted mix of operations until the duration (or request count) is reached;
+  config     GET /api/config
+  client     PUT then DELETE /api/client/<iqn>
+  clientlun  PUT then DELETE /api/clientlun/<iqn> (map/unmap a disk)
+  disk       PUT /api/disk/<pool.image> create, then resize
+
+The mix is one of the predefined mixes (read, write, mixed) or a list of
+op=weight pairs e.g. config=80,clientlun=20. Clients and disks needed by the
+run are created up front and removed at the end.
+
+Throughput, latency percentiles and the errors seen for each request type are
+written as JSON, so runs can be compared. Example;
+
+  python -m gwcli.loadgen --url https://gw1:5000 --insecure \\
+                          --mix mixed --concurrency 8 --rate 50 --duration 60
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+from collections import defaultdict
+
+import requests
+
+from gwcli.perf import LatencyStats
+
+__author__ = 'Paul Cuzner'
+
+MIXES = {"read": "config=100",
+         "write": "client=40,clientlun=40,disk=20",
+         "mixed": "config=70,client=10,clientlun=10,disk=10"}
+
+OPERATIONS = ['config', 'client', 'clientlun', 'disk']
+
+
+def parse_mix(mix):
+    """
+    convert a mix name or op=weight list into a list of (op, weight) tuples
+    :param mix: (str) mix name or comma separated op=weight pairs
+    :return: (list) of (op, weight)
+    """
+
+    spec = MIXES.get(mix, mix)
+    weights = []
+    for item in spec.split(','):
+        try:
+            op, weight = item.split('=')
+            weight = int(weight)
+        except ValueError:
+            raise ValueError("invalid mix entry '{}', expected "
+                             "op=weight".format(item))
+        if op not in OPERATIONS:
+            raise ValueError("unknown operation '{}', valid operations are "
+                             "{}".format(op, ','.join(OPERATIONS)))
+        if weight > 0:
+            weights.append((op, weight))
+
+    if not weights:
+        raise ValueError("mix '{}' has no operations".format(mix))
+
+    return weights
+
+
+class Worker(object):
+    """
+    state of a single load generation thread; each worker uses its own
+    client and disk names, so the workers don't interfere with each other
+    """
+
+    def __init__(self, worker_id, prefix, pool, seed):
+        self.id = worker_id
+        self.session = requests.Session()
+        self.random = random.Random(seed)
+        self.prefix = "{}w{}".format(prefix, worker_id)
+        self.pool = pool
+        self.client_iqn = self.iqn('map')
+        self.map_disk = "{}.{}map".format(pool, self.prefix)
+        self.ready = False
+        self.disks = []
+        self.seq = 0
+
+    def iqn(self, suffix):
+        return "iqn.2017-01.com.example:{}-{}".format(self.prefix, suffix)
+
+    def next_name(self):
+        self.seq += 1
+        return "{}n{}".format(self.prefix, self.seq)
+
+
+class LoadGenerator(object):
+
+    def __init__(self, args):
+        self.api_url = args.url.rstrip('/') + '/api'
+        self.auth = (args.user, args.password)
+        self.verify = not args.insecure
+        self.mix = parse_mix(args.mix)
+        self.args = args
+
+        self.lock = threading.Lock()
+        self.stats = defaultdict(LatencyStats)
+        self.errors = defaultdict(lambda: defaultdict(int))
+        self.interval = 1.0 / args.rate if args.rate else 0
+        self.next_slot = 0
+        self.issued = 0
+        self.stop_at = 0
+        self.elapsed = 0
+
+        self.workers = [Worker(n, args.prefix, args.pool, args.seed + n)
+                        for n in range(args.concurrency)]
+
+    def _call(self, worker, method, path, data=None):
+        return getattr(worker.session, method)(
+            "{}/{}".format(self.api_url, path),
+            data=data,
+            auth=self.auth,
+            verify=self.verify,
+            timeout=self.args.timeout)
+
+    def setup_call(self, worker, method, path, data=None):
+        """
+        untimed request used to create/remove the objects the run depends on
+        :return: (bool) True if the request succeeded
+        """
+        try:
+            response = self._call(worker, method, path, data)
+        except requests.RequestException as err:
+            sys.stderr.write("{} {} failed : {}\n".format(method, path, err))
+            return False
+
+        if response.status_code != 200:
+            sys.stderr.write("{} {} failed : {} {}\n".format(method, path,
+                                                             response.status_code,
+                                                             response.text[:200]))
+            return False
+        return True
+
+    def throttle(self):
+        """
+        wait for the next request slot
+        :return: (bool) False when the run is complete
+        """
+
+        with self.lock:
+            now = time.time()
+            if now >= self.stop_at:
+                return False
+            if self.args.requests and self.issued >= self.args.requests:
+                return False
+            self.issued += 1
+
+            slot = now
+            if self.interval:
+                slot = max(now, self.next_slot)
+                self.next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+        return True
+
+    def request(self, worker, label, method, path, data=None):
+        """
+        timed request, recorded against the label
+        :return: (bool) True if the request succeeded, None if the run is over
+        """
+
+        if not self.throttle():
+            return None
+
+        start = time.time()
+        try:
+            response = self._call(worker, method, path, data)
+        except requests.RequestException as err:
+            self.record_error(label, time.time() - start, type(err).__name__)
+            return False
+
+        elapsed = time.time() - start
+        if response.status_code != 200:
+            self.record_error(label, elapsed,
+                              "http {}".format(response.status_code))
+            return False
+
+        self.stats[label].add(elapsed)
+        return True
+
+    def record_error(self, label, elapsed, reason):
+        self.stats[label].add(elapsed, error=True)
+        with self.lock:
+            self.errors[label][reason] += 1
+
+    def op_config(self, worker):
+        self.request(worker, 'config_get', 'get', 'config')
+
+    def op_client(self, worker):
+        path = 'client/{}'.format(worker.iqn(worker.next_name()))
+        if self.request(worker, 'client_create', 'put', path):
+            # always try to remove the client, even if the run has ended
+            if self.request(worker, 'client_delete', 'delete', path) is None:
+                self.setup_call(worker, 'delete', path)
+
+    def op_clientlun(self, worker):
+        path = 'clientlun/{}'.format(worker.client_iqn)
+        data = {"disk": worker.map_disk}
+        if self.request(worker, 'clientlun_map', 'put', path, data):
+            if self.request(worker, 'clientlun_unmap', 'delete', path,
+                            data) is None:
+                self.setup_call(worker, 'delete', path, data)
+
+    def op_disk(self, worker):
+        disk_id = "{}.{}".format(worker.pool, worker.next_name())
+        path = 'disk/{}'.format(disk_id)
+        if self.request(worker, 'disk_create', 'put', path,
+                        {"mode": "create", "size": self.args.disk_size,
+                         "count": "1", "pool": worker.pool}):
+            worker.disks.append(disk_id)
+            self.request(worker, 'disk_resize', 'put', path,
+                         {"mode": "resize", "size": self.args.resize_size,
+                          "pool": worker.pool})
+
+    def setup(self):
+        if 'clientlun' not in dict(self.mix):
+            return
+
+        for worker in self.workers:
+            worker.ready = (
+                self.setup_call(worker, 'put',
+                                'disk/{}'.format(worker.map_disk),
+                                {"mode": "create",
+                                 "size": self.args.disk_size,
+                                 "count": "1", "pool": worker.pool}) and
+                self.setup_call(worker, 'put',
+                                'client/{}'.format(worker.client_iqn)))
+
+    def cleanup(self):
+        if self.args.no_cleanup:
+            return
+
+        for worker in self.workers:
+            if 'clientlun' in dict(self.mix):
+                self.setup_call(worker, 'delete',
+                                'client/{}'.format(worker.client_iqn))
+                self.setup_call(worker, 'delete',
+                                'disk/{}'.format(worker.map_disk))
+            for disk_id in worker.disks:
+                self.setup_call(worker, 'delete', 'disk/{}'.format(disk_id))
+
+    def run_worker(self, worker):
+        ops = [op for op, weight in self.mix for _ in range(weight)
+               if op != 'clientlun' or worker.ready]
+        if not ops:
+            return
+
+        while time.time() < self.stop_at:
+            if self.args.requests and self.issued >= self.args.requests:
+                break
+            getattr(self, 'op_{}'.format(worker.random.choice(ops)))(worker)
+
+    def run(self):
+        self.setup()
+
+        start = time.time()
+        self.stop_at = start + self.args.duration
+        self.next_slot = start
+
+        threads = [threading.Thread(target=self.run_worker, args=(worker,))
+                   for worker in self.workers]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.elapsed = time.time() - start
+
+        self.cleanup()
+
+    def report(self):
+        elapsed = self.elapsed or 1
+        overall = LatencyStats()
+        operations = {}
+
+        for label, stats in sorted(self.stats.items()):
+            summary = stats.summary()
+            summary['throughput_rps'] = round(summary['count'] / elapsed, 2)
+            operations[label] = summary
+            for sample in stats.samples:
+                overall.add(sample)
+            overall.errors += stats.errors
+
+        summary = overall.summary()
+        summary['throughput_rps'] = round(summary['count'] / elapsed, 2)
+
+        return {"settings": {"url": self.args.url,
+                             "mix": dict(self.mix),
+                             "concurrency": self.args.concurrency,
+                             "rate": self.args.rate,
+                             "duration": self.args.duration,
+                             "requests": self.args.requests},
+                "elapsed_s": round(self.elapsed, 3),
+                "overall": summary,
+                "operations": operations,
+                "errors": dict((label, dict(reasons))
+                               for label, reasons in self.errors.items())}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a concurrent request load against the "
+                    "rbd-target-api")
+    parser.add_argument('--url', default='http://127.0.0.1:5000',
+                        help="API base url (default http://127.0.0.1:5000)")
+    parser.add_argument('--user', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--insecure', action='store_true',
+                        help="don't verify the API's ssl certificate")
+    parser.add_argument('--mix', default='mixed',
+                        help="read, write, mixed or a list of op=weight "
+                             "pairs ({})".format(','.join(OPERATIONS)))
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="number of concurrent workers")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="maximum requests/s across all workers "
+                             "(0 is unlimited)")
+    parser.add_argument('--duration', type=float, default=30,
+                        help="length of the run in seconds")
+    parser.add_argument('--requests', type=int, default=0,
+                        help="stop after this many requests (0 is no limit)")
+    parser.add_argument('--timeout', type=float, default=60,
+                        help="per request timeout in seconds")
+    parser.add_argument('--pool', default='rbd',
+                        help="pool for the disks created by the run")
+    parser.add_argument('--disk-size', default='1G')
+    parser.add_argument('--resize-size', default='2G')
+    parser.add_argument('--prefix', default='loadgen',
+                        help="name prefix for the clients and disks created")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="random seed, for a repeatable sequence of ops")
+    parser.add_argument('--no-cleanup', action='store_true',
+                        help="leave the disks/clients created in place")
+    parser.add_argument('--output', help="write the JSON report to a file")
+    args = parser.parse_args()
+
+    if '.' in args.prefix:
+        parser.error("--prefix must not contain a '.'")
+
+    try:
+        generator = LoadGenerator(args)
+    except ValueError as err:
+        parser.error(str(err))
+
+    generator.run()
+    report = json.dumps(generator.report(), indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report + '\n')
+    else:
+        sys.stdout.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
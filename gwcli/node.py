@@ -2,6 +2,7 @@
 
 from configshell_fb import ConfigNode
 from gwcli.utils import console_message
+from gwcli.perf import reset_stats
 import logging
 
 __author__ = 'Paul Cuzner'
@@ -10,9 +11,77 @@ __author__ = 'Paul Cuzner'
 class UICommon(ConfigNode):
 
     def __init__(self, name, parent=None, shell=None):
-        ConfigNode.__init__(self, name, parent, shell)
+        # children indexed by name, so get_child doesn't scan the children
+        self.child_lookup = {}
+
+        if parent is None:
+            ConfigNode.__init__(self, name, parent, shell)
+        else:
+            # ConfigNode checks the name against every sibling, making the
+            # build of a group O(n^2) - the lookup does the same check, so
+            # ConfigNode is handed an empty sibling set
+            if name in parent.child_lookup:
+                raise ValueError("Name '{}' already used by a "
+                                 "sibling.".format(name))
+            siblings = parent._children
+            parent._children = set()
+            try:
+                ConfigNode.__init__(self, name, parent, shell)
+            finally:
+                parent._children = siblings
+            siblings.add(self)
+            parent.child_lookup[name] = self
+
         self.logger = logging.getLogger('gwcli')
 
+    def get_child(self, name):
+        if name in self.child_lookup:
+            return self.child_lookup[name]
+        return ConfigNode.get_child(self, name)
+
+    def remove_child(self, child):
+        ConfigNode.remove_child(self, child)
+        self.child_lookup.pop(child.name, None)
+
+    def _set_name(self, name):
+        # keep the parent's lookup keyed by the current name
+        parent = self.parent
+        if parent is not None and parent.child_lookup.get(self.name) is self:
+            del parent.child_lookup[self.name]
+            parent.child_lookup[name] = self
+        ConfigNode._set_name(self, name)
+
+    name = property(ConfigNode._get_name, _set_name,
+                    doc="Gets or sets the node's name.")
+
+    def ui_command_ls(self, path=None, depth=None):
+        try:
+            target = self.get_node(path)
+        except ValueError:
+            # reported by the listing
+            target = None
+
+        if isinstance(target, UICommon):
+            target.prepare_listing()
+
+        return ConfigNode.ui_command_ls(self, path, depth)
+
+    ui_command_ls.__doc__ = ConfigNode.ui_command_ls.__doc__
+
+    def prepare_listing(self):
+        """
+        fetch whatever the listing of this node shows that isn't loaded yet,
+        before the tree is rendered
+        """
+        pass
+
+    def execute_command(self, command, pparams=[], kparams={}):
+        # the perf counters cover a single command, so stats can report on
+        # the command that ran before it
+        if command != 'stats':
+            reset_stats()
+        return ConfigNode.execute_command(self, command, pparams, kparams)
+
     def ui_command_goto(self, shortcut='/'):
         if shortcut in self.shell.prefs['bookmarks']:
             return self.ui_command_cd(self.shell.prefs['bookmarks'][shortcut])
@@ -0,0 +1,663 @@
+#!/usr/bin/env python
+
+import bisect
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+import types
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    # python2
+    tracemalloc = None
+
+__author__ = 'Paul Cuzner'
+
+
+def percentile(samples, pct):
+    """
+    return the nearest-rank percentile of a list of samples
+    :param samples: (list) of numbers
+    :param pct: (int/float) percentile required (0-100)
+    :return: (float) percentile value, or 0 for an empty list
+    """
+
+    if not samples:
+        return 0.0
+
+    ordered = sorted(samples)
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+class LatencyStats(object):
+    """
+    Collect latency samples (in seconds) for an operation, together with the
+    number of failed calls
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+        self.errors = 0
+
+    def add(self, elapsed, error=False):
+        with self.lock:
+            self.samples.append(elapsed)
+            if error:
+                self.errors += 1
+
+    def summary(self):
+        """
+        :return: (dict) count, errors and latency distribution in ms
+        """
+
+        with self.lock:
+            samples = list(self.samples)
+            errors = self.errors
+
+        if not samples:
+            return {"count": 0, "errors": errors}
+
+        return {"count": len(samples),
+                "errors": errors,
+                "min_ms": round(min(samples) * 1000, 3),
+                "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+                "p50_ms": round(percentile(samples, 50) * 1000, 3),
+                "p95_ms": round(percentile(samples, 95) * 1000, 3),
+                "p99_ms": round(percentile(samples, 99) * 1000, 3),
+                "max_ms": round(max(samples) * 1000, 3)}
+
+
+class PhaseProfiler(object):
+    """
+    Run a sequence of steps (e.g. startup, refresh, command) under cProfile,
+    so the time can be broken down by step, and within each step by phase.
+    A phase is a group of entry point functions, and its time is the
+    cumulative time of those functions. Phase entry points must not call
+    each other, or their time is counted twice
+    """
+
+    def __init__(self, phases):
+        """
+        :param phases: (list) of (phase name, [functions]) tuples
+        """
+
+        self.phases = []
+        for phase_name, functions in phases:
+            keys = set()
+            for func in functions:
+                code = getattr(func, '__func__', func).__code__
+                keys.add((code.co_filename, code.co_firstlineno,
+                          code.co_name))
+            self.phases.append((phase_name, keys))
+
+        self.steps = []         # list of (step name, cProfile.Profile)
+
+    def run(self, step_name, func, *args, **kwargs):
+        profiler = cProfile.Profile()
+        self.steps.append((step_name, profiler))
+        profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+
+    def _stats(self, profilers, stream=None):
+        stats = pstats.Stats(profilers[0], stream=stream)
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        return stats
+
+    def breakdown(self):
+        """
+        :return: (list) of (step name, total secs, [(phase name, secs)])
+        """
+
+        result = []
+        for step_name, profiler in self.steps:
+            stats = self._stats([profiler])
+            phase_times = []
+            for phase_name, keys in self.phases:
+                # stats entries are (calls, prim calls, tottime, cumtime,
+                # callers)
+                elapsed = sum(stats.stats[key][3] for key in keys
+                              if key in stats.stats)
+                if elapsed:
+                    phase_times.append((phase_name, elapsed))
+            result.append((step_name, stats.total_tt, phase_times))
+
+        return result
+
+    def save(self, path):
+        if self.steps:
+            self._stats([profiler for _, profiler in self.steps]).dump_stats(path)
+
+    def report(self, stream, top=20, remainder=None):
+        """
+        write the time by step/phase and the top functions by cumulative time
+        :param stream: file like object to write to
+        :param top: (int) number of functions to show
+        :param remainder: (dict) step name -> label for time not in a phase
+                          (default 'other')
+        """
+
+        if not self.steps:
+            return
+
+        remainder = remainder or {}
+
+        stream.write("Time by phase\n")
+        for step_name, total, phase_times in self.breakdown():
+            other = max(total - sum(t for _, t in phase_times), 0)
+            phase_times = phase_times + [(remainder.get(step_name, 'other'),
+                                          other)]
+            stream.write("  {:<10} {:>8.3f}s : {}\n".format(
+                step_name, total,
+                ", ".join("{} {:.3f}s".format(name, elapsed)
+                          for name, elapsed in phase_times)))
+
+        stream.write("\nTop {} functions by cumulative time\n".format(top))
+        stats = self._stats([profiler for _, profiler in self.steps],
+                            stream=stream)
+        stats.sort_stats('cumulative').print_stats(top)
+
+
+class PerfCounters(object):
+    """
+    Count the calls gwcli makes to external services, and their cumulative
+    time and errors, by category (api, rados, mon, rbd, rtslib) and operation
+    """
+
+    categories = ['api', 'rados', 'mon', 'rbd', 'rtslib']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}      # (category, op) -> [calls, errors, secs]
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+
+    def record(self, category, op, elapsed, error=False):
+        with self.lock:
+            counter = self.counters.setdefault((category, op), [0, 0, 0.0])
+            counter[0] += 1
+            counter[1] += 1 if error else 0
+            counter[2] += elapsed
+
+    @contextmanager
+    def timed(self, category, op):
+        """
+        record the time taken by the block, as an error if it raises
+        """
+
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.record(category, op, time.time() - start, error=True)
+            raise
+        self.record(category, op, time.time() - start)
+
+    def summary(self):
+        """
+        :return: (dict) category -> dict of calls, errors, secs and
+                 operations (op -> dict of calls, errors, secs)
+        """
+
+        with self.lock:
+            counters = dict((key, list(value))
+                            for key, value in self.counters.items())
+
+        summary = {}
+        for (category, op), (calls, errors, elapsed) in counters.items():
+            totals = summary.setdefault(category, {"calls": 0, "errors": 0,
+                                                   "secs": 0.0,
+                                                   "operations": {}})
+            totals['calls'] += calls
+            totals['errors'] += errors
+            totals['secs'] += elapsed
+            totals['operations'][op] = {"calls": calls,
+                                        "errors": errors,
+                                        "secs": elapsed}
+        return summary
+
+    def report(self):
+        """
+        :return: (str) table of the calls by category and operation
+        """
+
+        summary = self.summary()
+        if not summary:
+            return "No calls recorded"
+
+        order = [c for c in PerfCounters.categories if c in summary] + \
+                sorted(c for c in summary if c not in PerfCounters.categories)
+
+        op_width = max([len(op) + 2 for category in summary
+                        for op in summary[category]['operations']] + [8])
+        line_fmt = "{:<{}} {:>7} {:>7} {:>10} {:>10}\n"
+
+        text = line_fmt.format("Category", op_width, "Calls", "Errors",
+                               "Time (s)", "Avg (ms)")
+        for category in order:
+            operations = summary[category]['operations']
+            rows = [(category, summary[category])] + \
+                   [("  " + op, operations[op]) for op in sorted(operations)]
+            for name, counts in rows:
+                text += line_fmt.format(name, op_width, counts['calls'],
+                                        counts['errors'],
+                                        "{:.3f}".format(counts['secs']),
+                                        "{:.2f}".format(counts['secs'] * 1000 /
+                                                        counts['calls']))
+        return text.rstrip('\n')
+
+
+# calls made by this process, shared by the instrumented call sites
+counters = PerfCounters()
+
+
+class LatencyHistogram(object):
+    """
+    Latency distribution in fixed buckets, so it can be kept for the life of
+    a process (unlike LatencyStats, which holds every sample)
+    """
+
+    # bucket upper bounds in ms, with a final bucket for anything slower
+    bounds_ms = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+                 30000]
+
+    def __init__(self):
+        self.buckets = [0] * (len(LatencyHistogram.bounds_ms) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed, error=False):
+        elapsed_ms = elapsed * 1000
+        self.buckets[bisect.bisect_left(LatencyHistogram.bounds_ms,
+                                        elapsed_ms)] += 1
+        self.count += 1
+        self.errors += 1 if error else 0
+        self.total += elapsed_ms
+        self.max = max(self.max, elapsed_ms)
+
+    def percentile(self, pct):
+        """
+        :return: (float) upper bound (ms) of the bucket holding the
+                 percentile, or the max for the last bucket
+        """
+
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(LatencyHistogram.bounds_ms, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        """
+        :return: (dict) counts, latencies in ms and the non-empty buckets as
+                 [upper bound ms (None for the last bucket), count] pairs
+        """
+
+        bounds = LatencyHistogram.bounds_ms + [None]
+        return {"count": self.count,
+                "errors": self.errors,
+                "mean_ms": round(self.total / self.count, 3)
+                if self.count else 0.0,
+                "p50_ms": round(self.percentile(50), 3),
+                "p95_ms": round(self.percentile(95), 3),
+                "p99_ms": round(self.percentile(99), 3),
+                "max_ms": round(self.max, 3),
+                "buckets": [[bound, count]
+                            for bound, count in zip(bounds, self.buckets)
+                            if count]}
+
+
+class BackendStats(object):
+    """
+    Latency histograms and errors of the calls to the ceph cluster (rados,
+    mon commands and rbd), by operation and pool. Operations are named
+    <category>.<call> e.g. rbd.open, and each call is also counted in the
+    perf counters
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}        # (op, pool) -> LatencyHistogram
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def record(self, op, pool, elapsed, error=False):
+        with self.lock:
+            histogram = self.histograms.get((op, pool))
+            if histogram is None:
+                histogram = self.histograms[(op, pool)] = LatencyHistogram()
+            histogram.add(elapsed, error)
+
+        category, _, call = op.partition('.')
+        counters.record(category, call, elapsed, error)
+
+    @contextmanager
+    def timed(self, op, pool=None):
+        """
+        record the time taken by the block, as an error if it raises
+        """
+
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.record(op, pool, time.time() - start, error=True)
+            raise
+        self.record(op, pool, time.time() - start)
+
+    def summary(self):
+        """
+        :return: (dict) op -> pool ('-' when not pool specific) -> histogram
+                 summary
+        """
+
+        with self.lock:
+            summary = {}
+            for (op, pool), histogram in self.histograms.items():
+                summary.setdefault(op, {})[pool or '-'] = histogram.summary()
+        return summary
+
+    def report(self):
+        """
+        :return: (str) table of the latency by operation and pool
+        """
+
+        summary = self.summary()
+        if not summary:
+            return "No backend calls recorded"
+
+        line_fmt = "{:<18} {:<12} {:>6} {:>6} {:>9} {:>9} {:>9} {:>9}\n"
+        text = line_fmt.format("Operation", "Pool", "Calls", "Errors",
+                               "p50 ms", "p95 ms", "p99 ms", "Max ms")
+        for op in sorted(summary):
+            for pool in sorted(summary[op]):
+                stats = summary[op][pool]
+                text += line_fmt.format(op, pool, stats['count'],
+                                        stats['errors'], stats['p50_ms'],
+                                        stats['p95_ms'], stats['p99_ms'],
+                                        stats['max_ms'])
+        return text.rstrip('\n')
+
+
+# ceph calls made by this process
+backend = BackendStats()
+
+
+def reset_stats():
+    counters.reset()
+    backend.reset()
+
+
+def stats_report():
+    """
+    :return: (str) the perf counters, and the backend latencies when there
+             were backend calls
+    """
+
+    text = counters.report()
+    if backend.histograms:
+        text += "\n\nBackend latency\n{}".format(backend.report())
+    return text
+
+
+class PhaseTimer(object):
+    """
+    Accumulate the elapsed time of an operation by phase. Phases nest, and
+    the time of a phase excludes the time of the phases entered from it, so
+    the phase times and the time outside any phase add up to the total. A
+    timer tracks a single flow of control, so phases must not be entered
+    from concurrent threads
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = defaultdict(float)
+        self.active = []        # stack of [phase name, time entered/resumed]
+
+    def enter(self, phase):
+        now = time.time()
+        if self.active:
+            parent = self.active[-1]
+            self.phases[parent[0]] += now - parent[1]
+        self.active.append([phase, now])
+
+    def leave(self):
+        now = time.time()
+        phase, resumed = self.active.pop()
+        self.phases[phase] += now - resumed
+        if self.active:
+            self.active[-1][1] = now
+
+    def elapsed(self):
+        return time.time() - self.started
+
+
+def thread_stacks():
+    """
+    Capture the current stack of every thread in the process
+    :return: (dict) thread ident -> list of (file, line, function, source)
+             tuples, outermost call first
+    """
+
+    return dict((ident, traceback.extract_stack(frame))
+                for ident, frame in sys._current_frames().items())
+
+
+class StackSampler(object):
+    """
+    Sampling profiler based on sys._current_frames(). The stacks of all the
+    other threads are sampled at a fixed interval from the calling thread,
+    and aggregated as folded stacks (frames joined by ';' with a sample
+    count), the input format of flamegraph.pl and speedscope. Nothing runs
+    between calls to sample, so an idle sampler costs nothing
+    """
+
+    max_depth = 128
+
+    def __init__(self, interval=0.01):
+        """
+        :param interval: (float) seconds between samples
+        """
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self.samples = 0
+
+    @staticmethod
+    def frame_name(frame):
+        code = frame.f_code
+        return "{}:{}".format(os.path.basename(code.co_filename),
+                              code.co_name)
+
+    def fold(self, frame):
+        names = []
+        while frame is not None and len(names) < StackSampler.max_depth:
+            names.append(StackSampler.frame_name(frame))
+            frame = frame.f_back
+        names.reverse()
+        return ';'.join(names)
+
+    def sample(self, seconds):
+        """
+        Sample the other threads' stacks for the given time
+        :param seconds: (float) duration of the sampling run
+        :return: (dict) folded stack -> sample count
+        """
+
+        own_thread = threading.current_thread().ident
+        stop_at = time.time() + seconds
+        next_sample = time.time()
+
+        while True:
+            for ident, frame in sys._current_frames().items():
+                if ident != own_thread:
+                    self.stacks[self.fold(frame)] += 1
+            self.samples += 1
+            del frame
+
+            next_sample += self.interval
+            now = time.time()
+            if now >= stop_at:
+                break
+            if next_sample > now:
+                time.sleep(min(next_sample, stop_at) - now)
+
+        return dict(self.stacks)
+
+    def folded(self):
+        """
+        :return: (str) folded stacks, one 'frame;frame;... count' per line
+        """
+        return ''.join("{} {}\n".format(stack, count)
+                       for stack, count in sorted(self.stacks.items()))
+
+
+def deep_size(obj, seen, skip=()):
+    """
+    Estimate the memory used by an object and everything it references,
+    using sys.getsizeof. Objects already in seen aren't counted again, so a
+    shared object is counted against the first object that references it
+    :param obj: object to size
+    :param seen: (set) ids of the objects already counted (updated)
+    :param skip: (tuple) types not to follow (e.g. other tree nodes)
+    :return: (int) bytes
+    """
+
+    skip = skip + (type, types.ModuleType, types.FunctionType,
+                   types.MethodType, types.BuiltinFunctionType)
+    size = 0
+    pending = [obj]
+    while pending:
+        item = pending.pop()
+        if id(item) in seen or (item is not obj and isinstance(item, skip)):
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+
+        if isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            pending.extend(item)
+
+        if hasattr(item, '__dict__'):
+            pending.append(item.__dict__)
+
+    return size
+
+
+class MemoryCensus(object):
+    """
+    Memory used by a tree of nodes, by node class. Each node is sized with
+    the objects it references (but not the other nodes), and a census can be
+    compared to an earlier one to show growth. When tracemalloc is tracing
+    (python3, started by the first census or PYTHONTRACEMALLOC) the census
+    also holds a snapshot of the allocations by source line
+    """
+
+    def __init__(self, root, children, skip=()):
+        """
+        :param root: root node of the tree
+        :param children: callable returning a node's children
+        :param skip: (tuple) types shared by the nodes that aren't counted
+                     (the nodes' own type must be included)
+        """
+
+        self.timestamp = time.time()
+        self.classes = defaultdict(lambda: [0, 0])  # name -> [nodes, bytes]
+
+        seen = set()
+        pending = [root]
+        while pending:
+            node = pending.pop()
+            counts = self.classes[node.__class__.__name__]
+            counts[0] += 1
+            counts[1] += deep_size(node, seen, skip)
+            pending.extend(children(node))
+
+        self.snapshot = None
+        if tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            # leave out the census' own allocations
+            self.snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, __file__),
+                 tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def total(self):
+        return sum(counts[1] for counts in self.classes.values())
+
+    def report(self, previous=None, top=10):
+        """
+        :param previous: (MemoryCensus) earlier census to compare against
+        :param top: (int) number of allocation sites to show
+        :return: (str) table of nodes and bytes by class
+        """
+
+        text = ''
+        if tracemalloc is None:
+            text += ("tracemalloc is not available, so this is not an "
+                     "allocation census - the sizes come from a deep_size "
+                     "walk of the tree's nodes, by node class\n\n")
+
+        line_fmt = "{:<20} {:>8} {:>8} {:>12} {:>12} {:>10}\n"
+        text += line_fmt.format("Class", "Nodes", "+/-", "Bytes", "+/-",
+                                "Avg")
+
+        names = set(self.classes)
+        if previous is not None:
+            names.update(previous.classes)
+
+        def class_size(name):
+            return self.classes.get(name, [0, 0])[1]
+
+        for name in sorted(names, key=class_size, reverse=True):
+            nodes, size = self.classes.get(name, [0, 0])
+            if previous is not None:
+                old_nodes, old_size = previous.classes.get(name, [0, 0])
+                node_diff = "{:+d}".format(nodes - old_nodes)
+                size_diff = "{:+d}".format(size - old_size)
+            else:
+                node_diff = size_diff = ''
+            text += line_fmt.format(name, nodes, node_diff, size, size_diff,
+                                    size // nodes if nodes else 0)
+
+        total_nodes = sum(counts[0] for counts in self.classes.values())
+        node_diff = size_diff = ''
+        if previous is not None:
+            node_diff = "{:+d}".format(total_nodes - sum(
+                counts[0] for counts in previous.classes.values()))
+            size_diff = "{:+d}".format(self.total() - previous.total())
+        text += line_fmt.format("Total", total_nodes, node_diff, self.total(),
+                                size_diff, '')
+
+        if self.snapshot is not None:
+            if previous is not None and previous.snapshot is not None:
+                text += "\nAllocation changes by line (top {})\n".format(top)
+                stats = self.snapshot.compare_to(previous.snapshot, 'lineno')
+            else:
+                text += "\nAllocations by line (top {})\n".format(top)
+                stats = self.snapshot.statistics('lineno')
+            text += "".join("{}\n".format(stat) for stat in stats[:top])
+
+        return text.rstrip('\n')
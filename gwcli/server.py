@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+"""
+Resident gwcli server, and the thin client used to talk to it
+
+'gwcli --server' loads the configuration tree once and keeps it warm,
+listening on a unix socket (only accessible to root) for one-shot commands.
+Each command runs in a forked copy of the server, so it starts from the loaded
+tree and can't disturb it, with its output streamed back over the socket.
+Commands run one at a time - further clients wait in the socket's backlog -
+so each command starts from a tree that shows the changes made by the one
+before it. The tree is refreshed when the config epoch changes (after a
+command, or when the API's /api/config/events stream reports a change) and
+every server_refresh_interval seconds, to pick up ceph and gateway state.
+
+The client side only uses the standard library, so 'gwcli <command>' can hand
+the command over before the shell's imports.
+"""
+
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+
+__author__ = 'Paul Cuzner'
+
+SOCKET_PATH = os.environ.get('GWCLI_SOCKET', '/var/run/gwcli.sock')
+
+# the command output is followed by a NUL and the command's exit code
+END_OF_OUTPUT = b'\0'
+
+
+def forward_command(command, socket_path=SOCKET_PATH):
+    """
+    Run a one-shot command on the gwcli server, if one is running
+    :param command: (str) the command, as parsed from gwcli's arguments
+    :param socket_path: (str) server socket
+    :return: (int) exit code of the command, or None if the command wasn't
+             forwarded (no server running)
+    """
+
+    if not os.path.exists(socket_path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        # not running, or not accessible to this user
+        sock.close()
+        return None
+
+    output = getattr(sys.stdout, 'buffer', sys.stdout)
+    trailer = None
+    try:
+        request = json.dumps({"command": command}) + '\n'
+        sock.sendall(request.encode('utf-8'))
+
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            if trailer is not None:
+                trailer += data
+                continue
+            if END_OF_OUTPUT in data:
+                data, trailer = data.split(END_OF_OUTPUT, 1)
+            output.write(data)
+            output.flush()
+    finally:
+        sock.close()
+
+    try:
+        return int(trailer)
+    except (TypeError, ValueError):
+        # the server went away before the command completed
+        return -1
+
+
+def peer_uid(conn):
+    """
+    :return: (int) uid of the process connected to the unix socket
+    """
+
+    so_peercred = getattr(socket, 'SO_PEERCRED', 17)
+    creds = conn.getsockopt(socket.SOL_SOCKET, so_peercred,
+                            struct.calcsize('3i'))
+    _pid, uid, _gid = struct.unpack('3i', creds)
+    return uid
+
+
+class EpochWatcher(object):
+    """
+    Follow the API's config events stream, waking the server whenever the
+    config changes (or the stream reconnects, since changes may have been
+    missed while it was down)
+
+    The watcher runs in a process of its own rather than a thread, so the
+    server has no other threads when it forks a command - a fork copies any
+    lock a thread is holding (logging, the requests connection pool) in its
+    held state, and the command could deadlock on it
+    """
+
+    retry_delay = 5
+
+    def __init__(self, wakeup):
+        """
+        :param wakeup: (int) fd written to when the tree should be refreshed
+        """
+        self.wakeup = wakeup
+        self.last_event_id = None
+        self.server_pid = None
+        self.pid = None
+
+    def start(self, close_fds=()):
+        """
+        fork the watcher process
+        :param close_fds: (list) server fds the watcher shouldn't hold open
+        """
+
+        self.server_pid = os.getpid()
+        self.pid = os.fork()
+        if self.pid:
+            return
+
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            for fd in close_fds:
+                os.close(fd)
+            self.run()
+        finally:
+            os._exit(0)
+
+    def stop(self):
+        if self.pid:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+                os.waitpid(self.pid, 0)
+            except OSError:
+                pass
+            self.pid = None
+
+    def server_running(self):
+        return os.getppid() == self.server_pid
+
+    def run(self):
+        while self.server_running():
+            try:
+                self.follow()
+            except Exception:
+                pass
+
+            # the API is unavailable, the periodic refresh keeps the tree
+            # going until the stream is back
+            time.sleep(self.retry_delay)
+
+    def follow(self):
+        import requests
+        import ceph_iscsi_config.settings as settings
+
+        http_mode = "https" if settings.config.api_secure else "http"
+        events_api = ("{}://127.0.0.1:{}/api/config/"
+                      "events".format(http_mode, settings.config.api_port))
+        headers = {}
+        if self.last_event_id is not None:
+            headers['Last-Event-ID'] = self.last_event_id
+
+        response = requests.get(events_api, stream=True, headers=headers,
+                                auth=(settings.config.api_user,
+                                      settings.config.api_password),
+                                verify=settings.config.api_ssl_verify,
+                                timeout=(5, 120))
+        if response.status_code != 200:
+            return
+
+        if self.last_event_id is not None:
+            # reconnected, and changes may have been missed
+            self.notify()
+
+        for line in response.iter_lines():
+            # keepalives arrive every few seconds, so a watcher left behind
+            # by a server that was killed doesn't linger
+            if not self.server_running():
+                return
+            if not line:
+                continue
+            if not isinstance(line, str):
+                line = line.decode('utf-8')
+
+            if line.startswith('id:'):
+                self.last_event_id = line[3:].strip()
+            elif line.startswith('event:') and \
+                    line[6:].strip() in ['change', 'resync']:
+                self.notify()
+
+    def notify(self):
+        os.write(self.wakeup, b'r')
+
+
+class CLIServer(object):
+
+    def __init__(self, socket_path, run_command, refresh, config_changed,
+                 refresh_interval):
+        """
+        :param socket_path: (str) unix socket to listen on
+        :param run_command: callable running a command string against the
+               tree, returning the exit code. It's called in the forked
+               child, with stdout and stderr on the client's connection
+        :param refresh: callable that reloads the tree
+        :param config_changed: callable returning whether the config epoch
+               has moved on from the one the tree was loaded from
+        :param refresh_interval: (int) seconds between periodic refreshes
+        """
+        self.socket_path = socket_path
+        self.run_command = run_command
+        self.refresh = refresh
+        self.config_changed = config_changed
+        self.refresh_interval = refresh_interval
+        self.last_refresh = time.time()
+        self.sock = None
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+    def listen(self):
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except socket.error:
+                # left behind by a server that's no longer running
+                os.unlink(self.socket_path)
+            else:
+                raise RuntimeError("a gwcli server is already listening on "
+                                   "{}".format(self.socket_path))
+            finally:
+                probe.close()
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        # create the socket without access for anyone but the owner (root)
+        old_umask = os.umask(0o177)
+        try:
+            self.sock.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.socket_path, 0o600)
+
+        self.sock.listen(16)
+
+    def serve_forever(self):
+        self.listen()
+        watcher = EpochWatcher(self.wakeup_w)
+        watcher.start(close_fds=[self.sock.fileno(), self.wakeup_r])
+
+        try:
+            while True:
+                timeout = max(0, self.last_refresh + self.refresh_interval -
+                              time.time())
+                try:
+                    readable, _, _ = select.select([self.sock,
+                                                    self.wakeup_r], [], [],
+                                                   timeout)
+                except select.error as err:
+                    if err.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                if not readable:
+                    self.refresh_tree()
+                elif self.wakeup_r in readable:
+                    self.refresh_if_changed()
+
+                if self.sock in readable:
+                    conn, _ = self.sock.accept()
+                    try:
+                        self.handle(conn)
+                    except socket.error:
+                        # the client went away
+                        pass
+                    finally:
+                        conn.close()
+
+                    # the next command must see any change this one made
+                    self.refresh_if_changed()
+        finally:
+            watcher.stop()
+            self.sock.close()
+            os.unlink(self.socket_path)
+
+    def refresh_if_changed(self):
+        try:
+            changed = self.config_changed()
+        except Exception:
+            # let the refresh report the problem
+            changed = True
+
+        if changed:
+            self.refresh_tree()
+        else:
+            # the change was already picked up
+            self.drain_wakeups()
+
+    def drain_wakeups(self):
+        while select.select([self.wakeup_r], [], [], 0)[0]:
+            os.read(self.wakeup_r, 4096)
+
+    def refresh_tree(self):
+        # collapse any queued wakeups into this refresh
+        self.drain_wakeups()
+
+        self.last_refresh = time.time()
+        try:
+            self.refresh()
+        except Exception as err:
+            sys.stderr.write("gwcli server refresh failed : "
+                             "{}\n".format(err))
+
+    def read_request(self, conn):
+        conn.settimeout(5)
+        request = b''
+        while not request.endswith(b'\n'):
+            data = conn.recv(4096)
+            if not data:
+                return None
+            request += data
+        conn.settimeout(None)
+
+        try:
+            return json.loads(request.decode('utf-8'))['command']
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def handle(self, conn):
+        if peer_uid(conn) != 0:
+            conn.sendall(b"gwcli server only accepts requests from root\n" +
+                         END_OF_OUTPUT + b'-1')
+            return
+
+        command = self.read_request(conn)
+        if command is None:
+            conn.sendall(b"invalid request\n" + END_OF_OUTPUT + b'-1')
+            return
+
+        # pick up a config change that arrived while the server was idle
+        if select.select([self.wakeup_r], [], [], 0)[0]:
+            self.refresh_if_changed()
+
+        # don't let the child inherit (and repeat) any buffered output
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            rc = -1
+            try:
+                self.sock.close()
+                os.dup2(conn.fileno(), 1)
+                os.dup2(conn.fileno(), 2)
+                rc = self.run_command(command)
+            except Exception as err:
+                sys.stderr.write("{}\n".format(err))
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(rc & 0xff)
+
+        _, status = os.waitpid(pid, 0)
+        rc = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 255
+        if rc > 127:
+            rc -= 256
+        conn.sendall(END_OF_OUTPUT + str(rc).encode('utf-8'))
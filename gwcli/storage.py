@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
 import os
+import json
+import logging
+import time
 
-import rados
 import rbd
 
 from gwcli.node import UIGroup, UINode
@@ -11,7 +13,9 @@ from gwcli.client import Clients
 
 from gwcli.utils import (human_size, readcontents, console_message,
                          GatewayAPIError, GatewayError,
-                         this_host, APIRequest)
+                         this_host, APIRequest, rados_cluster, rbd_image,
+                         rbd_metadata, get_tunable)
+from gwcli.perf import backend
 
 from ceph_iscsi_config.utils import valid_size, convert_2_bytes
 
@@ -25,6 +29,105 @@ __author__ = 'Paul Cuzner'
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
+class DiskMetaCache(object):
+    """
+    rbd size/features of the disks, kept in a file in the gwcli preferences
+    directory so successive gwcli runs don't have to open every rbd image
+    again. An entry is used while it's younger than the ttl and the disk's
+    wwn is unchanged (a disk deleted and created again under the same name
+    gets a new wwn)
+    """
+
+    version = 1
+
+    def __init__(self, path, ttl):
+        """
+        :param path: (str) cache file, or None to disable the cache
+        :param ttl: (int) seconds an entry remains valid, 0 disables the cache
+        """
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self.dirty = False
+        self.logger = logging.getLogger('gwcli')
+
+        if self.enabled:
+            self.load()
+
+    @property
+    def enabled(self):
+        return self.path is not None and self.ttl > 0
+
+    def load(self):
+        try:
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+        except (IOError, ValueError):
+            # a missing or damaged cache just means the meta data is fetched
+            return
+
+        if isinstance(data, dict) and data.get('version') == self.version:
+            self.entries = data.get('disks', {})
+
+    def save(self):
+        """
+        write the cache when it has changed. The file is replaced by a rename
+        so concurrent gwcli runs never see a partial file
+        """
+
+        if not (self.enabled and self.dirty):
+            return
+
+        tmp_path = "{}.{}".format(self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as cache_file:
+                json.dump({"version": self.version, "disks": self.entries},
+                          cache_file)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as err:
+            self.logger.debug("Unable to write the disk meta data cache "
+                              "{} : {}".format(self.path, err))
+            return
+
+        self.dirty = False
+
+    def get(self, image_id, wwn):
+        """
+        :return: (tuple) size, features of the disk or None if there is no
+                 valid entry
+        """
+
+        if not self.enabled:
+            return None
+
+        entry = self.entries.get(image_id)
+        if not entry or entry.get('wwn') != wwn:
+            return None
+        if time.time() - entry.get('verified', 0) > self.ttl:
+            return None
+
+        return entry['size'], entry['features']
+
+    def store(self, image_id, wwn, size, features):
+        self.entries[image_id] = {"wwn": wwn, "size": size,
+                                  "features": features,
+                                  "verified": int(time.time())}
+        self.dirty = True
+
+    def remove(self, image_id):
+        if self.entries.pop(image_id, None) is not None:
+            self.dirty = True
+
+    def prune(self, image_ids):
+        """
+        drop the entries of disks no longer in the configuration
+        :param image_ids: (list) of the disks defined in the config
+        """
+
+        for image_id in set(self.entries) - set(image_ids):
+            self.remove(image_id)
+
+
 class Disks(UIGroup):
 
     help_intro = '''
@@ -44,20 +147,132 @@ class Disks(UIGroup):
         UIGroup.__init__(self, 'disks', parent)
         self.disk_info = {}
         self.disk_lookup = {}
+        self.pending_meta = []
+
+        # capacity aggregates, adjusted as disk sizes are set or disks are
+        # removed (see Disk.size). Disks waiting for their rbd meta data
+        # aren't in the aggregates yet, they're counted by pool instead
+        self.total_bytes = 0
+        self.pool_bytes = {}
+        self.pending_count = {}
+
+        # the cache lives in the shell's preferences directory (~/.gwcli)
+        prefs_file = getattr(self.shell, '_prefs_file', None)
+        cache_path = os.path.join(os.path.dirname(prefs_file),
+                                  'disk_meta.json') if prefs_file else None
+        self.meta_cache = DiskMetaCache(cache_path,
+                                        get_tunable('metadata_cache_ttl', 300))
 
     def refresh(self, disk_info):
         self.logger.debug("Refreshing disk information from the config object")
+        self.reset()
+        self.disk_lookup = {}
         self.disk_info = disk_info
-        # Load the disk configuration
-        for image_id in disk_info:
-            image_config = disk_info[image_id]
-            Disk(self, image_id, image_config)
+        self.meta_cache.prune(disk_info.keys())
+        self.meta_cache.save()
+
+        # Load the disk configuration. The rbd meta data of the disks is
+        # fetched (in bulk) when it's first needed
+        self.pending_meta = [Disk(self, image_id, disk_info[image_id],
+                                  load_meta=False)
+                             for image_id in disk_info]
+        for disk in self.pending_meta:
+            self.pending_count[disk.pool] = \
+                self.pending_count.get(disk.pool, 0) + 1
+
+    def load_pending_meta(self):
+        """
+        fetch the meta data of all the disks that don't have it yet
+        """
+
+        disks = []
+        for disk in self.pending_meta:
+            if disk.meta_loaded:
+                continue
+            cached = self.meta_cache.get(disk.image_id, disk.wwn)
+            if cached:
+                disk.set_meta_data(*cached)
+            else:
+                disks.append(disk)
+
+        self.load_meta_data(disks)
+        self.pending_meta = []
+
+    def adjust_capacity(self, pool, delta):
+        """
+        apply a change in the size of a disk to the capacity aggregates
+        :param pool: (str) pool of the disk
+        :param delta: (int) change in bytes
+        """
+
+        self.total_bytes += delta
+        self.pool_bytes[pool] = self.pool_bytes.get(pool, 0) + delta
+
+    def meta_resolved(self, pool):
+        """
+        a disk of the pool that was waiting for its meta data has its size
+        in the aggregates now (or has been deleted)
+        :param pool: (str) pool of the disk
+        """
+
+        self.pending_count[pool] -= 1
+
+    def pool_commit(self, pool):
+        """
+        :param pool: (str) pool name
+        :return: (int) total size of the disks defined in the pool, leaving
+                 out the disks still waiting for their meta data (see
+                 pool_pending)
+        """
+
+        return self.pool_bytes.get(pool, 0)
+
+    def pool_pending(self, pool=None):
+        """
+        :param pool: (str) pool name, or None for all the pools
+        :return: (int) disks not in the capacity aggregates yet
+        """
+
+        if pool is None:
+            return sum(self.pending_count.values())
+        return self.pending_count.get(pool, 0)
+
+    def load_meta_data(self, disks):
+        """
+        fetch the size and features of the disks' rbd images in bulk,
+        rather than each disk connecting to the cluster in turn
+        :param disks: (list) of Disk objects
+        """
+
+        if not disks:
+            return
+
+        self.logger.debug("Fetching rbd meta data for {} "
+                          "disks".format(len(disks)))
+        meta_data = rbd_metadata([(disk.pool, disk.image) for disk in disks],
+                                 max_workers=get_tunable('metadata_workers',
+                                                         8))
+        for disk in disks:
+            size, features = meta_data[(disk.pool, disk.image)]
+            disk.set_meta_data(size, features)
+            self.meta_cache.store(disk.image_id, disk.wwn, size, features)
+
+        self.meta_cache.save()
 
     def reset(self):
         children = set(self.children)  # set of child objects
         for child in children:
             self.remove_child(child)
 
+        self.total_bytes = 0
+        self.pool_bytes = {}
+        self.pending_count = {}
+
+    def prepare_listing(self):
+        # the listing shows the size of every disk, so fetch the pending meta
+        # data in one pass before the summary reads the aggregates
+        self.load_pending_meta()
+
     def ui_command_create(self, pool=None, image=None, size=None, count=1):
         """
         Create a LUN and assign to the gateway(s).
@@ -144,9 +359,8 @@ class Disks(UIGroup):
             self.logger.debug("- LUN(s) ready on all gateways")
             self.logger.info("ok")
 
-            ceph_pools = self.parent.ceph.local_ceph.pools
-            ceph_pools.refresh()
-
+            # the new disks are added to the capacity aggregates as their
+            # sizes are set, the pool stats are updated by the next refresh
             self.logger.debug("Updating UI for the new disk(s)")
             for n in range(1, (int(count)+1), 1):
 
@@ -193,11 +407,11 @@ class Disks(UIGroup):
         """
         disk_users = []
 
-        client_list = self.find_hosts()
-        for client in client_list:
-            client_disks = [mlun.rbd_name for mlun in client.children]
-            if image_id in client_disks:
-                disk_users.append(client.name)
+        # each target's Clients group maintains a disk -> clients lun_map
+        for tgt in self.parent.target.children:
+            for tgt_child in tgt.children:
+                if isinstance(tgt_child, Clients):
+                    disk_users += sorted(tgt_child.lun_map.get(image_id, []))
 
         return disk_users
 
@@ -272,20 +486,26 @@ class Disks(UIGroup):
 
         if api.response.status_code == 200:
             self.logger.debug("- rbd removed from all gateways, and deleted")
-            disk_object = [disk for disk in self.children
-                           if disk.name == image_id][0]
-            self.remove_child(disk_object)
+            disk = self.disk_lookup[image_id]
+            # _size is what the disk has added to the aggregates - reading
+            # size would fetch the meta data of the image just deleted
+            self.adjust_capacity(disk.pool, -disk._size)
+            if disk.meta_pending:
+                disk.meta_pending = False
+                self.meta_resolved(disk.pool)
+            if disk in self.pending_meta:
+                self.pending_meta.remove(disk)
+            self.remove_child(disk)
             del self.disk_info[image_id]
             del self.disk_lookup[image_id]
+            self.meta_cache.remove(image_id)
+            self.meta_cache.save()
         else:
             self.logger.debug("delete request failed - "
                               "{}".format(api.response.status_code))
             self.logger.error("{}".format(api.response.json()['message']))
             return
 
-        ceph_pools = self.parent.ceph.local_ceph.pools
-        ceph_pools.refresh()
-
         self.logger.info('ok')
 
     def _valid_request(self, pool, image, size):
@@ -320,11 +540,30 @@ class Disks(UIGroup):
         return state
 
     def summary(self):
-        total_bytes = 0
-        for disk in self.children:
-            total_bytes += disk.size
-        return '{}, Disks: {}'.format(human_size(total_bytes),
-                                      len(self.children)), None
+        msg = ['{}'.format(human_size(self.total_bytes)),
+               'Disks: {}'.format(len(self.children))]
+        pending = self.pool_pending()
+        if pending:
+            msg.append('Pending: {}'.format(pending))
+        return ', '.join(msg), None
+
+
+def meta_property(name, doc, fset=None):
+    """
+    Disk attribute holding rbd meta data, which is fetched on first read
+    :param name: (str) name of the attribute holding the value
+    :param doc: (str) property description
+    :param fset: setter to use in place of a plain assignment
+    """
+
+    def getter(self):
+        self._resolve_meta_data()
+        return getattr(self, name)
+
+    def setter(self, value):
+        setattr(self, name, value)
+
+    return property(getter, fset or setter, doc=doc)
 
 
 class Disk(UINode):
@@ -332,13 +571,16 @@ class Disk(UINode):
     display_attributes = ["image", "ceph_cluster", "pool", "wwn", "size_h",
                           "feature_list", "owner"]
 
-    def __init__(self, parent, image_id, image_config):
+    def __init__(self, parent, image_id, image_config, load_meta=True):
         """
         Create a disk entry under the Disks subtree
         :param parent: parent object (instance of the Disks class)
         :param image_id: key used in the config object for this rbd image
                (pool.image_name) - str
         :param image_config: meta data for this image
+        :param load_meta: (bool) fetch the size/features of the rbd image
+               now. When False they're fetched on first use, together with
+               the other disks pending in the parent (see Disks.refresh)
         :return:
         """
         self.pool, self.rbd_image = image_id.split('.', 1)
@@ -346,11 +588,17 @@ class Disk(UINode):
         UINode.__init__(self, image_id, parent)
 
         self.image_id = image_id
-        self.size = 0
-        self.size_h = ''
-        self.features = 0
-        self.feature_list = []
-        self.ceph_cluster = self.parent.parent.ceph.local_ceph.name
+        self.wwn = ''
+        self.meta_loaded = False
+        # counted in the parent's pending_count until the meta data is set
+        self.meta_pending = not load_meta
+        self._size = 0
+        self._size_h = ''
+        self._features = 0
+        self._feature_list = []
+        # the disks are in the local cluster (named here without loading
+        # the clusters subtree)
+        self.ceph_cluster = settings.config.cluster_name
 
         disk_map = self.parent.disk_info
         if image_id not in disk_map:
@@ -366,7 +614,26 @@ class Disk(UINode):
 
         # Size/features are not stored in the config, since it can be changed
         # outside of this tool-chain, so we get them dynamically
-        self.get_meta_data_tcmu()
+        if load_meta:
+            self.get_meta_data_tcmu()
+
+    def _resolve_meta_data(self):
+        if not self.meta_loaded:
+            self.parent.load_pending_meta()
+
+        if not self.meta_loaded:
+            # not one of the pending disks
+            self.get_meta_data_tcmu()
+
+    def _set_size(self, size):
+        self.parent.adjust_capacity(self.pool, size - self._size)
+        self._size = size
+
+    size = meta_property('_size', "size of the rbd image in bytes",
+                         fset=_set_size)
+    size_h = meta_property('_size_h', "human readable size of the image")
+    features = meta_property('_features', "rbd feature bits of the image")
+    feature_list = meta_property('_feature_list', "rbd feature names")
 
     def summary(self):
         msg = [self.image, "({})".format(self.size_h)]
@@ -400,13 +667,34 @@ class Disk(UINode):
         query the rbd to get the features and size of the rbd
         :return:
         """
-        with rados.Rados(conffile=settings.config.cephconf) as cluster:
-            with cluster.open_ioctx(self.pool) as ioctx:
-                with rbd.Image(ioctx, self.image) as rbd_image:
-                    self.size = rbd_image.size()
-                    self.size_h = human_size(self.size)
-                    self.features = rbd_image.features()
-                    self.feature_list = self._get_features()
+        with rados_cluster() as cluster:
+            with rbd_image(cluster, self.pool, self.image) as disk_image:
+                with backend.timed('rbd.size', self.pool):
+                    size = disk_image.size()
+                with backend.timed('rbd.features', self.pool):
+                    features = disk_image.features()
+
+        self.set_meta_data(size, features)
+
+        meta_cache = self.parent.meta_cache
+        meta_cache.store(self.image_id, self.wwn, size, features)
+        meta_cache.save()
+
+    def set_meta_data(self, size, features):
+        """
+        apply the size and features of the rbd image to the disk
+        :param size: (int) size in bytes
+        :param features: (int) rbd feature bits
+        """
+
+        self.meta_loaded = True
+        self.size = size
+        if self.meta_pending:
+            self.meta_pending = False
+            self.parent.meta_resolved(self.pool)
+        self.size_h = human_size(self.size)
+        self.features = features
+        self.feature_list = self._get_features()
 
         # update the parent's disk info map
         disk_map = self.parent.disk_info
@@ -439,6 +727,10 @@ class Disk(UINode):
             raise GatewayError(error_msg)
         else:
 
+            self.meta_loaded = True
+            if self.meta_pending:
+                self.meta_pending = False
+                self.parent.meta_resolved(self.pool)
             self.size_h = human_size(self.size)
 
             # update the parent's disk info map
@@ -479,12 +771,22 @@ class Disk(UINode):
         api.put()
 
         if api.response.status_code == 200:
-            # at this point the resize request was successful, so we need to
-            # update the ceph pool meta data (%commit etc)
-            self._update_pool()
+            # at this point the resize request was successful. The ceph pool
+            # meta data (%commit etc) is derived from the disk sizes, so it
+            # picks up the new size
             self.size_h = size_rqst
             self.size = convert_2_bytes(size_rqst)
 
+            meta_cache = self.parent.meta_cache
+            if self.meta_loaded:
+                meta_cache.store(self.image_id, self.wwn, self.size,
+                                 self.features)
+            else:
+                # the features aren't known yet, so the entry is refreshed
+                # when they're fetched
+                meta_cache.remove(self.image_id)
+            meta_cache.save()
+
             self.logger.info('ok')
 
         else:
@@ -492,20 +794,6 @@ class Disk(UINode):
                               "{}".format(api.response.json()['message']))
 
 
-    def _update_pool(self):
-        """
-        use the object model to track back from the disk to the relevant pool
-        in the local ceph cluster and update the commit stats
-        """
-        root = self.parent.parent
-        ceph_group = root.ceph
-        cluster = ceph_group.local_ceph
-        pool = cluster.pools.pool_lookup.get(self.pool)
-
-        if pool:
-            # update the pool commit numbers
-            pool._calc_overcommit()
-
     def ui_command_resize(self, size=None):
         """
         The resize command allows you to increase the size of an
@@ -1,20 +1,28 @@
 #!/usr/bin/env python
 
+import errno
+import json
+import select
 import socket
 import requests
 import sys
 import rados
 import rbd
 import re
+import threading
+import time
 
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 from rtslib_fb.utils import normalize_wwn, RTSLibError
-import rtslib_fb.root as root
 
 import ceph_iscsi_config.settings as settings
 from ceph_iscsi_config.utils import (get_ip, ipv4_addresses, gen_file_hash,
                                      valid_size, convert_2_bytes)
 
+from gwcli.perf import counters, backend
+
 
 __author__ = 'Paul Cuzner'
 
@@ -64,6 +72,121 @@ def get_config():
         return {}
 
 
+def get_sessions(fresh=False):
+    """
+    use the /sessions api to return the iSCSI sessions across all gateways
+    :param fresh: (bool) query the gateways, rather than accepting the API's
+                  briefly cached view of the sessions
+    :return: (tuple) dict of client iqn -> merged session state for the
+             client (None if the sessions couldn't be queried), and the list
+             of gateways whose sessions are missing from the merged view
+    """
+
+    http_mode = "https" if settings.config.api_secure else "http"
+    api_rqst = "{}://127.0.0.1:{}/api/sessions".format(http_mode,
+                                                       settings.config.api_port)
+    if fresh:
+        api_rqst += "?fresh=1"
+    api = APIRequest(api_rqst)
+    api.get()
+
+    if api.response.status_code == 200:
+        response = api.response.json()
+        return response['sessions'], response['unreachable']
+    else:
+        return None, []
+
+
+class SessionSnapshot(object):
+    """
+    The merged iSCSI sessions of all the clients, indexed by client iqn.
+    The sessions are fetched once and shared by every lookup made within
+    the session_snapshot_ttl tunable, so rendering a tree of clients doesn't
+    query the sessions for each client. The snapshot is only for display -
+    checks that guard a change (e.g. a client delete) fetch the sessions
+    themselves
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = None
+        self.timestamp = 0
+
+    def get(self, client_iqn):
+        """
+        :param client_iqn: (str) client iqn
+        :return: (dict) merged session state of the client, empty if the
+                 client has no sessions
+        """
+
+        ttl = get_tunable('session_snapshot_ttl', 2)
+
+        with self.lock:
+            if (self.sessions is None or
+                    time.time() - self.timestamp >= ttl):
+                sessions, _ = get_sessions()
+                if sessions is None:
+                    # don't hold on to a failed query, the next lookup
+                    # tries again
+                    self.sessions = None
+                    return {}
+
+                self.sessions = sessions
+                self.timestamp = time.time()
+
+            return self.sessions.get(client_iqn, {})
+
+    def invalidate(self):
+        with self.lock:
+            self.sessions = None
+
+
+session_snapshot = SessionSnapshot()
+
+
+def get_tunable(name, default):
+    """
+    return a tuning value from the gateway's configuration settings, falling
+    back to the given default when it's not defined. Values read from
+    iscsi-gateway.cfg are strings, so they're cast to the type of the default
+    :param name: (str) setting name
+    :param default: default value (also determines the returned type)
+    :return: setting value
+    """
+
+    value = getattr(settings.config, name, default)
+    if isinstance(default, bool) and not isinstance(value, bool):
+        return str(value).lower() in ['true', 'yes', '1']
+
+    try:
+        return type(default)(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def run_concurrently(func, items, max_workers=8):
+    """
+    call func against each item using a bounded pool of threads
+    :param func: callable taking a single item
+    :param items: (list) items to process
+    :param max_workers: (int) maximum number of concurrent calls
+    :return: (list) of results, in the same sequence as items
+    """
+
+    items = list(items)
+    if len(items) < 2:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        results = pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
 def valid_iqn(iqn):
     """
     confirm whether the given iqn is in an acceptable format
@@ -169,13 +292,58 @@ def rbd_size(pool, image, conf=None):
     if conf is None:
         conf = settings.config.cephconf
 
-    with rados.Rados(conffile=conf) as cluster:
-        with cluster.open_ioctx(pool) as ioctx:
-            with rbd.Image(ioctx, image) as rbd_image:
-                size = rbd_image.size()
+    with rados_cluster(conf) as cluster:
+        with rbd_image(cluster, pool, image) as disk_image:
+            with backend.timed('rbd.size', pool):
+                size = disk_image.size()
     return size
 
 
+def rbd_metadata(images, conf=None, max_workers=8):
+    """
+    return the size and features of a number of rbd images in one pass. A
+    single cluster connection and one ioctx per pool are shared by all the
+    images, and the images are opened concurrently, read-only so no locks
+    are taken
+    :param images: (list) of (pool, image) tuples
+    :param conf: (str) or None
+    :param max_workers: (int) maximum number of concurrent image opens
+    :return: (dict) (pool, image) -> (size in bytes, features)
+    """
+
+    pools = {}
+    for pool, image in images:
+        pools.setdefault(pool, []).append(image)
+
+    metadata = {}
+    with rados_cluster(conf) as cluster:
+        for pool in sorted(pools):
+            with backend.timed('rados.open_ioctx', pool):
+                ioctx = cluster.open_ioctx(pool)
+
+            def _query(image, pool=pool, ioctx=ioctx):
+                with backend.timed('rbd.open', pool):
+                    disk_image = rbd.Image(ioctx, image, read_only=True)
+                try:
+                    with backend.timed('rbd.size', pool):
+                        size = disk_image.size()
+                    with backend.timed('rbd.features', pool):
+                        features = disk_image.features()
+                finally:
+                    disk_image.close()
+                return size, features
+
+            try:
+                results = run_concurrently(_query, pools[pool], max_workers)
+            finally:
+                ioctx.close()
+
+            for image, result in zip(pools[pool], results):
+                metadata[(pool, image)] = result
+
+    return metadata
+
+
 def rados_pools(conf=None):
     """
     return a list of pools in the local ceph cluster
@@ -186,12 +354,76 @@ def rados_pools(conf=None):
     if conf is None:
         conf = settings.config.cephconf
 
-    with rados.Rados(conffile=conf) as cluster:
-        pool_list = cluster.list_pools()
+    with rados_cluster(conf) as cluster:
+        with backend.timed('rados.list_pools'):
+            pool_list = cluster.list_pools()
 
     return pool_list
 
 
+@contextmanager
+def rados_cluster(conf=None):
+    """
+    connect to the local ceph cluster, recording the connection time
+    :param conf: (str) ceph.conf path, or None for the configured one
+    :return: connected rados.Rados instance
+    """
+
+    if conf is None:
+        conf = settings.config.cephconf
+
+    cluster = rados.Rados(conffile=conf)
+    with backend.timed('rados.connect'):
+        cluster.connect()
+    try:
+        yield cluster
+    finally:
+        cluster.shutdown()
+
+
+@contextmanager
+def rbd_image(cluster, pool, image):
+    """
+    open an rbd image, recording the ioctx and image open times
+    :param cluster: connected rados.Rados instance
+    :param pool: (str) pool name
+    :param image: (str) rbd image name
+    :return: rbd.Image instance
+    """
+
+    with backend.timed('rados.open_ioctx', pool):
+        ioctx = cluster.open_ioctx(pool)
+    try:
+        with backend.timed('rbd.open', pool):
+            disk_image = rbd.Image(ioctx, image)
+        try:
+            yield disk_image
+        finally:
+            disk_image.close()
+    finally:
+        ioctx.close()
+
+
+def mon_command(cluster, cmd):
+    """
+    issue a mon command, recording the time taken and any failure
+    :param cluster: connected rados.Rados instance
+    :param cmd: (dict) command, including the 'prefix'
+    :return: (tuple) return code, output buffer, status string
+    """
+
+    op = "mon.{}".format(cmd['prefix'])
+    start = time.time()
+    try:
+        rc, buf_s, out = cluster.mon_command(json.dumps(cmd), b'')
+    except Exception:
+        backend.record(op, None, time.time() - start, error=True)
+        raise
+
+    backend.record(op, None, time.time() - start, error=rc != 0)
+    return rc, buf_s, out
+
+
 def valid_disk(**kwargs):
     """
     determine whether the given image info is valid for a disk operation
@@ -405,17 +637,28 @@ def valid_client(**kwargs):
                     "group {}".format(client_iqn,
                                       this_client.get('group_name')))
 
-        # client to delete must not be logged in - we're just checking locally,
-        # since *all* nodes are set up the same, and a client login request
-        # would normally login to each gateway
-        lio_root = root.RTSRoot()
-        clients_logged_in = [session['parent_nodeacl'].node_wwn
-                             for session in lio_root.sessions
-                             if session['state'] == 'LOGGED_IN']
-
-        if client_iqn in clients_logged_in:
-            return ("Client '{}' is logged in - unable to delete until"
-                    " it's logged out".format(client_iqn))
+        # client to delete must not be logged in to *any* gateway, so use
+        # the current (not the display snapshot's) merged session view from
+        # across the gateways. A gateway that couldn't be queried may still
+        # hold a session for the client
+        sessions, unreachable = get_sessions(fresh=True)
+        if sessions is None:
+            return ("Unable to query the iSCSI sessions - '{}' can't be "
+                    "deleted until its sessions can be "
+                    "checked".format(client_iqn))
+        if unreachable:
+            return ("Unable to query the iSCSI sessions on {} - '{}' can't "
+                    "be deleted until its sessions can be checked on every "
+                    "gateway".format(','.join(unreachable), client_iqn))
+
+        client_sessions = sessions.get(client_iqn, {})
+        if client_sessions.get('state') == 'LOGGED_IN':
+            logged_in = [gw for gw, session in
+                         client_sessions['gateways'].items()
+                         if session['state'] == 'LOGGED_IN']
+            return ("Client '{}' is logged in to {} - unable to delete "
+                    "until it's logged out".format(client_iqn,
+                                                   ','.join(sorted(logged_in))))
 
         # at this point, the client looks ok for a DELETE operation
         return 'ok'
@@ -506,6 +749,9 @@ class APIRequest(object):
                                    settings.config.api_password)
         if 'verify' not in self.kwargs:
             self.kwargs['verify'] = settings.config.api_ssl_verify
+        if 'timeout' not in self.kwargs:
+            # requests waits forever without a timeout
+            self.kwargs['timeout'] = settings.config.time_out
 
         self.http_methods = ['get', 'put',  'delete']
         self.data = None
@@ -516,11 +762,21 @@ class APIRequest(object):
     def __getattr__(self, name):
         if name in self.http_methods:
             request_method = getattr(requests, name)
+            op = APIRequest.operation(name, self.args[0])
+            start = time.time()
             try:
                 self.data = request_method(*self.args, **self.kwargs)
             except requests.ConnectionError:
+                counters.record('api', op, time.time() - start, error=True)
                 raise GatewayAPIError("Unable to connect to api endpoint @ {}".format(self.args[0]))
+            except requests.Timeout:
+                counters.record('api', op, time.time() - start, error=True)
+                raise GatewayAPIError("No response from api endpoint @ {} "
+                                      "within {}s".format(self.args[0],
+                                                          self.kwargs['timeout']))
             else:
+                counters.record('api', op, time.time() - start,
+                                error=self.data.status_code >= 400)
                 # since the attribute is a callable, we must return with
                 # a callable
                 return self._get_response
@@ -529,6 +785,16 @@ class APIRequest(object):
     response = property(_get_response,
                         doc="get http response output")
 
+    @staticmethod
+    def operation(method, url):
+        """
+        name a request by its method and endpoint, for the perf counters
+        e.g. PUT /api/client
+        """
+
+        path = url.split('://', 1)[-1].partition('/')[2]
+        return "{} /{}".format(method.upper(), '/'.join(path.split('/')[:2]))
+
 
 def progress_message(text, color='green'):
 
@@ -548,22 +814,71 @@ def console_message(text, color='green'):
     else:
         print(text)
 
-def get_port_state(ip_address, port):
+def get_port_state(ip_address, port, timeout=1):
     """
     Determine port state
     :param ip_address: ipv4 address dotted quad string
     :param port: port number
+    :param timeout: (float) seconds to wait for the connection
     :return: 0 = port open, !=0 port closed/inaccessible
     """
 
-    socket.setdefaulttimeout(1)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        result = sock.connect_ex((ip_address, port))
-        sock.shutdown(socket.SHUT_RDWR)
+    result, _rtt = probe_ports([(ip_address, port)],
+                               timeout)[(ip_address, port)]
+    return result
+
+
+def probe_ports(endpoints, timeout=1):
+    """
+    Determine the state of a number of tcp ports at once. A non-blocking
+    connect is started to every endpoint, and the connects are multiplexed
+    with select, so the probes take at most timeout seconds in total
+    :param endpoints: (list) of (ip_address, port) tuples
+    :param timeout: (float) seconds to wait for the connections
+    :return: (dict) (ip_address, port) -> (result, rtt) where result is
+             0 = port open, !=0 port closed/inaccessible and rtt is the time
+             taken to connect in seconds (None if the port isn't open)
+    """
+
+    results = {}
+    pending = {}
+    started = {}
+
+    for endpoint in set(endpoints):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        started[sock] = time.time()
+        try:
+            result = sock.connect_ex(endpoint)
+        except socket.error:
+            result = 16
+
+        if result in [errno.EINPROGRESS, errno.EWOULDBLOCK]:
+            pending[sock] = endpoint
+            continue
+
+        rtt = time.time() - started[sock] if result == 0 else None
+        results[endpoint] = (result, rtt)
         sock.close()
-    except socket.error:
-        result = 16
 
-    return result
+    deadline = time.time() + timeout
+    while pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+
+        _, connected, _ = select.select([], list(pending), [], remaining)
+        for sock in connected:
+            endpoint = pending.pop(sock)
+            result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            rtt = time.time() - started[sock] if result == 0 else None
+            results[endpoint] = (result, rtt)
+            sock.close()
+
+    # anything left didn't connect within the timeout
+    for sock, endpoint in pending.items():
+        results[endpoint] = (errno.ETIMEDOUT, None)
+        sock.close()
+
+    return results
 
@@ -10,13 +10,24 @@ import OpenSSL
 import threading
 import time
 import inspect
+import json
+import zlib
 
+from collections import deque
+from contextlib import contextmanager
 from functools import wraps
 from rpm import labelCompare
 import rados
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 import werkzeug
-from flask import Flask, jsonify, make_response, request
+from flask import (Flask, Response, jsonify, make_response, request,
+                   copy_current_request_context, has_request_context)
+from rtslib_fb.root import RTSRoot
 from rtslib_fb.utils import RTSLibError, normalize_wwn
 
 import ceph_iscsi_config.settings as settings
@@ -29,7 +40,10 @@ from ceph_iscsi_config.utils import (get_ip, this_host, ipv4_addresses,
                                      gen_file_hash, valid_rpm)
 
 from gwcli.utils import (this_host, APIRequest, valid_gateway,
-                         valid_disk, valid_client)
+                         valid_disk, valid_client, GatewayAPIError,
+                         get_tunable, run_concurrently)
+from gwcli.perf import (PhaseTimer, StackSampler, thread_stacks, backend,
+                        LatencyHistogram, percentile)
 
 from gwcli.client import Client
 
@@ -37,6 +51,73 @@ __author__ = "pcuzner@redhat.com"
 
 app = Flask(__name__)
 
+# merged session view is cached briefly, so a cli refresh doesn't fan out
+# to every gateway for each lookup. 'fetching' is the fan-out under way, that
+# concurrent requests wait for rather than starting their own
+session_cache = {"timestamp": 0, "sessions": None, "fetching": None}
+session_cache_lock = threading.Lock()
+
+# admission gates for the LIO mutating endpoints, created on first use
+admission_gates = {}
+
+# endpoint classes of the admission controlled endpoints, whose mutating
+# requests run on the mutation worker
+MUTATION_CLASSES = ['_gateway', '_disk', '_client', '_clientlun', '_hostgroup']
+admission_gates_lock = threading.Lock()
+
+# request being handled by each thread (thread ident -> request details),
+# reported by the _threads endpoint
+request_contexts = {}
+
+# only one sampling profile runs at a time
+profile_lock = threading.Lock()
+
+# phases of a request reported by the slow request log, in log order. Time
+# outside these phases is reported as 'handler'. The lio phase covers the
+# ceph_iscsi_config calls, including the config object commits they make
+REQUEST_PHASES = ['auth', 'validation', 'lio', 'refresh', 'fanout']
+
+# endpoints that are slow by design, and are not reported as slow requests
+UNTIMED_ENDPOINTS = ['_profile']
+
+
+def credentials_error():
+    """
+    check the credentials supplied in the http request are valid
+    :return: error response, or None if the credentials are OK
+    """
+
+    auth = request.authorization
+    if not auth:
+        return jsonify(message="Missing credentials"), 401
+
+    if (auth.username != settings.config.api_user or
+            auth.password != settings.config.api_password):
+        return jsonify(message="username/password mismatch with the "
+                               "configuration file"), 401
+
+    return None
+
+
+def source_error():
+    """
+    check the source of the request is a gateway or a trusted address
+    :return: error response, or None if the source is OK
+    """
+
+    snapshot = get_snapshot()
+    local_gw = ['127.0.0.1']
+    gw_names = [gw for gw in snapshot.config['gateways']
+                if isinstance(snapshot.config['gateways'][gw], dict)]
+    gw_ips = [get_ip(gw_name) for gw_name in gw_names] + \
+             local_gw + settings.config.trusted_ip_list
+
+    if request.remote_addr not in gw_ips:
+        return jsonify(message="API access not available to "
+                               "{}".format(request.remote_addr)), 403
+
+    return None
+
 
 def requires_basic_auth(f):
     """
@@ -46,15 +127,10 @@ def requires_basic_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
 
-        # check credentials supplied in the http request are valid
-        auth = request.authorization
-        if not auth:
-            return jsonify(message="Missing credentials"), 401
-
-        if (auth.username != settings.config.api_user or
-           auth.password != settings.config.api_password):
-            return jsonify(message="username/password mismatch with the "
-                                   "configuration file"), 401
+        with request_phase('auth'):
+            error = credentials_error()
+        if error:
+            return error
 
         return f(*args, **kwargs)
 
@@ -70,28 +146,368 @@ def requires_restricted_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
 
-        # First check that the source of the request is actually valid
-        local_gw = ['127.0.0.1']
-        gw_names = [gw for gw in config.config['gateways']
-                    if isinstance(config.config['gateways'][gw], dict)]
-        gw_ips = [get_ip(gw_name) for gw_name in gw_names] + \
-                 local_gw + settings.config.trusted_ip_list
+        # First check that the source of the request is actually valid, then
+        # the credentials
+        with request_phase('auth'):
+            error = source_error() or credentials_error()
+        if error:
+            return error
+
+        return f(*args, **kwargs)
 
-        if request.remote_addr not in gw_ips:
-            return jsonify(message="API access not available to "
-                                   "{}".format(request.remote_addr)), 403
+    return decorated
 
-        # check credentials supplied in the http request are valid
-        auth = request.authorization
-        if not auth:
-            return jsonify(message="Missing credentials"), 401
 
-        if (auth.username != settings.config.api_user or
-                    auth.password != settings.config.api_password):
-            return jsonify(message="username/password mismatch with the "
-                                   "configuration file"), 401
+class AdmissionGate(object):
+    """
+    An AdmissionGate bounds the number of LIO mutating requests of a given
+    endpoint class that run at once. Requests over the concurrency limit wait
+    in a bounded queue, and once that queue is full further requests are
+    rejected so the caller backs off instead of piling up on configfs.
+
+    An admitted request is handed to the MutationWorker, which runs the
+    mutations of every class one at a time. The concurrency limit of a class
+    is therefore the number of its requests that may be at the worker
+    (running, or waiting their turn behind other classes) at once - a limit
+    above 1 doesn't run mutations in parallel, it lets a class keep more of
+    the worker's backlog, at the cost of the other classes waiting longer
+    """
 
-        return f(*args, **kwargs)
+    def __init__(self, name, max_active, max_queued):
+        self.name = name
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.lock = threading.Condition()
+        self.active = 0
+        self.queued = 0
+        self.peak_queued = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def acquire(self):
+        """
+        Wait for a free slot
+        :return: (bool) False if the request is rejected (queue full)
+        """
+        with self.lock:
+            if self.active >= self.max_active:
+                if self.queued >= self.max_queued:
+                    self.rejected += 1
+                    return False
+
+                self.queued += 1
+                self.peak_queued = max(self.peak_queued, self.queued)
+                while self.active >= self.max_active:
+                    self.lock.wait()
+                self.queued -= 1
+
+            self.active += 1
+            self.admitted += 1
+
+        return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+            self.lock.notify()
+
+    def stats(self):
+        with self.lock:
+            return {"active": self.active,
+                    "queued": self.queued,
+                    "peak_queued": self.peak_queued,
+                    "admitted": self.admitted,
+                    "rejected": self.rejected,
+                    "max_active": self.max_active,
+                    "max_queued": self.max_queued}
+
+
+def get_admission_gate(endpoint_class):
+    """
+    Return the admission gate for an endpoint class, creating it from the
+    <class>_mutation_limit/_queue settings (or the mutation_limit and
+    mutation_queue defaults) on first use
+    :param endpoint_class: (str) endpoint class name e.g. _disk
+    :return: AdmissionGate
+    """
+
+    with admission_gates_lock:
+        if endpoint_class not in admission_gates:
+            prefix = endpoint_class.strip('_')
+            max_queued = get_tunable('{}_mutation_queue'.format(prefix),
+                                     get_tunable('mutation_queue', 16))
+            admission_gates[endpoint_class] = AdmissionGate(
+                endpoint_class, mutation_limit(endpoint_class),
+                max(0, max_queued))
+
+        return admission_gates[endpoint_class]
+
+
+def mutation_limit(endpoint_class):
+    """
+    :param endpoint_class: (str) endpoint class name e.g. _disk
+    :return: (int) requests of the class admitted to the mutation worker at
+             once, from the <class>_mutation_limit setting (or the
+             mutation_limit default)
+    """
+
+    prefix = endpoint_class.strip('_')
+    return max(1, get_tunable('{}_mutation_limit'.format(prefix),
+                              get_tunable('mutation_limit', 2)))
+
+
+def admission_control(endpoint_class):
+    """
+    wrapper function to apply admission control to the mutating (non GET)
+    requests of an endpoint class. When the queue for the class is full the
+    request is rejected with a 429 and a Retry-After header
+    """
+
+    def wrapper(f):
+
+        @wraps(f)
+        def decorated(*args, **kwargs):
+
+            if request.method == 'GET':
+                return f(*args, **kwargs)
+
+            gate = get_admission_gate(endpoint_class)
+            if not gate.acquire():
+                logger.warning("{} request from {} rejected - {} requests "
+                               "queued".format(endpoint_class,
+                                               request.remote_addr,
+                                               gate.queued))
+                retry_after = get_tunable('mutation_retry_after', 5)
+                return jsonify(message="Too many concurrent {} requests, "
+                                       "retry later".format(endpoint_class)), \
+                       429, {"Retry-After": str(retry_after)}
+
+            try:
+                return f(*args, **kwargs)
+            finally:
+                gate.release()
+
+        return decorated
+
+    return wrapper
+
+
+class MutationWorker(threading.Thread):
+    """
+    The MutationWorker runs every LIO mutating request on this gateway, one
+    at a time, on a dedicated thread. Request threads hand the work over and
+    wait for the result, so reads are never stuck behind a long running
+    mutation and mutations never run concurrently against configfs. The
+    worker's queue is bounded by the sum of the admission limits of the
+    endpoint classes, so the backlog of mutations is capped as a whole and
+    each class holds no more of it than its own limit
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.jobs = queue.Queue()
+        self.start_lock = threading.Lock()
+
+    def run(self):
+        while True:
+            func, job = self.jobs.get()
+            try:
+                job['result'] = func()
+            except Exception as err:
+                logger.exception("Mutation request failed")
+                job['error'] = err
+            finally:
+                job['done'].set()
+
+    def submit(self, func):
+        """
+        Run func on the worker thread and wait for its result
+        :param func: callable with no arguments
+        :return: whatever func returns
+        """
+
+        with self.start_lock:
+            if not self.is_alive():
+                # the limits are read from the settings, loaded at startup
+                backlog = sum(mutation_limit(endpoint_class)
+                              for endpoint_class in MUTATION_CLASSES)
+                self.jobs = queue.Queue(maxsize=backlog)
+                self.start()
+
+        job = {"done": threading.Event()}
+        self.jobs.put((func, job))
+        job['done'].wait()
+
+        if 'error' in job:
+            raise job['error']
+
+        return job['result']
+
+    def pending(self):
+        return self.jobs.qsize()
+
+
+mutation_worker = MutationWorker()
+
+
+def serialized_mutation(f):
+    """
+    wrapper function to run mutating (non GET) requests of a local gateway
+    endpoint on the mutation worker. Only use this for endpoints that don't
+    call back into the API, since the worker runs one request at a time
+    """
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+
+        if request.method == 'GET':
+            return f(*args, **kwargs)
+
+        @in_request_context
+        @copy_current_request_context
+        def mutation():
+            return f(*args, **kwargs)
+
+        return mutation_worker.submit(mutation)
+
+    return decorated
+
+
+@app.before_request
+def track_request():
+    timer = PhaseTimer()
+    timer.thread = threading.current_thread().ident
+    request.environ['rbd_target_api.timer'] = timer
+
+    request_contexts[timer.thread] = {
+        "method": request.method,
+        "path": request.full_path.rstrip('?'),
+        "remote_addr": request.remote_addr,
+        "started": timer.started}
+
+
+@app.after_request
+def record_status(response):
+    timer = request.environ.get('rbd_target_api.timer')
+    if timer is not None:
+        timer.status = response.status_code
+        timer.streamed = response.is_streamed
+    return response
+
+
+@app.teardown_request
+def untrack_request(exc):
+    ident = threading.current_thread().ident
+    request_contexts.pop(ident, None)
+
+    # a request run on the mutation worker is torn down there too, but the
+    # request is only complete when its own thread is torn down
+    timer = request.environ.get('rbd_target_api.timer')
+    if timer is not None and timer.thread == ident:
+        log_slow_request(timer, exc)
+
+
+def log_slow_request(timer, exc=None):
+    """
+    Log a request that took longer than the slow_request_threshold tunable
+    (secs, 0 disables the log) as a single line of key=value pairs, showing
+    where the time went
+    """
+
+    threshold = get_tunable('slow_request_threshold', 2.0)
+    if threshold <= 0 or getattr(timer, 'streamed', False) or \
+            request.endpoint in UNTIMED_ENDPOINTS:
+        return
+
+    total = timer.elapsed()
+    if total < threshold:
+        return
+
+    phase_total = sum(timer.phases.values())
+    fields = [("method", request.method),
+              ("path", request.path),
+              ("endpoint", request.endpoint),
+              ("caller", request.remote_addr),
+              ("status", getattr(timer, 'status', 500)),
+              ("total_ms", "{:.1f}".format(total * 1000))]
+    fields.extend(("{}_ms".format(phase),
+                   "{:.1f}".format(timer.phases.get(phase, 0) * 1000))
+                  for phase in REQUEST_PHASES)
+    fields.append(("handler_ms",
+                   "{:.1f}".format(max(total - phase_total, 0) * 1000)))
+    if exc is not None:
+        fields.append(("error", type(exc).__name__))
+
+    logger.warning("slow_request {}".format(
+        " ".join("{}={}".format(key, value) for key, value in fields)))
+
+
+@contextmanager
+def request_phase(phase):
+    """
+    attribute the time spent in the block to a phase of the current request
+    (see REQUEST_PHASES). Outside of a request, or on a thread pool thread,
+    it does nothing
+    """
+
+    timer = None
+    if has_request_context():
+        timer = request.environ.get('rbd_target_api.timer')
+
+    if timer is None:
+        yield
+        return
+
+    timer.enter(phase)
+    try:
+        yield
+    finally:
+        timer.leave()
+
+
+def timed_phase(phase):
+    """
+    wrapper function to attribute the time spent in a function to a phase of
+    the current request
+    """
+
+    def wrapper(f):
+
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            with request_phase(phase):
+                return f(*args, **kwargs)
+
+        decorated.request_phase = phase
+        return decorated
+
+    return wrapper
+
+
+valid_gateway = timed_phase('validation')(valid_gateway)
+valid_disk = timed_phase('validation')(valid_disk)
+valid_client = timed_phase('validation')(valid_client)
+
+
+def in_request_context(func):
+    """
+    wrap a function that's run on another thread (mutation worker, thread
+    pool) on behalf of the current request, so the thread is shown against
+    the request in a thread dump
+    """
+
+    context = request_contexts.get(threading.current_thread().ident)
+
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        ident = threading.current_thread().ident
+        if context is not None:
+            request_contexts[ident] = context
+        try:
+            return func(*args, **kwargs)
+        finally:
+            request_contexts.pop(ident, None)
 
     return decorated
 
@@ -220,7 +636,87 @@ def get_config():
     **RESTRICTED**
     """
     if request.method == 'GET':
-        return jsonify(config.config), 200
+
+        snapshot = get_snapshot()
+        etag = '"{}"'.format(snapshot.epoch)
+        if request.headers.get('If-None-Match') == etag:
+            return Response(status=304, headers={"ETag": etag})
+
+        headers = {"ETag": etag,
+                   "Vary": "Accept-Encoding"}
+
+        # the config is serialized once per epoch, so just hand back the
+        # encoded form of the current snapshot
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            body = snapshot.json_gzip
+            headers['Content-Encoding'] = 'gzip'
+        else:
+            body = snapshot.json
+
+        return Response(body, status=200, mimetype='application/json',
+                        headers=headers)
+
+
+@app.route('/api/config/events', methods=['GET'])
+@requires_restricted_auth
+def get_config_events():
+    """
+    Stream config object changes to the caller as server-sent events
+    Each event holds the new epoch and the config sections that changed. A
+    client may resume the stream by passing the last event id it received
+    in the Last-Event-ID header (or the last_event_id query parameter)
+    **RESTRICTED**
+    """
+
+    last_event_id = request.headers.get('Last-Event-ID',
+                                        request.args.get('last_event_id'))
+    try:
+        last_epoch = int(last_event_id)
+    except (TypeError, ValueError):
+        last_epoch = None
+
+    if not config_events.subscribe():
+        return jsonify(message="Too many config event subscribers"), 503
+
+    def event_stream(last_epoch):
+        try:
+            yield "retry: {}\n\n".format(ConfigEvents.retry_ms)
+
+            if last_epoch is None:
+                # new subscriber, so just tell it where we are now
+                last_epoch = get_snapshot().epoch
+                yield ConfigEvents.format_event('epoch',
+                                                {"epoch": last_epoch,
+                                                 "sections": []},
+                                                last_epoch)
+
+            while True:
+                events, complete = config_events.wait(last_epoch)
+                if not complete:
+                    # the subscriber has missed changes we no longer hold,
+                    # so it needs to re-read the whole config
+                    last_epoch = get_snapshot().epoch
+                    yield ConfigEvents.format_event('resync',
+                                                    {"epoch": last_epoch,
+                                                     "sections": []},
+                                                    last_epoch)
+                    continue
+
+                if not events:
+                    # keepalive, which also detects disconnected subscribers
+                    yield ": keepalive\n\n"
+                    continue
+
+                for event in events:
+                    last_epoch = event['epoch']
+                    yield ConfigEvents.format_event('change', event,
+                                                    last_epoch)
+        finally:
+            config_events.unsubscribe()
+
+    return Response(event_stream(last_epoch),
+                    mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache"})
 
 
 @app.route('/api/gateways', methods=['GET'])
@@ -230,8 +726,10 @@ def gateways():
     Return the gateway subsection of the config object to the caller
     **RESTRICTED**
     """
+
+    snapshot = get_snapshot()
     if request.method == 'GET':
-        return jsonify(config.config['gateways']), 200
+        return jsonify(snapshot.config['gateways']), 200
 
 
 @app.route('/api/gateway/<gateway_name>', methods=['PUT'])
@@ -246,6 +744,8 @@ def gateway(gateway_name=None):
     **RESTRICTED**
     """
 
+    snapshot = get_snapshot()
+
     # the definition of a gateway into an existing configuration can apply the
     # running config to the new host. The downside is that this sync task
     # could take a while if there are 100's of disks/clients. Future work should
@@ -257,7 +757,7 @@ def gateway(gateway_name=None):
 
     # first confirm that the request is actually valid, if not return a 400
     # error with the error description
-    current_config = config.config
+    current_config = snapshot.config
     gateway_usable = valid_gateway(gateway_name, ip_address, current_config)
     if gateway_usable != 'ok':
         return jsonify(message=gateway_usable), 400
@@ -265,9 +765,9 @@ def gateway(gateway_name=None):
     resp_text = "Gateway added"  # Assume the best!
     http_mode = 'https' if settings.config.api_secure else 'http'
 
-    current_disks = config.config['disks']
-    current_clients = config.config['clients']
-    target_iqn = config.config['gateways'].get('iqn')
+    current_disks = snapshot.config['disks']
+    current_clients = snapshot.config['clients']
+    target_iqn = snapshot.config['gateways'].get('iqn')
 
     total_objects = (len(current_disks.keys()) +
                      len(current_clients.keys()))
@@ -276,7 +776,7 @@ def gateway(gateway_name=None):
     if total_objects == 0:
         nosync = True
 
-    gateway_ip_list = config.config['gateways'].get('ip_list', [])
+    gateway_ip_list = list(snapshot.config['gateways'].get('ip_list', []))
 
     gateway_ip_list.append(ip_address)
 
@@ -304,7 +804,7 @@ def gateway(gateway_name=None):
         if len(current_disks.keys()) > 0:
             # there are disks in the environment, so we need to add them to the
             # new tpg created when the new gateway was added
-            seed_gateways = gateways.remove(ip_address)
+            seed_gateways = [gw for gw in gateways if gw != ip_address]
 
             resp_text, resp_code = seed_tpg(seed_gateways,
                                             gateway_name,
@@ -339,6 +839,7 @@ def gateway(gateway_name=None):
                resp_code
 
 
+@timed_phase('fanout')
 def seed_tpg(gateways, gateway_name, api_vars):
 
     http_mode = 'https' if settings.config.api_secure else 'http'
@@ -362,6 +863,7 @@ def seed_tpg(gateways, gateway_name, api_vars):
     return "TPG mapping {}".format(state), rc
 
 
+@timed_phase('fanout')
 def seed_disks(current_disks, gw_ip):
 
     http_mode = 'https' if settings.config.api_secure else 'http'
@@ -394,6 +896,7 @@ def seed_disks(current_disks, gw_ip):
            api.response.status_code
 
 
+@timed_phase('fanout')
 def seed_clients(current_clients, gw_ip):
 
     http_mode = 'https' if settings.config.api_secure else 'http'
@@ -434,6 +937,8 @@ def seed_clients(current_clients, gw_ip):
 
 @app.route('/api/_gateway/<gateway_name>', methods=['GET', 'PUT', 'DELETE'])
 @requires_restricted_auth
+@admission_control('_gateway')
+@serialized_mutation
 def _gateway(gateway_name=None):
     """
     Manage the local iSCSI gateway definition
@@ -444,11 +949,13 @@ def _gateway(gateway_name=None):
     **RESTRICTED**
     """
 
+    snapshot = get_snapshot()
+
     if request.method == 'GET':
 
-        if gateway_name in config.config['gateways']:
+        if gateway_name in snapshot.config['gateways']:
 
-            return jsonify(config.config['gateways'][gateway_name]), 200
+            return jsonify(snapshot.config['gateways'][gateway_name]), 200
         else:
             return jsonify(message="Gateway doesn't exist in the "
                                    "configuration"), 404
@@ -472,7 +979,8 @@ def _gateway(gateway_name=None):
             logger.error("Unable to create an instance of the GWTarget class")
             return jsonify(message="Failed to create the gateway"), 500
 
-        gateway.manage(target_mode)
+        with request_phase('lio'):
+            gateway.manage(target_mode)
         if gateway.error:
             logger.error("manage({}) logic failed for {}".format(target_mode,
                                                                  gateway_name))
@@ -485,19 +993,20 @@ def _gateway(gateway_name=None):
             # will actually change
             logger.info("refreshing the configuration after the gateway "
                         "creation")
-            config.refresh()
+            refresh_config()
 
         return jsonify(message="Gateway defined/mapped"), 200
 
     else:
         # DELETE gateway request
         gateway = GWTarget(logger,
-                           config.config['gateways']['iqn'],
+                           snapshot.config['gateways']['iqn'],
                            '')
         if gateway.error:
             return jsonify(message="Failed to connect to the gateway"), 500
 
-        gateway.manage('clearconfig')
+        with request_phase('lio'):
+            gateway.manage('clearconfig')
         if gateway.error:
             logger.error("clearconfig failed for {} : "
                          "{}".format(gateway_name,
@@ -507,7 +1016,7 @@ def _gateway(gateway_name=None):
 
         else:
 
-            config.refresh()
+            refresh_config()
 
             return jsonify(message="Gateway removed successfully"), 200
 
@@ -520,7 +1029,9 @@ def get_disks():
     **RESTRICTED**
     """
 
-    disk_names = config.config['disks'].keys()
+    snapshot = get_snapshot()
+
+    disk_names = snapshot.config['disks'].keys()
     response = {"disks": disk_names}
 
     return jsonify(response), 200
@@ -543,18 +1054,20 @@ def disk(image_id):
     curl --insecure --user admin:admin -d mode=create -d size=1g -d pool=rbd -d count=5 -X PUT https://192.168.122.69:5001/api/all_disk/rbd.new2_
     """
 
+    snapshot = get_snapshot()
+
     local_gw = this_host()
     logger.debug("this host is {}".format(local_gw))
-    gateways = [key for key in config.config['gateways']
-                if isinstance(config.config['gateways'][key], dict)]
+    gateways = [key for key in snapshot.config['gateways']
+                if isinstance(snapshot.config['gateways'][key], dict)]
     logger.debug("other gateways - {}".format(gateways))
     gateways.remove(local_gw)
     logger.debug("other gw's {}".format(gateways))
 
     if request.method == 'GET':
 
-        if image_id in config.config['disks']:
-            return jsonify(config.config["disks"][image_id]), 200
+        if image_id in snapshot.config['disks']:
+            return jsonify(snapshot.config["disks"][image_id]), 200
 
         else:
             return jsonify(message="rbd image {} not "
@@ -623,6 +1136,8 @@ def disk(image_id):
 
 @app.route('/api/_disk/<image_id>', methods=['GET', 'PUT', 'DELETE'])
 @requires_restricted_auth
+@admission_control('_disk')
+@serialized_mutation
 def _disk(image_id):
     """
     Manage a disk definition on the local gateway
@@ -633,10 +1148,12 @@ def _disk(image_id):
     **RESTRICTED**
     """
 
+    snapshot = get_snapshot()
+
     if request.method == 'GET':
 
-        if image_id in config.config['disks']:
-            return jsonify(config.config["disks"][image_id]), 200
+        if image_id in snapshot.config['disks']:
+            return jsonify(snapshot.config["disks"][image_id]), 200
 
         else:
             return jsonify(message="rbd image {} not "
@@ -660,17 +1177,19 @@ def _disk(image_id):
                              " : {}".format(lun.error_msg))
                 return jsonify(message="Unable to establish LUN instance"), 500
 
-            lun.allocate()
+            with request_phase('lio'):
+                lun.allocate()
             if lun.error:
                 logger.error("LUN alloc problem - {}".format(lun.error_msg))
                 return jsonify(message="LUN allocation failure"), 500
 
             if request.form['mode'] == 'create':
                 # new disk is allocated, so refresh the local config object
-                config.refresh()
+                refresh_config()
 
-                iqn = config.config['gateways']['iqn']
-                ip_list = config.config['gateways']['ip_list']
+                snapshot = get_snapshot()
+                iqn = snapshot.config['gateways']['iqn']
+                ip_list = snapshot.config['gateways']['ip_list']
 
                 # Add the mapping for the lun to ensure the block device is
                 # present on all TPG's
@@ -678,7 +1197,8 @@ def _disk(image_id):
                                    iqn,
                                    ip_list)
 
-                gateway.manage('map')
+                with request_phase('lio'):
+                    gateway.manage('map')
                 if gateway.error:
                     logger.error("LUN mapping failed : "
                                  "".format(gateway.error_msg))
@@ -717,7 +1237,8 @@ def _disk(image_id):
                          "{}".format(lun.error_msg))
             return jsonify(message="Error establishing LUN instance"), 500
 
-        lun.remove_lun()
+        with request_phase('lio'):
+            lun.remove_lun()
         if lun.error:
             if 'allocated to' in lun.error_msg:
                 # attempted to remove rbd that is still allocated to a client
@@ -728,7 +1249,7 @@ def _disk(image_id):
             logger.error("LUN remove failed : {}".format(lun.error_msg))
             return jsonify(message="Failed to remove the LUN"), status_code
 
-        config.refresh()
+        refresh_config()
 
         return jsonify(message="LUN removed"), 200
 
@@ -743,7 +1264,9 @@ def get_clients():
     **RESTRICTED**
     """
 
-    client_list = config.config['clients'].keys()
+    snapshot = get_snapshot()
+
+    client_list = snapshot.config['clients'].keys()
     response = {"clients": client_list}
 
     return jsonify(response), 200
@@ -769,14 +1292,15 @@ def _update_client(**kwargs):
         logger.error("Invalid client request - {}".format(client.error_msg))
         return 400, "Invalid client request"
 
-    client.manage('present', committer=kwargs['committing_host'])
+    with request_phase('lio'):
+        client.manage('present', committer=kwargs['committing_host'])
     if client.error:
         logger.error("client update failed on {} : "
                      "{}".format(kwargs['client_iqn'],
                                  client.error_msg))
         return 500, "Client update failed"
     else:
-        config.refresh()
+        refresh_config()
         return 200, "Client configured successfully"
 
 
@@ -791,15 +1315,17 @@ def clientauth(client_iqn):
     **RESTRICTED**
     """
 
+    snapshot = get_snapshot()
+
     # http_mode = 'https' if settings.config.api_secure else 'http'
     local_gw = this_host()
     logger.debug("this host is {}".format(local_gw))
-    gateways = [key for key in config.config['gateways']
-                if isinstance(config.config['gateways'][key], dict)]
+    gateways = [key for key in snapshot.config['gateways']
+                if isinstance(snapshot.config['gateways'][key], dict)]
     logger.debug("other gateways - {}".format(gateways))
     gateways.remove(local_gw)
 
-    lun_list = config.config['clients'][client_iqn]['luns'].keys()
+    lun_list = snapshot.config['clients'][client_iqn]['luns'].keys()
     image_list = ','.join(lun_list)
     chap = request.form.get('chap')
 
@@ -824,6 +1350,8 @@ def clientauth(client_iqn):
 
 @app.route('/api/_clientauth/<client_iqn>', methods=['PUT'])
 @requires_restricted_auth
+@admission_control('_client')
+@serialized_mutation
 def _clientauth(client_iqn):
     """
     Manage client authentication credentials on the local gateway
@@ -855,18 +1383,20 @@ def clientlun(client_iqn):
     **RESTRICTED**
     """
 
+    snapshot = get_snapshot()
+
     # http_mode = 'https' if settings.config.api_secure else 'http'
 
     local_gw = this_host()
     logger.debug("this host is {}".format(local_gw))
-    gateways = [key for key in config.config['gateways']
-                if isinstance(config.config['gateways'][key], dict)]
+    gateways = [key for key in snapshot.config['gateways']
+                if isinstance(snapshot.config['gateways'][key], dict)]
     logger.debug("other gateways - {}".format(gateways))
     gateways.remove(local_gw)
 
     disk = request.form.get('disk')
 
-    lun_list = config.config['clients'][client_iqn]['luns'].keys()
+    lun_list = snapshot.config['clients'][client_iqn]['luns'].keys()
 
     if request.method == 'PUT':
         lun_list.append(disk)
@@ -877,7 +1407,7 @@ def clientlun(client_iqn):
         else:
             return jsonify(message="disk not mapped to client"), 400
 
-    chap_obj = CHAP(config.config['clients'][client_iqn]['auth']['chap'])
+    chap_obj = CHAP(snapshot.config['clients'][client_iqn]['auth']['chap'])
     chap = "{}/{}".format(chap_obj.user, chap_obj.password)
     image_list = ','.join(lun_list)
 
@@ -905,6 +1435,8 @@ def clientlun(client_iqn):
 
 @app.route('/api/_clientlun/<client_iqn>', methods=['GET', 'PUT'])
 @requires_restricted_auth
+@admission_control('_clientlun')
+@serialized_mutation
 def _clientlun(client_iqn):
     """
     Manage the addition/removal of disks from a client on the local gateway
@@ -912,10 +1444,12 @@ def _clientlun(client_iqn):
     **RESTRICTED**
     """
 
+    snapshot = get_snapshot()
+
     if request.method == 'GET':
 
-        if client_iqn in config.config['clients']:
-            lun_config = config.config['clients'][client_iqn]['luns']
+        if client_iqn in snapshot.config['clients']:
+            lun_config = snapshot.config['clients'][client_iqn]['luns']
 
             return jsonify(message=lun_config), 200
         else:
@@ -949,14 +1483,16 @@ def client(client_iqn):
     curl --insecure --user admin:admin -X DELETE https://192.168.122.69:5001/api/all_client/iqn.1994-05.com.redhat:myhost4
     """
 
+    snapshot = get_snapshot()
+
     method = {"PUT": 'create',
               "DELETE": 'delete'}
 
     # http_mode = 'https' if settings.config.api_secure else 'http'
     local_gw = this_host()
     logger.debug("this host is {}".format(local_gw))
-    gateways = [key for key in config.config['gateways']
-                if isinstance(config.config['gateways'][key], dict)]
+    gateways = [key for key in snapshot.config['gateways']
+                if isinstance(snapshot.config['gateways'][key], dict)]
     logger.debug("other gateways - {}".format(gateways))
     gateways.remove(local_gw)
 
@@ -996,6 +1532,8 @@ def client(client_iqn):
 
 @app.route('/api/_client/<client_iqn>', methods=['GET', 'PUT', 'DELETE'])
 @requires_restricted_auth
+@admission_control('_client')
+@serialized_mutation
 def _client(client_iqn):
     """
     Manage a client definition on the local gateway
@@ -1004,10 +1542,12 @@ def _client(client_iqn):
     **RESTRICTED**
     """
 
+    snapshot = get_snapshot()
+
     if request.method == 'GET':
 
-        if client_iqn in config.config['clients']:
-            return jsonify(config.config["clients"][client_iqn]), 200
+        if client_iqn in snapshot.config['clients']:
+            return jsonify(snapshot.config["clients"][client_iqn]), 200
         else:
             return jsonify(message="Client does not exist"), 404
 
@@ -1039,9 +1579,10 @@ def _client(client_iqn):
         committing_host = request.form['committing_host']
 
         # Make sure the delete request is for a client we have defined
-        if client_iqn in config.config['clients'].keys():
+        if client_iqn in snapshot.config['clients'].keys():
             client = GWClient(logger, client_iqn, '', '')
-            client.manage('absent', committer=committing_host)
+            with request_phase('lio'):
+                client.manage('absent', committer=committing_host)
 
             if client.error:
                 logger.error("Failed to remove client : "
@@ -1050,13 +1591,341 @@ def _client(client_iqn):
 
             else:
                 if committing_host == this_host():
-                    config.refresh()
+                    refresh_config()
 
                 return jsonify(message="Client deleted ok"), 200
         else:
             logger.error("Delete request for non existent client!")
             return jsonify(message="Client does not exist!"), 404
 
+
+@app.route('/api/sessions', methods=['GET'])
+@requires_restricted_auth
+def sessions():
+    """
+    Return the iSCSI sessions of each client, across all gateways
+    The per gateway session tables are merged by client IQN, and cached for
+    a few seconds (session_cache_ttl). Concurrent requests share a single
+    query of the gateways
+    :param fresh: (str) '1' to bypass the cache (e.g. to validate a client
+                  delete against the current sessions)
+    **RESTRICTED**
+    """
+
+    ttl = get_tunable('session_cache_ttl', 5)
+    fresh = request.args.get('fresh', '0') == '1'
+
+    fetch = None
+    with session_cache_lock:
+        if not fresh:
+            cache_age = time.time() - session_cache['timestamp']
+            if session_cache['sessions'] is not None and cache_age < ttl:
+                return jsonify(session_cache['sessions']), 200
+
+            if session_cache['fetching'] is not None:
+                fetch = session_cache['fetching']
+            else:
+                session_cache['fetching'] = {"done": threading.Event(),
+                                             "sessions": None}
+
+    if fetch is not None:
+        # another request is already querying the gateways
+        fetch['done'].wait()
+        if fetch['sessions'] is not None:
+            return jsonify(fetch['sessions']), 200
+
+    # query the gateways without holding the lock, so a gateway that's slow
+    # to answer only holds up the requests waiting for this query
+    merged = None
+    try:
+        merged = merge_sessions(get_gateway_sessions())
+    finally:
+        with session_cache_lock:
+            if merged is not None:
+                session_cache['sessions'] = merged
+                session_cache['timestamp'] = time.time()
+
+            if not fresh and fetch is None:
+                leader = session_cache['fetching']
+                session_cache['fetching'] = None
+                leader['sessions'] = merged
+                leader['done'].set()
+
+    return jsonify(merged), 200
+
+
+@timed_phase('fanout')
+def get_gateway_sessions():
+    """
+    Query the _sessions endpoint of each gateway in parallel
+    :return: (dict) gateway name -> list of sessions, or None if the gateway
+             could not be queried
+    """
+
+    snapshot = get_snapshot()
+
+    http_mode = 'https' if settings.config.api_secure else 'http'
+    local_gw = this_host()
+    gateways = [key for key in snapshot.config['gateways']
+                if isinstance(snapshot.config['gateways'][key], dict)]
+
+    def _query(gw_name):
+        gw_addr = '127.0.0.1' if gw_name == local_gw else gw_name
+        gw_api = '{}://{}:{}/api/_sessions'.format(http_mode,
+                                                   gw_addr,
+                                                   settings.config.api_port)
+        api = APIRequest(gw_api)
+        try:
+            api.get()
+        except GatewayAPIError:
+            logger.warning("Unable to query sessions on {}".format(gw_name))
+            return None
+
+        if api.response.status_code != 200:
+            logger.warning("Session query on {} failed with "
+                           "{}".format(gw_name, api.response.status_code))
+            return None
+
+        return api.response.json()['sessions']
+
+    results = run_concurrently(in_request_context(_query), gateways)
+
+    return dict(zip(gateways, results))
+
+
+def merge_sessions(gateway_sessions):
+    """
+    Combine the session tables from each gateway into a per client view
+    :param gateway_sessions: (dict) gateway name -> list of sessions
+    :return: (dict) holding the merged sessions and unreachable gateways
+    """
+
+    merged = {}
+    unreachable = []
+
+    for gw_name in sorted(gateway_sessions):
+        gw_sessions = gateway_sessions[gw_name]
+        if gw_sessions is None:
+            unreachable.append(gw_name)
+            continue
+
+        for session in gw_sessions:
+            client = merged.setdefault(session['initiator'],
+                                       {"state": session['state'],
+                                        "gateways": {}})
+            if session['state'] == 'LOGGED_IN':
+                client['state'] = 'LOGGED_IN'
+
+            client['gateways'][gw_name] = {
+                "state": session['state'],
+                "connections": session['connections'],
+                "portal": session['portal']}
+
+    return {"sessions": merged,
+            "unreachable": unreachable}
+
+
+@app.route('/api/convergence', methods=['GET'])
+@requires_restricted_auth
+def convergence():
+    """
+    Report how the config epoch has propagated across the gateways. Each
+    gateway's epoch and lag behind the newest epoch are shown, with the
+    time each gateway took to observe new epochs (after the first gateway
+    that observed them) and the cost of its config refreshes
+    **RESTRICTED**
+    """
+
+    gateway_epochs = get_gateway_epochs()
+    reachable = dict((gw_name, data) for gw_name, data in
+                     gateway_epochs.items() if data is not None)
+    if not reachable:
+        return jsonify(message="Unable to query any gateway"), 500
+
+    newest = max(data['epoch'] for data in reachable.values())
+
+    # the first time each epoch was observed by any gateway, which is as
+    # close as we get to the time it was written
+    first_seen = {}
+    for data in reachable.values():
+        for entry in data['observed']:
+            first_seen[entry['epoch']] = min(
+                first_seen.get(entry['epoch'], entry['observed_at']),
+                entry['observed_at'])
+
+    now = time.time()
+    propagation = []
+    pending = []
+    gateways = {}
+    for gw_name, data in gateway_epochs.items():
+        if data is None:
+            gateways[gw_name] = {"reachable": False}
+            continue
+
+        delays = []
+        for epoch, written in first_seen.items():
+            seen = observed_time(data, epoch, written)
+            if seen is not None:
+                delays.append(seen - written)
+
+        behind = [written for epoch, written in first_seen.items()
+                  if epoch > data['epoch']]
+
+        gateways[gw_name] = {
+            "reachable": True,
+            "epoch": data['epoch'],
+            "lag_epochs": newest - data['epoch'],
+            "lag_s": round(now - min(behind), 3) if behind else 0.0,
+            "clock_offset_ms": data['clock_offset_ms'],
+            "observe_delay_ms": delay_summary(delays),
+            "refresh": data['refresh']}
+
+    # the propagation time of an epoch is the time taken for the last gateway
+    # to observe it, so it's only known once every gateway has moved past it
+    for epoch, written in sorted(first_seen.items()):
+        times = [(observed_time(data, epoch, written), data['epoch'])
+                 for data in reachable.values()]
+        if any(seen is None and gw_epoch < epoch for seen, gw_epoch in times):
+            pending.append(epoch)
+        else:
+            propagation.append(max(seen for seen, _ in times
+                                   if seen is not None) - written)
+
+    return jsonify(newest_epoch=newest,
+                   gateways=gateways,
+                   propagation_ms=delay_summary(propagation),
+                   pending_epochs=pending), 200
+
+
+def observed_time(epoch_data, epoch, written):
+    """
+    A gateway may skip epochs that change between its polls, so an epoch
+    counts as observed when it, or any later epoch, was first observed
+    :param epoch_data: (dict) a gateway's _epochs response
+    :param epoch: (int) config epoch
+    :param written: (float) time the epoch was first observed by any gateway
+    :return: (float) time the epoch was observed, or None if it wasn't (or
+             it was written before the gateway's observations begin)
+    """
+
+    if written < epoch_data['since']:
+        return None
+
+    seen = [entry['observed_at'] for entry in epoch_data['observed']
+            if entry['epoch'] >= epoch]
+    return min(seen) if seen else None
+
+
+def delay_summary(delays):
+    """
+    :param delays: (list) of secs
+    :return: (dict) count and percentiles in ms
+    """
+
+    if not delays:
+        return {"count": 0}
+
+    return {"count": len(delays),
+            "p50": round(percentile(delays, 50) * 1000, 3),
+            "p95": round(percentile(delays, 95) * 1000, 3),
+            "p99": round(percentile(delays, 99) * 1000, 3),
+            "max": round(max(delays) * 1000, 3)}
+
+
+@timed_phase('fanout')
+def get_gateway_epochs():
+    """
+    Query the _epochs endpoint of each gateway in parallel. The observation
+    times are moved onto the local clock, using the clock offset estimated
+    from the gateway's time and the request's round trip
+    :return: (dict) gateway name -> epoch data, or None if the gateway could
+             not be queried
+    """
+
+    snapshot = get_snapshot()
+
+    http_mode = 'https' if settings.config.api_secure else 'http'
+    local_gw = this_host()
+    gateways = [key for key in snapshot.config['gateways']
+                if isinstance(snapshot.config['gateways'][key], dict)]
+
+    def _query(gw_name):
+        gw_addr = '127.0.0.1' if gw_name == local_gw else gw_name
+        gw_api = '{}://{}:{}/api/_epochs'.format(http_mode,
+                                                 gw_addr,
+                                                 settings.config.api_port)
+        api = APIRequest(gw_api)
+        sent = time.time()
+        try:
+            api.get()
+        except GatewayAPIError:
+            logger.warning("Unable to query epochs on {}".format(gw_name))
+            return None
+
+        if api.response.status_code != 200:
+            logger.warning("Epoch query on {} failed with "
+                           "{}".format(gw_name, api.response.status_code))
+            return None
+
+        data = api.response.json()
+        offset = data['time'] - (sent + time.time()) / 2
+        for entry in data['observed']:
+            entry['observed_at'] -= offset
+        data['since'] -= offset
+        data['clock_offset_ms'] = round(offset * 1000, 3)
+        return data
+
+    results = run_concurrently(in_request_context(_query), gateways)
+
+    return dict(zip(gateways, results))
+
+
+@app.route('/api/_epochs', methods=['GET'])
+@requires_restricted_auth
+def _epochs():
+    """
+    Return the local gateway's config epoch, when it observed the recent
+    epochs and the cost of its config refreshes
+    Internal Use ONLY
+    **RESTRICTED**
+    """
+
+    summary = epoch_log.summary()
+    return jsonify(epoch=get_snapshot().epoch,
+                   time=time.time(),
+                   since=summary['since'],
+                   observed=summary['observed'],
+                   refresh=summary['refresh']), 200
+
+
+@app.route('/api/_sessions', methods=['GET'])
+@requires_restricted_auth
+def _sessions():
+    """
+    Return the iSCSI sessions active on the local gateway. The portal of a
+    session is the address its connections were made from (comma separated
+    when a session has several connections)
+    Internal Use ONLY
+    **RESTRICTED**
+    """
+
+    session_list = []
+
+    lio_root = RTSRoot()
+    for session in lio_root.sessions:
+        node_acl = session['parent_nodeacl']
+        connections = session.get('connections', [])
+        addresses = [conn['address'] for conn in connections
+                     if 'address' in conn]
+
+        session_list.append({"initiator": node_acl.node_wwn,
+                             "state": session.get('state', 'UNKNOWN'),
+                             "connections": len(connections),
+                             "portal": ','.join(addresses)})
+
+    return jsonify(sessions=session_list), 200
+
+
 @app.route('/api/hostgroups', methods=['GET'])
 @requires_restricted_auth
 def hostgroups():
@@ -1064,8 +1933,10 @@ def hostgroups():
     Return the hostgroup names defined to the configuration
     **RESTRICTED**
     """
+
+    snapshot = get_snapshot()
     if request.method == 'GET':
-        return jsonify({"groups": config.config['groups'].keys()}), 200
+        return jsonify({"groups": snapshot.config['groups'].keys()}), 200
 
 
 @app.route('/api/hostgroup/<group_name>', methods=['GET', 'PUT', 'DELETE'])
@@ -1079,12 +1950,14 @@ def hostgroup(group_name):
     :param: disks (list) list of disks that each member should have masked
     :return:
     """
+
+    snapshot = get_snapshot()
     http_mode = 'https' if settings.config.api_secure else 'http'
     valid_hostgroup_actions = ['add', 'remove']
 
     local_gw = this_host()
-    gw_list = [key for key in config.config['gateways']
-               if isinstance(config.config['gateways'][key], dict)]
+    gw_list = [key for key in snapshot.config['gateways']
+               if isinstance(snapshot.config['gateways'][key], dict)]
     gw_list.remove(local_gw)
 
     action = request.form.get('action', 'add')
@@ -1093,16 +1966,16 @@ def hostgroup(group_name):
 
     if request.method == 'GET':
         # return the requested definition
-        if group_name in config.config['groups'].keys():
-            return jsonify(config.config['groups'].get(group_name)), 200
+        if group_name in snapshot.config['groups'].keys():
+            return jsonify(snapshot.config['groups'].get(group_name)), 200
         else:
             # group name does not exist
             return jsonify(message="Group name does not exist"), 404
 
     elif request.method == 'PUT':
 
-        if group_name in config.config['groups']:
-            host_group = config.config['groups'].get(group_name)
+        if group_name in snapshot.config['groups']:
+            host_group = snapshot.config['groups'].get(group_name)
             current_members = host_group.get('members')
             current_disks = host_group.get('disks')
         else:
@@ -1147,7 +2020,7 @@ def hostgroup(group_name):
         # Delete request just purges the entry from the config, so we only
         # need to run against the local gateway
 
-        if not config.config['groups'].get(group_name, None):
+        if not snapshot.config['groups'].get(group_name, None):
             return jsonify(message="Group name '{}' not "
                                    "found".format(group_name)), 404
 
@@ -1160,7 +2033,8 @@ def hostgroup(group_name):
                                                ))
 
         api = APIRequest(api_endpoint)
-        api.delete()
+        with request_phase('fanout'):
+            api.delete()
 
         if api.response.status_code == 200:
             logger.debug("Group definition {} removed".format(group_name))
@@ -1174,6 +2048,8 @@ def hostgroup(group_name):
 
 @app.route('/api/_hostgroup/<group_name>', methods=['GET', 'PUT', 'DELETE'])
 @requires_restricted_auth
+@admission_control('_hostgroup')
+@serialized_mutation
 def _hostgroup(group_name):
     """
     Manage a hostgroup definition on the local iscsi gateway
@@ -1182,10 +2058,12 @@ def _hostgroup(group_name):
     :param group_name:
     :return:
     """
+
+    snapshot = get_snapshot()
     if request.method == 'GET':
         # return the requested definition
-        if group_name in config.config['groups'].keys():
-            return jsonify(config.config['groups'].get(group_name)), 200
+        if group_name in snapshot.config['groups'].keys():
+            return jsonify(snapshot.config['groups'].get(group_name)), 200
         else:
             # group name does not exist
             return jsonify(message="Group name does not exist"), 404
@@ -1206,10 +2084,11 @@ def _hostgroup(group_name):
         # create/update a host group definition
         grp = Group(logger, group_name, members, disks)
 
-        grp.apply()
+        with request_phase('lio'):
+            grp.apply()
 
         if not grp.error:
-            config.refresh()
+            refresh_config()
             return jsonify(message="Group created/updated"), 200
         else:
             return jsonify(message="{}".format(grp.error_msg)), 400
@@ -1217,7 +2096,8 @@ def _hostgroup(group_name):
     else:
         # request is for a delete of a host group
         grp = Group(logger, group_name)
-        grp.purge()
+        with request_phase('lio'):
+            grp.purge()
         if not grp.error:
             return jsonify(message="Group '{}' removed".format(group_name)), \
                    200
@@ -1225,6 +2105,108 @@ def _hostgroup(group_name):
             return jsonify(message=grp.error_msg), 400
 
 
+@app.route('/api/metrics', methods=['GET'])
+@requires_restricted_auth
+def get_metrics():
+    """
+    Return performance metrics for the local API server
+    **RESTRICTED**
+    """
+
+    with admission_gates_lock:
+        gates = list(admission_gates.values())
+
+    admission = dict((gate.name, gate.stats()) for gate in gates)
+
+    return jsonify(admission=admission,
+                   mutation_worker={"pending": mutation_worker.pending()},
+                   backend=backend.summary()), \
+           200
+
+
+@app.route('/api/_threads', methods=['GET'])
+@requires_restricted_auth
+def _threads():
+    """
+    Return the stack of every thread in the API server, together with the
+    request each thread is working on
+    **RESTRICTED**
+    """
+
+    now = time.time()
+    names = dict((thread.ident, thread) for thread in threading.enumerate())
+    own_thread = threading.current_thread().ident
+
+    threads = []
+    for ident, stack in sorted(thread_stacks().items()):
+        if ident == own_thread:
+            continue
+
+        thread = names.get(ident)
+        context = request_contexts.get(ident)
+        if context is not None:
+            context = dict(context)
+            context['age_s'] = round(now - context.pop('started'), 3)
+
+        threads.append({"ident": ident,
+                        "name": thread.name if thread else "unknown",
+                        "daemon": thread.daemon if thread else None,
+                        "request": context,
+                        "stack": ["{}:{} in {}: {}".format(*frame)
+                                  for frame in stack]})
+
+    return jsonify(threads=threads), 200
+
+
+@app.route('/api/_profile', methods=['GET'])
+@requires_restricted_auth
+def _profile():
+    """
+    Sample the stacks of the API server's threads for a number of seconds,
+    returning the aggregated stacks in folded format (for flamegraph.pl or
+    speedscope)
+    **RESTRICTED**
+    :param seconds: (float) sampling duration (default 10)
+    :param interval: (float) ms between samples (default 10)
+    :param format: (str) folded (default) or json
+    """
+
+    max_seconds = get_tunable('profile_max_seconds', 60.0)
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = float(request.args.get('interval', 10))
+    except ValueError:
+        return jsonify(message="seconds and interval must be numeric"), 400
+
+    if not 0 < seconds <= max_seconds or interval < 1:
+        return jsonify(message="seconds must be between 0 and {}, and "
+                               "interval at least 1ms".format(max_seconds)), 400
+
+    output_format = request.args.get('format', 'folded')
+    if output_format not in ['folded', 'json']:
+        return jsonify(message="format must be folded or json"), 400
+
+    if not profile_lock.acquire(False):
+        return jsonify(message="A profile is already running"), 409
+
+    try:
+        logger.info("Sampling thread stacks for {}s at {}ms "
+                    "intervals".format(seconds, interval))
+        sampler = StackSampler(interval / 1000.0)
+        stacks = sampler.sample(seconds)
+    finally:
+        profile_lock.release()
+
+    if output_format == 'json':
+        return jsonify(seconds=seconds,
+                       interval_ms=interval,
+                       samples=sampler.samples,
+                       stacks=stacks), 200
+
+    return Response(sampler.folded(), mimetype='text/plain')
+
+
+@timed_phase('fanout')
 def call_api(gateway_list, endpoint, element, http_method='put', api_vars=None):
     """
     Generic API handler to process a given request across multiple gateways
@@ -1337,6 +2319,245 @@ def halt(message):
     sys.exit(16)
 
 
+class ConfigSnapshot(object):
+    """
+    An immutable view of the config object at a given epoch. The config is
+    encoded (and compressed) once when the snapshot is taken, and the dict
+    handlers read is decoded from that encoding, so it's independent of the
+    Config object that the next refresh replaces. Handlers must treat the
+    dict as read-only
+    """
+
+    __slots__ = ('_epoch', '_config', '_json', '_json_gzip')
+
+    def __init__(self, config_dict):
+        encoded = json.dumps(config_dict, sort_keys=True)
+        if not isinstance(encoded, bytes):
+            encoded = encoded.encode('utf-8')
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+        self._json = encoded
+        self._json_gzip = compressor.compress(encoded) + compressor.flush()
+        self._config = json.loads(encoded.decode('utf-8'))
+        self._epoch = self._config.get('epoch', 0)
+
+    epoch = property(lambda self: self._epoch,
+                     doc="config epoch this snapshot was taken at")
+    config = property(lambda self: self._config,
+                      doc="parsed config dict (read-only)")
+    json = property(lambda self: self._json,
+                    doc="config encoded as JSON (bytes)")
+    json_gzip = property(lambda self: self._json_gzip,
+                         doc="gzip compressed JSON encoding of the config")
+
+
+class ConfigEvents(object):
+    """
+    ConfigEvents holds a short history of config epoch changes, and wakes
+    the /api/config/events subscribers when the epoch moves on. Subscribers
+    block on a condition without a timeout, so an idle subscriber costs
+    nothing - keepalives are driven by the ConfigWatcher calling tick()
+    """
+
+    retry_ms = 5000
+
+    def __init__(self, history=64):
+        self.changed = threading.Condition()
+        self.events = deque(maxlen=history)
+        self.subscribers = 0
+        self.last_tick = time.time()
+        self.epoch = None
+
+    @staticmethod
+    def format_event(event_type, data, event_id):
+        return "id: {}\nevent: {}\ndata: {}\n\n".format(event_id,
+                                                         event_type,
+                                                         json.dumps(data))
+
+    def subscribe(self):
+        limit = get_tunable('config_events_max_subscribers', 256)
+        with self.changed:
+            if self.subscribers >= limit:
+                return False
+            self.subscribers += 1
+        return True
+
+    def unsubscribe(self):
+        with self.changed:
+            self.subscribers -= 1
+
+    def publish(self, old_config, new_config):
+        """
+        Record a change event if the epoch of the config has changed
+        :param old_config: (dict) config before the refresh
+        :param new_config: (dict) config after the refresh
+        """
+
+        old_epoch = old_config.get('epoch', 0)
+        new_epoch = new_config.get('epoch', 0)
+        self.epoch = new_epoch
+        if new_epoch == old_epoch:
+            return
+
+        sections = [section for section in
+                    sorted(set(old_config) | set(new_config))
+                    if section != 'epoch' and
+                    old_config.get(section) != new_config.get(section)]
+
+        with self.changed:
+            self.events.append({"epoch": new_epoch,
+                                "previous_epoch": old_epoch,
+                                "sections": sections,
+                                "timestamp": time.time()})
+            self.changed.notify_all()
+
+    def tick(self):
+        """
+        Wake subscribers periodically, so idle streams send a keepalive
+        """
+        keepalive = get_tunable('config_events_keepalive', 15)
+        if time.time() - self.last_tick >= keepalive:
+            self.last_tick = time.time()
+            with self.changed:
+                self.changed.notify_all()
+
+    def _pending(self, last_epoch):
+        if not self.events:
+            # nothing has changed since startup
+            return [], self.epoch is None or last_epoch >= self.epoch
+
+        if last_epoch >= self.events[-1]['epoch']:
+            return [], True
+
+        complete = last_epoch >= self.events[0]['previous_epoch']
+        return [event for event in self.events
+                if event['epoch'] > last_epoch], complete
+
+    def wait(self, last_epoch):
+        """
+        Wait for events newer than the given epoch
+        :param last_epoch: (int) last epoch the subscriber has seen
+        :return: (list, bool) pending events (empty on a keepalive wakeup),
+                 and whether the history covers everything since last_epoch
+        """
+
+        with self.changed:
+            events, complete = self._pending(last_epoch)
+            if events or not complete:
+                return events, complete
+
+            self.changed.wait()
+            return self._pending(last_epoch)
+
+
+config_events = ConfigEvents()
+
+
+class EpochLog(object):
+    """
+    EpochLog records when this gateway first observed each config epoch, and
+    the cost of the refreshes of the local config. It's the per gateway
+    input to the convergence report
+    """
+
+    def __init__(self, history=256):
+        self.lock = threading.Lock()
+        self.observed = deque(maxlen=history)
+        self.refreshes = LatencyHistogram()
+        self.started = time.time()
+
+    def record(self, old_epoch, new_epoch, elapsed, source):
+        """
+        Record a refresh of the local config
+        :param old_epoch: (int) epoch before the refresh
+        :param new_epoch: (int) epoch after the refresh
+        :param elapsed: (float) secs taken by the refresh
+        :param source: (str) what triggered the refresh (request or watcher)
+        """
+
+        with self.lock:
+            self.refreshes.add(elapsed)
+            if new_epoch != old_epoch:
+                self.observed.append({"epoch": new_epoch,
+                                      "observed_at": time.time(),
+                                      "refresh_ms": round(elapsed * 1000, 3),
+                                      "source": source})
+
+    def summary(self):
+        """
+        :return: (dict) observed epochs, refresh cost and the time from which
+                 the observations are complete (startup, or the oldest
+                 observation once the history is full)
+        """
+
+        with self.lock:
+            since = self.started
+            if len(self.observed) == self.observed.maxlen:
+                since = self.observed[0]['observed_at']
+            return {"observed": list(self.observed),
+                    "since": since,
+                    "refresh": self.refreshes.summary()}
+
+
+epoch_log = EpochLog()
+
+
+# the Config object is only read and refreshed under refresh_lock (by
+# get_snapshot and refresh_config). Handlers never touch it, they read the
+# config through the snapshot of the current epoch
+config_snapshot = None
+refresh_lock = threading.Lock()
+
+
+def get_snapshot():
+    """
+    Return the snapshot of the config for the current epoch. Handlers read
+    the config through the snapshot without taking any locks
+    :return: ConfigSnapshot
+    """
+
+    global config_snapshot
+
+    if config_snapshot is None:
+        with refresh_lock:
+            if config_snapshot is None:
+                config_snapshot = ConfigSnapshot(config.config)
+
+    return config_snapshot
+
+
+def refresh_config():
+    """
+    Refresh the local copy of the config object and publish a new snapshot.
+    The refresh is recorded in the epoch log, and when the epoch has moved on
+    the change is sent to any config event subscribers
+    """
+
+    global config_snapshot
+
+    with refresh_lock:
+        previous = config_snapshot
+        if previous is None:
+            # nothing has read the config since startup
+            previous = ConfigSnapshot(config.config)
+
+        start = time.time()
+        with request_phase('refresh'):
+            config.refresh()
+        current = ConfigSnapshot(config.config)
+        config_snapshot = current
+        elapsed = time.time() - start
+
+        # still under the lock, so concurrent refreshes report their
+        # changes in epoch order. Every refresh counts towards the refresh
+        # cost, the epoch log only notes the epochs that changed
+        epoch_log.record(previous.epoch, current.epoch, elapsed,
+                         'request' if has_request_context() else 'watcher')
+        if current.epoch != previous.epoch:
+            config_events.publish(previous.config, current.config)
+
+
 class ConfigWatcher(threading.Thread):
     """
     A ConfigWatcher checks the epoc xattr of the rados config object every 'n'
@@ -1356,23 +2577,27 @@ class ConfigWatcher(threading.Thread):
             self.interval))
 
         cluster = rados.Rados(conffile=settings.config.cephconf)
-        cluster.connect()
-        ioctx = cluster.open_ioctx('rbd')
+        with backend.timed('rados.connect'):
+            cluster.connect()
+        with backend.timed('rados.open_ioctx', 'rbd'):
+            ioctx = cluster.open_ioctx('rbd')
         while True:
             time.sleep(self.interval)
+            config_events.tick()
 
             # look at the internal config object epoch (it could be refreshed
             # within an api call)
-            current_epoch = config.config['epoch']
+            current_epoch = get_snapshot().epoch
 
             # get the epoch from the xattr of the config object
             try:
-                obj_epoch = int(ioctx.get_xattr('gateway.conf', 'epoch'))
+                with backend.timed('rados.get_xattr', 'rbd'):
+                    obj_epoch = int(ioctx.get_xattr('gateway.conf', 'epoch'))
             except rados.ObjectNotFound:
                 # daemon is running prior to any config being created or it has
                 # skip the error, and
                 logger.warning("config object missing, recreating")
-                config.refresh()
+                refresh_config()
 
             else:
                 # if it's changed, refresh the local config to ensure a query
@@ -1381,7 +2606,7 @@ class ConfigWatcher(threading.Thread):
                     logger.info("Change detected - internal {} / xattr {} "
                                 "refreshing".format(current_epoch,
                                                     obj_epoch))
-                    config.refresh()
+                    refresh_config()
 
 
 def get_ssl_context():
@@ -1415,6 +2640,8 @@ def get_ssl_context():
 
 
 def main():
+    config_events.epoch = get_snapshot().epoch
+
     config_watcher = ConfigWatcher()
     config_watcher.start()
 
@@ -1455,7 +2682,7 @@ def signal_stop(*args):
 
 def signal_reload(*args):
     logger.info("Refreshing local copy of the Gateway configuration")
-    config.refresh()
+    refresh_config()
 
 
 if __name__ == '__main__':
@@ -1487,8 +2714,8 @@ if __name__ == '__main__':
 
     settings.init()
 
-    # config is set in the outer scope, so it's easily accessible to all
-    # api functions
+    # config is set in the outer scope for refresh_config/get_snapshot - the
+    # api functions read it through get_snapshot()
     config = Config(logger)
     if config.error:
         logger.error(config.error_msg)